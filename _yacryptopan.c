@@ -0,0 +1,313 @@
+/*
+ * Optional C accelerator of yacryptopan.
+ *
+ * Implements the whole Crypto-PAn loop of CryptoPAn.anonymize_bin()
+ * for buffers of addresses in the network byte order.  The padded
+ * prefixes of an address are encrypted by one AES-128-ECB call of
+ * OpenSSL (which uses AES-NI when available), and the GIL is released
+ * while a buffer is processed.  The reverse loop of
+ * CryptoPAn.deanonymize_bin() restores an address bit by bit, one AES
+ * block per bit.
+ *
+ * License: BSD
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+#include <openssl/evp.h>
+
+typedef struct {
+    PyObject_HEAD
+    unsigned char key[16];
+    unsigned char padding[16];
+} CoreObject;
+
+/* Sets block to the first pos bits of ext followed by the padding. */
+static void
+pad_prefix(const CoreObject *self, const unsigned char *ext, int pos,
+           unsigned char *block)
+{
+    int full = pos / 8, rem = pos % 8;
+
+    memcpy(block, ext, full);
+    memcpy(block + full, self->padding + full, 16 - full);
+    if (rem)
+        block[full] = (ext[full] & (0xff << (8 - rem)))
+            | (self->padding[full] & (0xff >> rem));
+}
+
+/*
+ * Deanonymizes count addresses of width bytes from src to dst.
+ * Returns 0 on success, -1 if OpenSSL failed.
+ */
+static int
+deanonymize_buffer(const CoreObject *self, const unsigned char *src,
+                   unsigned char *dst, Py_ssize_t count, int width)
+{
+    unsigned char block[16], out[32];
+    unsigned char ext[16];
+    int pos_max = width * 8;
+    int outlen, pos, ret = -1;
+    Py_ssize_t n;
+    EVP_CIPHER_CTX *ctx;
+
+    ctx = EVP_CIPHER_CTX_new();
+    if (ctx == NULL)
+        return -1;
+    if (EVP_EncryptInit_ex(ctx, EVP_aes_128_ecb(), NULL, self->key, NULL) != 1)
+        goto done;
+    EVP_CIPHER_CTX_set_padding(ctx, 0);
+
+    for (n = 0; n < count; n++) {
+        /* ext holds the original bits restored so far */
+        memset(ext, 0, sizeof(ext));
+        memcpy(ext, src + n * width, width);
+        for (pos = 0; pos < pos_max; pos++) {
+            pad_prefix(self, ext, pos, block);
+            if (EVP_EncryptUpdate(ctx, out, &outlen, block, 16) != 1)
+                goto done;
+            ext[pos / 8] ^= (out[0] & 0x80) >> (pos % 8);
+        }
+        memcpy(dst + n * width, ext, width);
+    }
+    ret = 0;
+
+done:
+    EVP_CIPHER_CTX_free(ctx);
+    return ret;
+}
+
+/*
+ * Anonymizes count addresses of width bytes from src to dst.
+ * Returns 0 on success, -1 if OpenSSL failed.
+ */
+static int
+anonymize_buffer(const CoreObject *self, const unsigned char *src,
+                 unsigned char *dst, Py_ssize_t count, int width)
+{
+    unsigned char blocks[128 * 16], out[128 * 16 + 16];
+    unsigned char ext[16];
+    int pos_max = width * 8;
+    int outlen, pos, i, ret = -1;
+    Py_ssize_t n;
+    EVP_CIPHER_CTX *ctx;
+
+    ctx = EVP_CIPHER_CTX_new();
+    if (ctx == NULL)
+        return -1;
+    if (EVP_EncryptInit_ex(ctx, EVP_aes_128_ecb(), NULL, self->key, NULL) != 1)
+        goto done;
+    EVP_CIPHER_CTX_set_padding(ctx, 0);
+
+    for (n = 0; n < count; n++) {
+        const unsigned char *addr = src + n * width;
+        unsigned char *aaddr = dst + n * width;
+
+        /* IPv4 addresses are extended to 128 bits by appending zeros */
+        memset(ext, 0, sizeof(ext));
+        memcpy(ext, addr, width);
+        for (pos = 0; pos < pos_max; pos++)
+            pad_prefix(self, ext, pos, blocks + pos * 16);
+        if (EVP_EncryptUpdate(ctx, out, &outlen, blocks, pos_max * 16) != 1)
+            goto done;
+        for (i = 0; i < width; i++) {
+            unsigned char flips = 0;
+            for (pos = i * 8; pos < i * 8 + 8; pos++)
+                flips = (flips << 1) | (out[pos * 16] >> 7);
+            aaddr[i] = addr[i] ^ flips;
+        }
+    }
+    ret = 0;
+
+done:
+    EVP_CIPHER_CTX_free(ctx);
+    return ret;
+}
+
+static int
+Core_init(CoreObject *self, PyObject *args, PyObject *kwds)
+{
+    Py_buffer key, padding;
+
+    if (!PyArg_ParseTuple(args, "y*y*", &key, &padding))
+        return -1;
+    if (key.len != 16 || padding.len != 16) {
+        PyErr_SetString(PyExc_ValueError,
+                        "the key and the padding must be 16 bytes long");
+        PyBuffer_Release(&key);
+        PyBuffer_Release(&padding);
+        return -1;
+    }
+    memcpy(self->key, key.buf, 16);
+    memcpy(self->padding, padding.buf, 16);
+    PyBuffer_Release(&key);
+    PyBuffer_Release(&padding);
+    return 0;
+}
+
+static PyObject *
+process_buffer(CoreObject *self, PyObject *args,
+               int (*process)(const CoreObject *, const unsigned char *,
+                              unsigned char *, Py_ssize_t, int))
+{
+    Py_buffer buf;
+    int width, ret;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "y*i", &buf, &width))
+        return NULL;
+    if ((width != 4 && width != 16) || buf.len % width != 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "the buffer must hold addresses of 4 or 16 bytes");
+        PyBuffer_Release(&buf);
+        return NULL;
+    }
+    result = PyBytes_FromStringAndSize(NULL, buf.len);
+    if (result == NULL) {
+        PyBuffer_Release(&buf);
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    ret = process(self, buf.buf,
+                  (unsigned char *)PyBytes_AS_STRING(result),
+                  buf.len / width, width);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&buf);
+    if (ret != 0) {
+        Py_DECREF(result);
+        PyErr_SetString(PyExc_RuntimeError, "AES encryption failed");
+        return NULL;
+    }
+    return result;
+}
+
+static PyObject *
+Core_anonymize_buffer(CoreObject *self, PyObject *args)
+{
+    return process_buffer(self, args, anonymize_buffer);
+}
+
+static PyObject *
+Core_deanonymize_buffer(CoreObject *self, PyObject *args)
+{
+    return process_buffer(self, args, deanonymize_buffer);
+}
+
+/* Encrypts len bytes (a multiple of 16) from src to dst with AES-128-ECB. */
+static int
+encrypt_ecb(const CoreObject *self, const unsigned char *src,
+            unsigned char *dst, Py_ssize_t len)
+{
+    int outlen, chunk, ret = -1;
+    EVP_CIPHER_CTX *ctx;
+
+    ctx = EVP_CIPHER_CTX_new();
+    if (ctx == NULL)
+        return -1;
+    if (EVP_EncryptInit_ex(ctx, EVP_aes_128_ecb(), NULL, self->key, NULL) != 1)
+        goto done;
+    EVP_CIPHER_CTX_set_padding(ctx, 0);
+    while (len > 0) {
+        chunk = len > (1 << 30) ? (1 << 30) : (int)len;
+        if (EVP_EncryptUpdate(ctx, dst, &outlen, src, chunk) != 1)
+            goto done;
+        src += chunk;
+        dst += chunk;
+        len -= chunk;
+    }
+    ret = 0;
+
+done:
+    EVP_CIPHER_CTX_free(ctx);
+    return ret;
+}
+
+static PyObject *
+Core_encrypt(CoreObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    int ret;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "y*", &buf))
+        return NULL;
+    if (buf.len % 16 != 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "the data must be a multiple of 16 bytes long");
+        PyBuffer_Release(&buf);
+        return NULL;
+    }
+    result = PyBytes_FromStringAndSize(NULL, buf.len);
+    if (result == NULL) {
+        PyBuffer_Release(&buf);
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    ret = encrypt_ecb(self, buf.buf, (unsigned char *)PyBytes_AS_STRING(result),
+                      buf.len);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&buf);
+    if (ret != 0) {
+        Py_DECREF(result);
+        PyErr_SetString(PyExc_RuntimeError, "AES encryption failed");
+        return NULL;
+    }
+    return result;
+}
+
+static PyMethodDef Core_methods[] = {
+    {"encrypt", (PyCFunction)Core_encrypt, METH_VARARGS,
+     "encrypt(data) -> bytes\n\n"
+     "Encrypt data of a multiple of 16 bytes with AES-128-ECB and the key,\n"
+     "as the encrypt() method of the AES backends."},
+    {"anonymize_buffer", (PyCFunction)Core_anonymize_buffer, METH_VARARGS,
+     "anonymize_buffer(buf, width) -> bytes\n\n"
+     "Anonymize the addresses of width (4 or 16) bytes held back to back\n"
+     "in buf, in the network byte order."},
+    {"deanonymize_buffer", (PyCFunction)Core_deanonymize_buffer, METH_VARARGS,
+     "deanonymize_buffer(buf, width) -> bytes\n\n"
+     "Restore the original addresses of the anonymized ones of width (4 or\n"
+     "16) bytes held back to back in buf, in the network byte order."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject CoreType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_yacryptopan.Core",
+    .tp_doc = "Core(key, padding)\n\n"
+              "The Crypto-PAn loop for the 16 bytes AES key and the 16 bytes\n"
+              "padding (the encrypted second half of the CryptoPAn key).",
+    .tp_basicsize = sizeof(CoreObject),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc)Core_init,
+    .tp_methods = Core_methods,
+};
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT,
+    "_yacryptopan",
+    "Optional C accelerator of yacryptopan.",
+    -1,
+    NULL
+};
+
+PyMODINIT_FUNC
+PyInit__yacryptopan(void)
+{
+    PyObject *m;
+
+    if (PyType_Ready(&CoreType) < 0)
+        return NULL;
+    m = PyModule_Create(&module);
+    if (m == NULL)
+        return NULL;
+    Py_INCREF(&CoreType);
+    if (PyModule_AddObject(m, "Core", (PyObject *)&CoreType) < 0) {
+        Py_DECREF(&CoreType);
+        Py_DECREF(m);
+        return NULL;
+    }
+    return m;
+}
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Addresses per second of each AES backend of CryptoPAn, and of the C
+accelerator when it is built, for single addresses (anonymize_bin)
+and batches (anonymize_bin_many).
+
+Usage: backends.py [number of addresses]
+"""
+
+from __future__ import print_function
+import random
+import sys
+import time
+import yacryptopan
+from yacryptopan import CryptoPAn, available_backends
+
+KEY = b'32-char-str-for-AES-key-and-pad.'
+
+
+def rate(func, count):
+    stime = time.time()
+    func()
+    return count / (time.time() - stime)
+
+
+def main(count):
+    implementations = [(name, CryptoPAn(KEY, backend=name))
+                       for name in available_backends()]
+    if yacryptopan._yacryptopan is not None:
+        implementations.append(('C accelerator', CryptoPAn(KEY)))
+    for (version, bits) in ((4, 32), (6, 128)):
+        addrs = [random.getrandbits(bits) for _ in range(count)]
+        expected = None
+        for (name, cp) in implementations:
+            n = count if name != 'python' else max(count // 100, 1)
+            result = cp.anonymize_bin_many(addrs[:n], version)
+            if expected is None:
+                expected = result
+            assert result == expected[:n]
+            single = rate(lambda: [cp.anonymize_bin(addr, version) for addr in addrs[:n]], n)
+            batch = rate(lambda: cp.anonymize_bin_many(addrs[:n], version), n)
+            print("IPv%d %-14s %12.1f addresses/sec single %12.1f addresses/sec batch"
+                  % (version, name, single, batch))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
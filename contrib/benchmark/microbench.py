@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Per-address latency of CryptoPAn.anonymize_bin() compared with the
+original implementation, which encrypted every prefix with its own AES
+call and assembled the flip bits with functools.reduce().
+
+Usage: microbench.py [number of addresses]
+"""
+
+from __future__ import print_function
+import random
+import sys
+import timeit
+from array import array
+from functools import reduce
+from Crypto.Cipher import AES
+from yacryptopan import CryptoPAn
+
+KEY = b'32-char-str-for-AES-key-and-pad.'
+
+
+class LegacyCryptoPAn(object):
+    """The anonymize_bin() of yacryptopan 1.0.1, kept as the baseline."""
+    def __init__(self, key):
+        self._cipher = AES.new(key[:16], AES.MODE_ECB)
+        self._padding_int = self._to_int(array('B', self._cipher.encrypt(key[16:])))
+        mask128 = reduce(lambda x, y: (x << 1) | y, [1] * 128)
+        self._masks = [mask128 >> l for l in range(128)]
+
+    def _to_array(self, int_value, int_value_len):
+        byte_array = array('B')
+        for i in range(int_value_len):
+            byte_array.insert(0, (int_value >> (i * 8)) & 0xff)
+        return byte_array
+
+    def _to_int(self, byte_array):
+        return reduce(lambda x, y: (x << 8) | y, byte_array)
+
+    def anonymize_bin(self, addr, version):
+        if version == 4:
+            pos_max = 32
+            ext_addr = addr << 96
+        else:
+            pos_max = 128
+            ext_addr = addr
+        flip_array = []
+        for pos in range(pos_max):
+            prefix = ext_addr >> (128 - pos) << (128 - pos)
+            padded_addr = prefix | (self._padding_int & self._masks[pos])
+            f = self._cipher.encrypt(self._to_array(padded_addr, 16).tobytes())
+            flip_array.append(bytearray(f)[0] >> 7)
+        result = reduce(lambda x, y: (x << 1) | y, flip_array)
+        return addr ^ result
+
+
+def latency(cp, addrs, version, repeat=5):
+    """Returns the best per-address latency in microseconds."""
+    def run():
+        for addr in addrs:
+            cp.anonymize_bin(addr, version)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(addrs) * 1e6
+
+
+def main(count):
+    implementations = [
+        ('legacy', LegacyCryptoPAn(KEY)),
+        ('current', CryptoPAn(KEY)),
+        ('current+cache', CryptoPAn(KEY, cache_size=100000)),
+    ]
+    for (version, bits) in ((4, 32), (6, 128)):
+        addrs = [random.getrandbits(bits) for _ in range(count)]
+        expected = [implementations[0][1].anonymize_bin(addr, version)
+                    for addr in addrs]
+        base = None
+        for (name, cp) in implementations:
+            assert [cp.anonymize_bin(addr, version) for addr in addrs] == expected
+            us = latency(cp, addrs, version)
+            if base is None:
+                base = us
+            print("IPv%d %-14s %9.2f us/address  speedup %6.2f"
+                  % (version, name, us, base / us))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
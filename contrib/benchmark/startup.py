@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Start-up cost of short-lived anonymization jobs: the time to import
+yacryptopan in a fresh interpreter, to create the first CryptoPAn
+instance, to create further instances with the same key, and to get
+the instance shared by CryptoPAn.shared().
+
+Each is measured for an instance using the C accelerator (when it is
+built) and for one with a prefix cache, which uses an AES backend
+instead and pays for importing it.
+
+Usage: startup.py [number of runs]
+"""
+
+from __future__ import print_function
+import statistics
+import subprocess
+import sys
+import timeit
+
+KEY = b'32-char-str-for-AES-key-and-pad.'
+
+# the configurations measured: name, CryptoPAn() options
+CONFIGURATIONS = [
+    ('C accelerator', {}),
+    ('AES backend (cache_size)', {'cache_size': 100000}),
+]
+
+# run in a fresh interpreter, prints the import and first construction
+# times in seconds
+FRESH = '''
+import time
+stime = time.perf_counter()
+import yacryptopan
+itime = time.perf_counter()
+yacryptopan.CryptoPAn(%r, **%r)
+ctime = time.perf_counter()
+print(itime - stime, ctime - itime)
+'''
+
+
+def fresh(runs, options):
+    imports = []
+    firsts = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', FRESH % (KEY, options)])
+        (import_time, first_time) = map(float, out.split())
+        imports.append(import_time)
+        firsts.append(first_time)
+    return (statistics.median(imports), statistics.median(firsts))
+
+
+def main(runs):
+    import yacryptopan
+    from yacryptopan import CryptoPAn
+    for (config, options) in CONFIGURATIONS:
+        if not options and yacryptopan._yacryptopan is None:
+            print("%s: not built" % config)
+            continue
+        print("%s:" % config)
+        (import_time, first_time) = fresh(runs, options)
+        print("  import yacryptopan          %10.2f ms" % (import_time * 1e3))
+        print("  first CryptoPAn(key)        %10.2f ms" % (first_time * 1e3))
+        CryptoPAn(KEY, **options)
+        for (name, stmt) in (('CryptoPAn(key)', lambda: CryptoPAn(KEY, **options)),
+                             ('CryptoPAn.shared(key)',
+                              lambda: CryptoPAn.shared(KEY, **options))):
+            number = 1000
+            best = min(timeit.repeat(stmt, number=number, repeat=5)) / number
+            print("  %-27s %10.2f us" % (name, best * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
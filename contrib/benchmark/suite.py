@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Benchmark suite of CryptoPAn, superseding the former
+contrib/aaronkaplan/speedtest.py (whose parallel_anonymize() speedup
+per worker count is measured with --parallel).
+
+Every combination of the following is measured:
+
+  version       IPv4, IPv6
+  distribution  random (uniform) addresses, or skewed ones drawn from a
+                pool of distinct addresses with Zipf weights
+  api           string (anonymize), string-fast (anonymize(fast=True)),
+                bin (anonymize_bin), many (anonymize_bin_many)
+  cache         none (the default instance), cold (a fresh instance with
+                the prefix and address caches), warm (the same instance
+                after a warmup pass)
+
+Each case is run --warmup times, then timed --repeat times, and the
+median, min and standard deviation of ns/op are reported with the
+median ops/sec.  The peak memory is measured with tracemalloc in one
+extra untimed run.  The results, with the environment, are printed as
+a table to stderr and as JSON to stdout (or --json FILE) to track
+regressions across releases.
+
+Usage: suite.py [--count N] [--repeat N] [--filter SUBSTRING] [--json FILE]
+"""
+
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import time
+import tracemalloc
+import yacryptopan
+from yacryptopan import CryptoPAn, available_backends, parallel_anonymize
+
+KEY = b'32-char-str-for-AES-key-and-pad.'
+
+VERSIONS = (4, 6)
+DISTRIBUTIONS = ('random', 'zipf')
+APIS = ('string', 'string-fast', 'bin', 'many')
+CACHES = ('none', 'cold', 'warm')
+
+
+def make_addresses(version, distribution, count, rng, pool_size=1000,
+                   zipf_s=1.1):
+    """Returns count address values of the version and distribution.
+
+    Skewed addresses are drawn from pool_size distinct addresses in a
+    few networks, the i-th one with a weight of 1 / i ** zipf_s.
+    """
+    bits = 32 if version == 4 else 128
+    if distribution == 'random':
+        return [rng.getrandbits(bits) for _ in range(count)]
+    networks = [rng.getrandbits(bits) for _ in range(16)]
+    host_bits = 8 if version == 4 else 64
+    pool = [(rng.choice(networks) >> host_bits << host_bits) | rng.getrandbits(host_bits)
+            for _ in range(pool_size)]
+    weights = list(itertools.accumulate(1.0 / (i + 1) ** zipf_s
+                                        for i in range(pool_size)))
+    return rng.choices(pool, cum_weights=weights, k=count)
+
+
+def to_string(value, version):
+    if version == 4:
+        return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+
+
+def make_workload(api, version, values):
+    """Returns a function anonymizing the addresses with the api."""
+    if api in ('string', 'string-fast'):
+        strings = [to_string(value, version) for value in values]
+        fast = api == 'string-fast'
+        return lambda cp: [cp.anonymize(addr, fast=fast) for addr in strings]
+    if api == 'bin':
+        return lambda cp: [cp.anonymize_bin(value, version) for value in values]
+    return lambda cp: cp.anonymize_bin_many(values, version)
+
+
+def new_instance(cache, count):
+    if cache == 'none':
+        return CryptoPAn(KEY)
+    return CryptoPAn(KEY, cache_size=8 * count, address_cache_size=count)
+
+
+def run_case(version, distribution, api, cache, args, rng):
+    values = make_addresses(version, distribution, args.count, rng)
+    workload = make_workload(api, version, values)
+    cp = new_instance(cache, args.count)
+    for _ in range(args.warmup):
+        if cache == 'cold':
+            cp = new_instance(cache, args.count)
+        workload(cp)
+    times = []
+    for _ in range(args.repeat):
+        if cache == 'cold':
+            cp = new_instance(cache, args.count)
+        stime = time.perf_counter()
+        workload(cp)
+        times.append(time.perf_counter() - stime)
+    if cache == 'cold':
+        cp = new_instance(cache, args.count)
+    tracemalloc.start()
+    workload(cp)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ns = [t / args.count * 1e9 for t in times]
+    return {
+        'name': 'ipv%d/%s/%s/%s' % (version, distribution, api, cache),
+        'version': version,
+        'distribution': distribution,
+        'api': api,
+        'cache': cache,
+        'count': args.count,
+        'repeat': args.repeat,
+        'ops_per_sec': args.count / statistics.median(times),
+        'ns_per_op': statistics.median(ns),
+        'ns_per_op_min': min(ns),
+        'ns_per_op_stdev': statistics.stdev(ns) if len(ns) > 1 else 0.0,
+        'peak_memory_bytes': peak,
+    }
+
+
+def run_parallel(args):
+    """parallel_anonymize() speedup per worker count, random addresses."""
+    rng = random.Random(args.seed)
+    addrs = [to_string(value, 4)
+             for value in make_addresses(4, 'random', args.count, rng)]
+    results = []
+    base = None
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        stime = time.perf_counter()
+        for _ in parallel_anonymize(addrs, KEY, workers=workers,
+                                    chunk_size=max(args.count // (4 * workers), 1)):
+            pass
+        rate = args.count / (time.perf_counter() - stime)
+        if base is None:
+            base = rate
+        results.append({'name': 'parallel/%d' % workers, 'workers': workers,
+                        'count': args.count, 'ops_per_sec': rate,
+                        'speedup': rate / base})
+        workers *= 2
+    return results
+
+
+def environment():
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'backends': available_backends(),
+        'accelerator': yacryptopan._yacryptopan is not None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=10000,
+                        help='addresses per run (default: 10000)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--filter', default='',
+                        help='run the cases whose name contains this, '
+                        'e.g. ipv6/zipf')
+    parser.add_argument('--parallel', action='store_true',
+                        help='also measure parallel_anonymize() per worker count')
+    parser.add_argument('--json', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    results = []
+    for (version, distribution, api, cache) in itertools.product(
+            VERSIONS, DISTRIBUTIONS, APIS, CACHES):
+        name = 'ipv%d/%s/%s/%s' % (version, distribution, api, cache)
+        if args.filter not in name:
+            continue
+        # the same addresses for every case of a distribution
+        rng = random.Random('%s/%d/%s' % (args.seed, version, distribution))
+        result = run_case(version, distribution, api, cache, args, rng)
+        results.append(result)
+        print('%-32s %12.1f ops/s %10.1f ns/op (min %.1f, stdev %.1f) %10d bytes peak'
+              % (name, result['ops_per_sec'], result['ns_per_op'],
+                 result['ns_per_op_min'], result['ns_per_op_stdev'],
+                 result['peak_memory_bytes']), file=sys.stderr)
+    if args.parallel:
+        for result in run_parallel(args):
+            results.append(result)
+            print('%-32s %12.1f ops/s speedup %.2f'
+                  % (result['name'], result['ops_per_sec'], result['speedup']),
+                  file=sys.stderr)
+
+    report = json.dumps({'environment': environment(), 'results': results},
+                        indent=2)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
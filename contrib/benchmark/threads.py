@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Throughput of a thread-safe CryptoPAn instance shared by 1, 2, 4 and 8
+threads calling anonymize_bin_many() through a ThreadPoolExecutor.
+
+Only the AES work runs in parallel (the GIL is released while the AES
+library encrypts), so the speedup depends on the batch size and on the
+share of the time spent in AES.
+
+Usage: threads.py [number of addresses] [batch size]
+"""
+
+from __future__ import print_function
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from yacryptopan import CryptoPAn
+
+KEY = b'32-char-str-for-AES-key-and-pad.'
+
+
+def main(count, batch_size):
+    for (version, bits) in ((4, 32), (6, 128)):
+        addrs = [random.getrandbits(bits) for _ in range(count)]
+        batches = [addrs[i:i + batch_size] for i in range(0, count, batch_size)]
+        base = None
+        for threads in (1, 2, 4, 8):
+            cp = CryptoPAn(KEY, thread_safe=True)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                stime = time.time()
+                list(executor.map(lambda batch: cp.anonymize_bin_many(batch, version),
+                                  batches))
+                dtime = time.time() - stime
+            rate = count / dtime
+            if base is None:
+                base = rate
+            print("IPv%d %d threads: %10.1f addresses/sec  speedup %.2f"
+                  % (version, threads, rate, rate / base))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
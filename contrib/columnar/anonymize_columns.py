@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+Anonymize the IP address columns of CSV and Parquet files, such as flow
+records, batch by batch.
+
+Each batch of records is processed column by column: the distinct
+addresses of a column are anonymized once with a single
+CryptoPAn.anonymize_bin_many() call per IP version, and the results are
+mapped back to the rows.  With pyarrow installed the mapping is a
+vectorized take over the dictionary of distinct values, and Parquet
+files are supported; without it CSV files are read with the csv module.
+Only one batch is held in memory, whatever the size of the file.
+
+String columns hold address strings, and uint32 or int64 columns hold
+IPv4 address values (from 0 to 2**32 - 1); columns of any other type
+are rejected.  Null (and empty CSV) cells are left as they are.
+
+Usage: anonymize_columns.py hexlified_key input output -c COLUMN [-c COLUMN ...]
+"""
+
+import argparse
+import csv
+import sys
+import time
+from binascii import unhexlify
+from yacryptopan import AddressValueError, CryptoPAn
+try:
+    import _yacryptopan
+except ImportError:
+    # the optional C accelerator of yacryptopan is not built
+    _yacryptopan = None
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+
+def anonymize_values(cp, values, invalid='raise'):
+    """Anonymize a list of distinct address strings.
+
+    Args:
+        cp: the CryptoPAn instance.
+        values: a list of address strings.  Empty strings and None are
+            returned as they are.
+        invalid: 'raise' to raise AddressValueError for a value which is
+            not an address, or 'keep' to leave it as it is.
+
+    Returns:
+        A list of the anonymized strings in the order of values.
+    """
+    index = [i for (i, value) in enumerate(values) if value]
+    result = list(values)
+    try:
+        anonymized = cp.anonymize_many([values[i] for i in index], fast=True)
+    except AddressValueError:
+        if invalid == 'raise':
+            raise
+        anonymized = []
+        for i in index:
+            try:
+                anonymized.append(cp.anonymize(values[i], fast=True))
+            except AddressValueError:
+                anonymized.append(values[i])
+    for (i, value) in zip(index, anonymized):
+        result[i] = value
+    return result
+
+
+class ColumnAnonymizer(object):
+    """Anonymize the named address columns of record batches."""
+
+    def __init__(self, cp, columns, batch_size=65536, invalid='raise'):
+        """
+        Args:
+            cp: the CryptoPAn instance.
+            columns: the names of the address columns.
+            batch_size: the number of records processed at once.
+            invalid: what to do with a value which is not an address,
+                see anonymize_values().
+        """
+        assert invalid in ('raise', 'keep')
+        self._cp = cp
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.invalid = invalid
+        # the statistics printed by main()
+        self.rows = 0
+        self.distinct = 0
+
+    def _check_columns(self, names, path):
+        missing = [column for column in self.columns if column not in names]
+        if missing:
+            raise ValueError('{}: no column {}'.format(path, ', '.join(missing)))
+
+    def _anonymize_array(self, name, array):
+        """Anonymize a pyarrow array of address strings or IPv4 values."""
+        is_values = array.type in (pyarrow.uint32(), pyarrow.int64())
+        if not is_values and not (pyarrow.types.is_string(array.type) or
+                                  pyarrow.types.is_large_string(array.type)):
+            raise ValueError('column {}: type {} is not supported, an address'
+                             ' column holds strings, or IPv4 values as uint32'
+                             ' or int64'.format(name, array.type))
+        uniques = pyarrow.compute.unique(array)
+        values = uniques.to_pylist()
+        self.distinct += len(values)
+        if is_values:
+            index = [i for (i, value) in enumerate(values)
+                     if value is not None and 0 <= value <= 0xffffffff]
+            if (self.invalid == 'raise' and
+                    len(index) != len(values) - values.count(None)):
+                raise AddressValueError('column {}: a value is not an IPv4'
+                                        ' address value'.format(name))
+            anonymized = self._cp.anonymize_bin_many([values[i] for i in index], 4)
+            for (i, value) in zip(index, anonymized):
+                values[i] = value
+        else:
+            values = anonymize_values(self._cp, values, self.invalid)
+        anonymized = pyarrow.array(values, type=array.type)
+        indices = pyarrow.compute.index_in(array, value_set=uniques)
+        return pyarrow.compute.take(anonymized, indices)
+
+    def anonymize_batch(self, batch):
+        """Anonymize the address columns of a pyarrow.RecordBatch.
+
+        Returns:
+            A new pyarrow.RecordBatch with the same schema.
+        """
+        self._check_columns(batch.schema.names, 'batch')
+        arrays = []
+        for (name, array) in zip(batch.schema.names, batch.columns):
+            if name in self.columns:
+                array = self._anonymize_array(name, array)
+            arrays.append(array)
+        self.rows += batch.num_rows
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=batch.schema)
+
+    def anonymize_rows(self, rows, index):
+        """Anonymize the address columns of a list of CSV rows in place.
+
+        Args:
+            rows: a list of lists of strings.
+            index: the positions of the address columns in a row.
+        """
+        for i in index:
+            values = list(set(row[i] for row in rows))
+            self.distinct += len(values)
+            mapping = dict(zip(values,
+                               anonymize_values(self._cp, values, self.invalid)))
+            for row in rows:
+                row[i] = mapping[row[i]]
+        self.rows += len(rows)
+
+    def anonymize_csv(self, inpath, outpath):
+        """Anonymize a CSV file with a header line."""
+        if pyarrow is not None:
+            self._anonymize_csv_arrow(inpath, outpath)
+            return
+        with open(inpath, newline='') as infile, \
+                open(outpath, 'w', newline='') as outfile:
+            reader = csv.reader(infile)
+            writer = csv.writer(outfile)
+            header = next(reader, None)
+            if header is None:
+                return
+            self._check_columns(header, inpath)
+            index = [header.index(column) for column in self.columns]
+            writer.writerow(header)
+            while True:
+                rows = [row for (_, row) in zip(range(self.batch_size), reader)]
+                if not rows:
+                    break
+                self.anonymize_rows(rows, index)
+                writer.writerows(rows)
+
+    def _anonymize_csv_arrow(self, inpath, outpath):
+        # read the address columns as strings, whatever they look like
+        convert_options = pyarrow.csv.ConvertOptions(
+            column_types={column: pyarrow.string() for column in self.columns})
+        # a block of about 64 bytes per record
+        read_options = pyarrow.csv.ReadOptions(block_size=max(self.batch_size * 64, 1 << 20))
+        reader = pyarrow.csv.open_csv(inpath, read_options=read_options,
+                                      convert_options=convert_options)
+        with pyarrow.csv.CSVWriter(outpath, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(self.anonymize_batch(batch))
+
+    def anonymize_parquet(self, inpath, outpath):
+        """Anonymize a Parquet file.  This requires pyarrow."""
+        if pyarrow is None:
+            raise RuntimeError('Parquet files require pyarrow')
+        # not pyarrow.parquet, which would make pyarrow a local name
+        from pyarrow import parquet
+        infile = parquet.ParquetFile(inpath)
+        with parquet.ParquetWriter(outpath, infile.schema_arrow) as writer:
+            for batch in infile.iter_batches(batch_size=self.batch_size):
+                writer.write_table(pyarrow.Table.from_batches([self.anonymize_batch(batch)]))
+
+    def anonymize_file(self, inpath, outpath, format=None):
+        """Anonymize a file, of the format given by its extension unless
+        format ('csv' or 'parquet') is given."""
+        if format is None:
+            format = 'parquet' if inpath.endswith(('.parquet', '.pq')) else 'csv'
+        if format == 'parquet':
+            self.anonymize_parquet(inpath, outpath)
+        else:
+            self.anonymize_csv(inpath, outpath)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('key', help='the 32 bytes key as 64 hex digits')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('-c', '--column', action='append', required=True,
+                        help='the name of an address column (repeatable)')
+    parser.add_argument('--format', choices=('csv', 'parquet'),
+                        help='the file format (default: by the extension)')
+    parser.add_argument('--batch-size', type=int, default=65536)
+    parser.add_argument('--invalid', choices=('raise', 'keep'), default='raise',
+                        help='fail on a value which is not an address, or keep it')
+    # an instance with a prefix cache does not use the C accelerator,
+    # which is faster than the cache
+    default_cache_size = 0 if _yacryptopan is not None else 1000000
+    parser.add_argument('--cache-size', type=int, default=default_cache_size,
+                        help='the size of the prefix cache, 0 for none; it '
+                             'disables the C accelerator (default: %d)'
+                             % default_cache_size)
+    args = parser.parse_args()
+    key = unhexlify(args.key)
+    assert len(key) == 32, "hexlified encoded key of 32 bytes"
+    anonymizer = ColumnAnonymizer(CryptoPAn(key, cache_size=args.cache_size or None),
+                                  args.column, args.batch_size, args.invalid)
+    stime = time.time()
+    try:
+        anonymizer.anonymize_file(args.input, args.output, args.format)
+    except AddressValueError:
+        print("an address column holds a value which is not an address"
+              " (see --invalid)", file=sys.stderr)
+        return 1
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    dtime = time.time() - stime
+    print("{} rows, {} distinct addresses in {:.3f} s".format(
+        anonymizer.rows, anonymizer.distinct, dtime), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,23 +6,12 @@ IP addresses, but there is an option not to anonymize certain IP addresses
 or to preserve the prefix for certain ranges.
 
 The module fails if an anonymized IP accidentally maps into one of these special ranges.
+
+The preserved ranges are looked up by yacryptopan.AddressPolicy.
 """
 import sys
-from ipaddress import ip_network, ip_address
-from yacryptopan import CryptoPAn
-
-
-def _overwrite_prefix(ip, net):
-    """Replace the network prefix of an ip address.
-
-    Example: _overwrite_prefix(40.41.42.43, 10.1.0.0/16) = 10.1.42.43
-    """
-    host_part = int(ip) & int(net.hostmask)
-    # add the prefix of the net
-    return ip_address(int(net.network_address) | host_part)
-
-assert _overwrite_prefix(ip_address('40.41.42.43'), ip_network('10.1.0.0/16')) ==\
-        ip_address('10.1.42.43')
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_address
+from yacryptopan import AddressPolicy, CryptoPAn, PolicyCollisionError
 
 
 def _no_anonymize(ip, debug):
@@ -45,6 +34,7 @@ class IPAddressCrypt(object):
                 return true if address should not be anonymized at all.
             preserve_prefix (list<ipaddress.ip_network>): List of network
                 prefixes where only the host part should be anonymized.
+                If ranges overlap, the first listed one applies.
         """
         self.cp = CryptoPAn(key)
         self._no_anonymize = no_anonymize
@@ -53,14 +43,24 @@ class IPAddressCrypt(object):
             self._preserve_prefix = []
         else:
             self._preserve_prefix = preserve_prefix
+        # an address in overlapping ranges keeps the prefix of the first
+        # listed one, so a range inside an earlier range never applies.
+        # The policy matches the longest prefix, and gets the others.
+        first_match = []
+        for net in self._preserve_prefix:
+            if not any(net.version == prev.version and net.subnet_of(prev)
+                       for prev in first_match):
+                first_match.append(net)
+        self._policy = AddressPolicy(self.cp, preserve=first_match)
 
     def get_preserve_prefix_net(self, ip):
-        # check for ip versions necessary?
-        preserve = [net for net in self._preserve_prefix if net.version == ip.version]
-        for net in preserve:
-            if ip in net:
-                return net
-        return None
+        match = self._policy.match_bin(int(ip), ip.version)
+        if match is None:
+            return None
+        # by the version of ip, as an IPv6 value may be below 2**32
+        if ip.version == 4:
+            return IPv4Network((match[1], match[2]))
+        return IPv6Network((match[1], match[2]))
 
     def is_preserve_prefix(self, ip):
         return self.get_preserve_prefix_net(ip) is not None
@@ -71,25 +71,23 @@ class IPAddressCrypt(object):
         ip = ip_address(ip)
         if self._no_anonymize(ip, self.debug):
             return ip
-        elif self.is_preserve_prefix(ip):
-            net = self.get_preserve_prefix_net(ip)
-            ip_anonymized = ip_address(self.cp.anonymize(ip))
-            return _overwrite_prefix(ip_anonymized, net)
-        else:
-            ip_anonymized = ip_address(self.cp.anonymize(ip))
-            # Fail if anonymized IP is accidentally mapped to some special IP
-            if self._no_anonymize(ip_anonymized, debug=False):
-                print("INFO: anonymized ip {} mapped to a special ip which should "
-                      "not be anonymized ({}). Please re-run with a different key"
-                      .format(ip, ip_anonymized),
-                      file=sys.stderr)
-                sys.exit(1)
-            if self.is_preserve_prefix(ip_anonymized):
-                print("INFO: anonymized ip {} mapped to special "
-                      "address range ({} in {}). "
-                      "Please re-run with a different key"
-                      .format(ip, ip_anonymized, self.get_preserve_prefix_net(ip_anonymized)),
-                      file=sys.stderr)
-                sys.exit(1)
-            return ip_anonymized
-
+        address_class = IPv4Address if ip.version == 4 else IPv6Address
+        try:
+            # the policy keeps the prefix of the preserved ranges
+            ip_anonymized = address_class(self._policy.anonymize_bin(int(ip), ip.version))
+        except PolicyCollisionError:
+            ip_anonymized = address_class(self.cp.anonymize_bin(int(ip), ip.version))
+            print("INFO: anonymized ip {} mapped to special "
+                  "address range ({} in {}). "
+                  "Please re-run with a different key"
+                  .format(ip, ip_anonymized, self.get_preserve_prefix_net(ip_anonymized)),
+                  file=sys.stderr)
+            sys.exit(1)
+        # Fail if anonymized IP is accidentally mapped to some special IP
+        if self._no_anonymize(ip_anonymized, debug=False) and not self.is_preserve_prefix(ip):
+            print("INFO: anonymized ip {} mapped to a special ip which should "
+                  "not be anonymized ({}). Please re-run with a different key"
+                  .format(ip, ip_anonymized),
+                  file=sys.stderr)
+            sys.exit(1)
+        return ip_anonymized
@@ -1,42 +1,63 @@
 #!/usr/bin/env python
-from __future__ import absolute_import, division, print_function, unicode_literals
 import sys, os
 import unittest
 import random
 import subprocess
-from yacryptopan import CryptoPAn
-if sys.version_info < (3, 3):
-    # python 2 compatibility
-    import netaddr
-    def mk_ip_address(a, version=None):
-        return netaddr.IPAddress(a, version=version)
-    def mk_ip_network(a):
-        return netaddr.IPNetwork(a)
-    def format_ip_verbose(ip):
-        return ip.format(netaddr.ipv6_verbose)
-
-    # for bulding the CryptoPAn key
-    def bytes(ls):
-        return b''.join([chr(x) for x in ls])
-else:
-    import ipaddress
-    def mk_ip_address(a, version=None):
-        assert version is None or version == 4 or version == 6
-        if version == 4:
-            return ipaddress.IPv4Address(a)
-        elif version == 6:
-            return ipaddress.IPv6Address(a)
-        else:
-            return ipaddress.ip_address(a)
-    def mk_ip_network(a):
-        return ipaddress.ip_network(a, strict=False)
-    def format_ip_verbose(ip):
-        return ip.exploded
+import tempfile
+from yacryptopan import CryptoPAn, AddressValueError, KeyFingerprintError
+from yacryptopan import parallel_anonymize, TextAnonymizer, available_backends
+from yacryptopan import AddressPolicy, PolicyCollisionError
+from yacryptopan import MultiCryptoPAn, MultiTextAnonymizer
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try:
+    import _yacryptopan
+except ImportError:
+    _yacryptopan = None
+import ipaddress
+def mk_ip_address(a, version=None):
+    assert version is None or version == 4 or version == 6
+    if version == 4:
+        return ipaddress.IPv4Address(a)
+    elif version == 6:
+        return ipaddress.IPv6Address(a)
+    else:
+        return ipaddress.ip_address(a)
+def mk_ip_network(a):
+    return ipaddress.ip_network(a, strict=False)
+def format_ip_verbose(ip):
+    return ip.exploded
 
 
 def ip_in_subnet(ip, subnet_ip, prefix_len):
     return mk_ip_address(ip) in mk_ip_network("%s/%d" % (subnet_ip, prefix_len))
 
+REFERENCE_KEY = [21,34,23,141,51,164,207,128,19,10,91,22,73,144,125,16,216,152,143,131,121,121,101,39,98,87,76,45,42,132,34,2]
+
+def read_testvector():
+    """Returns the (raw, anonymized) IPv4 pairs shipped with the reference
+    implementation."""
+    f_raw = open("testdata/sample_trace_raw.dat", 'r') #encoding='ASCII'
+    f_anon = open("testdata/sample_trace_sanitized.dat", 'r')
+
+    def extract_IP(s):
+        return s.split('\t')[2].strip()
+
+    testvector = []
+
+    for raw in f_raw:
+        anon = f_anon.readline()
+        testvector.append((extract_IP(raw), extract_IP(anon)))
+    f_raw.close()
+    f_anon.close()
+    return testvector
+
 class ReferenceImplementationIPv4(unittest.TestCase):
     """Compares this implementation with the results shipped with the reference
     implementation of
@@ -225,6 +246,691 @@ class ReferenceImplementationIPv4(unittest.TestCase):
             self.prefix_preserving(anons, prefix_offset=96-i)
 
 
+class PrefixCache(unittest.TestCase):
+    """Runs the reference test vector through a CryptoPAn instance with
+    a prefix cache and checks the cache bookkeeping."""
+    def setUp(self):
+        self.key = REFERENCE_KEY
+        self.testvector = read_testvector()
+
+    def test_sample_trace(self):
+        cp = CryptoPAn(bytes(self.key), cache_size=10000)
+        for (raw, anon) in self.testvector:
+            self.assertEqual(cp.anonymize(raw), anon)
+        info = cp.cache_info()
+        self.assertEqual(info.hits + info.misses, len(self.testvector))
+        self.assertGreater(info.hits, 0)
+        # a second pass is served from the cache only
+        for (raw, anon) in self.testvector:
+            self.assertEqual(cp.anonymize(raw), anon)
+        self.assertEqual(cp.cache_info().misses, info.misses)
+
+    def test_bounded(self):
+        cp = CryptoPAn(bytes(self.key), cache_size=64)
+        for (raw, anon) in self.testvector:
+            self.assertEqual(cp.anonymize(raw), anon)
+            self.assertLessEqual(cp.cache_info().currsize, 64)
+        cp.cache_clear()
+        self.assertEqual(cp.cache_info(), (0, 0, 64, 0))
+        self.assertIsNone(CryptoPAn(bytes(self.key)).cache_info())
+
+
+class Batch(unittest.TestCase):
+    """The batch APIs must give the same results as the per address ones."""
+    def setUp(self):
+        self.key = REFERENCE_KEY
+        self.testvector = read_testvector()
+
+    def test_sample_trace(self):
+        cp = CryptoPAn(bytes(self.key))
+        raws = [raw for (raw, _) in self.testvector]
+        anons = [anon for (_, anon) in self.testvector]
+        self.assertEqual(cp.anonymize_many(raws), anons)
+        # the same again, with every prefix served by the cache
+        cp = CryptoPAn(bytes(self.key), cache_size=10000)
+        self.assertEqual(cp.anonymize_many(raws), anons)
+        self.assertEqual(cp.anonymize_many(raws), anons)
+
+    def test_ipv6_mixed(self):
+        cp = CryptoPAn(bytes(self.key))
+        addrs = [random.randint(0, (2**128) - 1) for _ in range(20)]
+        self.assertEqual(cp.anonymize_bin_many(addrs, 6),
+                         [cp.anonymize_bin(addr, 6) for addr in addrs])
+        mixed = ["2001:db8::1", "192.0.2.1", "::", "10.0.0.1"]
+        self.assertEqual(cp.anonymize_many(mixed),
+                         [cp.anonymize(addr) for addr in mixed])
+        self.assertEqual(cp.anonymize_many([]), [])
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class NumPyArray(unittest.TestCase):
+    """anonymize_array() must match anonymize_bin() bit for bit."""
+    def setUp(self):
+        self.key = REFERENCE_KEY
+        self.testvector = read_testvector()
+
+    def test_sample_trace(self):
+        cp = CryptoPAn(bytes(self.key))
+        raws = numpy.array([int(mk_ip_address(raw, version=4))
+                            for (raw, _) in self.testvector], dtype=numpy.uint32)
+        anons = cp.anonymize_array(raws)
+        self.assertEqual(anons.dtype, numpy.uint32)
+        for (aaddr, (_, anon)) in zip(anons, self.testvector):
+            self.assertEqual(int(aaddr), int(mk_ip_address(anon, version=4)))
+        # the shape of the input is kept
+        self.assertEqual(cp.anonymize_array(raws.reshape(10, 10)).tolist(),
+                         anons.reshape(10, 10).tolist())
+
+    def test_engines(self):
+        """The vectorized engine, used when the C accelerator is not,
+        matches the scalar results."""
+        tmpdir = tempfile.mkdtemp()
+        table = os.path.join(tmpdir, "table.bin")
+        CryptoPAn(bytes(self.key)).save_table(table, depth=8)
+        addrs = [random.randint(0, (2**32) - 1) for _ in range(200)]
+        addrs += [(addrs[0] & 0xffffff00) | i for i in range(50)]
+        raws = numpy.array(addrs, dtype=numpy.uint32)
+        options = [{'cache_size': 1000}, {'table': table}]
+        options += [{'backend': name} for name in available_backends()]
+        for kwargs in options:
+            with self.subTest(**kwargs):
+                cp = CryptoPAn(bytes(self.key), **kwargs)
+                self.assertIsNone(cp._core)
+                self.assertEqual(cp.anonymize_array(raws).tolist(),
+                                 [cp.anonymize_bin(addr, 4) for addr in addrs])
+                del cp
+        os.remove(table)
+        os.rmdir(tmpdir)
+
+
+class PrefixTable(unittest.TestCase):
+    """Anonymize the reference test vector with a precomputed prefix table."""
+    def setUp(self):
+        self.key = REFERENCE_KEY
+        self.testvector = read_testvector()
+        self.tmpdir = tempfile.mkdtemp()
+        self.table = os.path.join(self.tmpdir, "table.bin")
+
+    def tearDown(self):
+        os.remove(self.table)
+        os.rmdir(self.tmpdir)
+
+    def test_sample_trace(self):
+        CryptoPAn(bytes(self.key)).save_table(self.table, depth=16)
+        self.assertEqual(os.path.getsize(self.table), 48 + 2 * 2**16)
+        cp = CryptoPAn(bytes(self.key), table=self.table)
+        for (raw, anon) in self.testvector:
+            self.assertEqual(cp.anonymize(raw), anon)
+        raws = [raw for (raw, _) in self.testvector]
+        anons = [anon for (_, anon) in self.testvector]
+        self.assertEqual(cp.anonymize_many(raws), anons)
+        # IPv6 addresses share the top of the prefix tree
+        cp_plain = CryptoPAn(bytes(self.key))
+        self.assertEqual(cp.anonymize("2001:db8::1"), cp_plain.anonymize("2001:db8::1"))
+
+    def test_chunked(self):
+        # written in two subtrees of 2**16 entries
+        CryptoPAn(bytes(self.key)).save_table(self.table, depth=17)
+        self.assertEqual(os.path.getsize(self.table), 48 + 4 * 2**17)
+        cp = CryptoPAn(bytes(self.key), table=self.table)
+        self.assertEqual(cp.anonymize_many([raw for (raw, _) in self.testvector]),
+                         [anon for (_, anon) in self.testvector])
+
+    def test_wrong_key(self):
+        CryptoPAn(bytes(self.key)).save_table(self.table, depth=8)
+        with self.assertRaises(KeyFingerprintError):
+            CryptoPAn(bytes(range(32)), table=self.table)
+
+
+class Parallel(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        raws = [raw for (raw, _) in testvector]
+        anons = [anon for (_, anon) in testvector]
+        result = parallel_anonymize(iter(raws), bytes(REFERENCE_KEY),
+                                    workers=2, chunk_size=7)
+        self.assertEqual(list(result), anons)
+
+
+class Text(unittest.TestCase):
+    def test_sub(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        text = TextAnonymizer(cp)
+        for (raw, anon) in read_testvector():
+            line = "%s -> [%s]:80, %s.\n" % (raw, raw, raw)
+            expected = "%s -> [%s]:80, %s.\n" % (anon, anon, anon)
+            self.assertEqual(text.sub(line.encode()), expected.encode())
+        self.assertEqual(text.addresses, 300)
+        line = b"12:30:45 1.2.3.4.5 HWaddr ab:cd:ef:01:23:45 ::1 fe80::1%eth0\n"
+        expected = "12:30:45 1.2.3.4.5 HWaddr XX:XX:XX:XX:XX:XX %s %s%%eth0\n" % (
+            cp.anonymize("::1", fast=True), cp.anonymize("fe80::1", fast=True))
+        self.assertEqual(text.sub(line), expected.encode())
+        self.assertEqual(TextAnonymizer(cp, mac='keep').sub(b" 00-11-22-33-44-55\n"),
+                         b" 00-11-22-33-44-55\n")
+
+    def test_count(self):
+        text = TextAnonymizer(CryptoPAn(bytes(REFERENCE_KEY)), mac='keep')
+        for _ in range(3):
+            text.sub(b"12:30:45 ab:cd:ef:01:23:45 192.0.2.1 fe80::1\n")
+        self.assertEqual(text.addresses, 6)
+
+    def test_punctuation(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        text = TextAnonymizer(cp)
+        anon = cp.anonymize("2001:db8::1", fast=True)
+        self.assertEqual(text.sub(b"error from 2001:db8::1: refused\n"),
+                         ("error from %s: refused\n" % anon).encode())
+        self.assertEqual(text.sub(b"connected to 2001:db8::1.\n"),
+                         ("connected to %s.\n" % anon).encode())
+        self.assertEqual(text.sub(b"conn ::ffff:10.0.0.1:80 ok\n"),
+                         ("conn %s:80 ok\n" % cp.anonymize("::ffff:10.0.0.1", fast=True)).encode())
+        self.assertEqual(text.sub(b"[2001:db8::1]:443 10.0.0.1:80\n"),
+                         ("[%s]:443 %s:80\n" % (anon, cp.anonymize("10.0.0.1"))).encode())
+
+
+class FastParser(unittest.TestCase):
+    def test_sample_trace(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        for (raw, anon) in read_testvector():
+            self.assertEqual(cp.anonymize(raw, fast=True), anon)
+
+    def test_ipv6_compressed(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        for _ in range(100):
+            # random addresses with runs of zero fields
+            ip = mk_ip_address(random.randint(0, (2**128) - 1) &
+                               random.choice([2**128 - 1, 0xffff0000ffff << 80, 2**64 - 1]),
+                               version=6)
+            for addr in (str(ip), format_ip_verbose(ip)):
+                anon = cp.anonymize(addr, fast=True)
+                self.assertEqual(anon, str(mk_ip_address(cp.anonymize(addr))))
+        for addr in ("1.2.3", "01.2.3.4", "1::2::3", "", "foo"):
+            with self.assertRaises(AddressValueError):
+                cp.anonymize(addr, fast=True)
+
+
+class Packed(unittest.TestCase):
+    def test_sample_trace(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        testvector = read_testvector()
+        raws = b''.join(mk_ip_address(raw, version=4).packed for (raw, _) in testvector)
+        anons = b''.join(mk_ip_address(anon, version=4).packed for (_, anon) in testvector)
+        self.assertEqual(cp.anonymize_packed(raws[:4]), anons[:4])
+        self.assertEqual(cp.anonymize_packed_buffer(raws, 4, chunk_size=7), anons)
+        # in place
+        buf = bytearray(raws)
+        self.assertIs(cp.anonymize_packed_buffer(buf, 4, out=buf), buf)
+        self.assertEqual(buf, anons)
+
+    def test_ipv6(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        addrs = [mk_ip_address(random.randint(0, (2**128) - 1), version=6)
+                 for _ in range(10)]
+        expected = b''.join(mk_ip_address(cp.anonymize(addr)).packed for addr in addrs)
+        packed = b''.join(addr.packed for addr in addrs)
+        self.assertEqual(cp.anonymize_packed_buffer(memoryview(packed), 16), expected)
+        self.assertEqual(cp.anonymize_packed(packed[:16]), expected[:16])
+        with self.assertRaises(AddressValueError):
+            cp.anonymize_packed(packed[:5])
+        with self.assertRaises(ValueError):
+            cp.anonymize_packed_buffer(packed[:20], 16)
+
+
+class ThreadSafe(unittest.TestCase):
+    def test_sample_trace(self):
+        from concurrent.futures import ThreadPoolExecutor
+        cp = CryptoPAn(bytes(REFERENCE_KEY), cache_size=1000, thread_safe=True)
+        testvector = read_testvector() * 10
+        raws = [raw for (raw, _) in testvector]
+        chunks = [raws[i:i + 10] for i in range(0, len(raws), 10)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            result = sum(executor.map(cp.anonymize_many, chunks), [])
+        self.assertEqual(result, [anon for (_, anon) in testvector])
+        info = cp.cache_info()
+        self.assertEqual(info.hits + info.misses, len(testvector))
+
+
+@unittest.skipIf(_yacryptopan is None, "the C accelerator is not built")
+class Accelerator(unittest.TestCase):
+    """The C accelerator must match the pure Python code."""
+    def test_sample_trace(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        self.assertIsNotNone(cp._core)
+        for (raw, anon) in read_testvector():
+            self.assertEqual(cp.anonymize(raw), anon)
+            self.assertEqual(cp.anonymize(raw, fast=True), anon)
+
+    def test_parity(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        # a prefix cache makes the instance use the pure Python code
+        cp_python = CryptoPAn(bytes(REFERENCE_KEY), cache_size=10)
+        self.assertIsNone(cp_python._core)
+        for (version, bits) in ((4, 32), (6, 128)):
+            addrs = [random.randint(0, (2**bits) - 1) for _ in range(200)]
+            expected = cp_python.anonymize_bin_many(addrs, version)
+            self.assertEqual(cp.anonymize_bin_many(addrs, version), expected)
+            self.assertEqual([cp.anonymize_bin(addr, version) for addr in addrs], expected)
+            width = bits // 8
+            packed = b''.join(addr.to_bytes(width, 'big') for addr in addrs)
+            self.assertEqual(cp.anonymize_packed_buffer(packed, width),
+                             cp_python.anonymize_packed_buffer(packed, width))
+
+
+class Backends(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        self.assertIn('python', available_backends())
+        for backend in available_backends():
+            cp = CryptoPAn(bytes(REFERENCE_KEY), backend=backend)
+            for (raw, anon) in testvector:
+                self.assertEqual(cp.anonymize(raw), anon)
+            self.assertEqual(cp.anonymize_many([raw for (raw, _) in testvector]),
+                             [anon for (_, anon) in testvector])
+        with self.assertRaises(ValueError):
+            CryptoPAn(bytes(REFERENCE_KEY), backend='rot13')
+
+    def test_ipv6(self):
+        addrs = [random.randint(0, (2**128) - 1) for _ in range(5)]
+        expected = None
+        for backend in available_backends():
+            cp = CryptoPAn(bytes(REFERENCE_KEY), backend=backend)
+            result = [cp.anonymize_bin(addr, 6) for addr in addrs]
+            if expected is None:
+                expected = result
+            self.assertEqual(result, expected)
+
+    def test_default(self):
+        """The default backend is the first installed one, chosen without
+        timing the backends or building the tables of the python one."""
+        names = available_backends()
+        code = ("import yacryptopan, sys; "
+                "yacryptopan.CryptoPAn(bytes(32), cache_size=10); "
+                "print(yacryptopan._default_backend, yacryptopan._PythonAES._tables is None)")
+        ret = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                             env=dict(os.environ, PYTHONPATH=os.path.abspath('../..')))
+        self.assertEqual(ret.stdout.split(), [names[0].encode(), str(names[0] != 'python').encode()])
+        cp = CryptoPAn(bytes(REFERENCE_KEY), backend='fastest')
+        self.assertEqual(cp.anonymize_many([raw for (raw, _) in read_testvector()]),
+                         [anon for (_, anon) in read_testvector()])
+
+
+class Networks(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        for (raw, anon) in testvector:
+            for prefixlen in (0, 8, 13, 24, 32):
+                net = cp.anonymize_network('%s/%d' % (raw, prefixlen))
+                self.assertIn(mk_ip_address(anon), mk_ip_network(net))
+
+    def test_range(self):
+        for options in ({}, {'cache_size': 1000}):
+            cp = CryptoPAn(bytes(REFERENCE_KEY), **options)
+            for net in ('192.0.2.0/24', '10.16.0.0/17', '2001:db8::/116'):
+                expected = cp.anonymize_many([str(addr) for addr in mk_ip_network(net)],
+                                             fast=True)
+                self.assertEqual(list(cp.anonymize_range(net, fast=True)), expected)
+
+
+class Instrumentation(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        events = []
+        cp = CryptoPAn(bytes(REFERENCE_KEY), cache_size=1000,
+                       stats_hook=lambda *event: events.append(event))
+        for (raw, anon) in testvector:
+            self.assertEqual(cp.anonymize(raw), anon)
+        self.assertEqual(cp.anonymize_many([raw for (raw, _) in testvector]),
+                         [anon for (_, anon) in testvector])
+        stats = cp.stats()
+        self.assertEqual(stats.ipv4_addresses, 2 * len(testvector))
+        self.assertEqual(stats.ipv6_addresses, 0)
+        self.assertEqual(stats.cache_hits + stats.cache_misses, 2 * len(testvector))
+        self.assertLess(stats.aes_blocks, 2 * 32 * len(testvector))
+        self.assertEqual(len([event for event in events if event[0] == 'format']),
+                         2 * len(testvector))
+        self.assertEqual(sum(event[2] for event in events if event[0] == 'core'),
+                         2 * len(testvector))
+        self.assertAlmostEqual(sum(event[3] for event in events if event[0] == 'parse'),
+                               stats.parse_time)
+        cp.stats_clear()
+        cp.anonymize_bin(1, version=6)
+        self.assertEqual(cp.stats()[:2], (0, 1))
+        self.assertIsNone(CryptoPAn(bytes(REFERENCE_KEY)).stats())
+
+    def test_entry_points(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY), instrument=True)
+        cp.anonymize('192.0.2.1', prefix_bits=32)
+        self.assertEqual(cp.stats()[:2], (1, 0))
+        anon = cp.anonymize_bin(1, 6, prefix_bits=128)
+        self.assertEqual(cp.stats()[:2], (1, 1))
+        self.assertEqual(cp.deanonymize_bin(anon, 6), 1)
+        cp.deanonymize('192.0.2.1')
+        stats = cp.stats()
+        self.assertEqual(stats[:2], (1, 1))
+        self.assertEqual((stats.ipv4_deanonymized, stats.ipv6_deanonymized),
+                         (1, 1))
+        self.assertGreater(stats.deanonymize_time, 0)
+        cp.stats_clear()
+        cp.anonymize_network('192.0.2.0/24')
+        self.assertEqual(cp.stats()[:2], (1, 0))
+        self.assertEqual(len(list(cp.anonymize_range('192.0.2.0/28'))), 16)
+        self.assertEqual(cp.stats()[:2], (17, 0))
+        # a partly consumed range counts the addresses generated
+        next(cp.anonymize_range_bin(0, 120, 6))
+        self.assertEqual(cp.stats()[:2], (17, 1))
+
+
+class Shared(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        cp = CryptoPAn.shared(bytes(REFERENCE_KEY))
+        self.assertIs(CryptoPAn.shared(bytes(REFERENCE_KEY)), cp)
+        self.assertIsNot(CryptoPAn.shared(bytes(REFERENCE_KEY), cache_size=1000), cp)
+        self.assertIsNot(CryptoPAn.shared(bytes(32)), cp)
+        for (raw, anon) in testvector:
+            self.assertEqual(CryptoPAn.shared(bytes(REFERENCE_KEY)).anonymize(raw), anon)
+
+
+class AddressCache(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        cp = CryptoPAn(bytes(REFERENCE_KEY), address_cache_size=1000)
+        for _ in range(2):
+            for (raw, anon) in testvector:
+                self.assertEqual(cp.anonymize(raw), anon)
+        self.assertEqual(cp.anonymize_many([raw for (raw, _) in testvector]),
+                         [anon for (_, anon) in testvector])
+        info = cp.address_cache_info()
+        self.assertEqual(info.misses, len(set(raw for (raw, _) in testvector)))
+        self.assertEqual(info.hits + info.misses, 3 * len(testvector))
+
+    def test_snapshot(self):
+        testvector = read_testvector()
+        addrs = [random.randint(0, (2**128) - 1) for _ in range(20)]
+        cp = CryptoPAn(bytes(REFERENCE_KEY), address_cache_size=1000)
+        cp.anonymize_many([raw for (raw, _) in testvector])
+        expected = cp.anonymize_bin_many(addrs, 6)
+        path = os.path.join(tempfile.mkdtemp(), "snapshot")
+        cp.save_address_cache(path)
+        cp = CryptoPAn(bytes(REFERENCE_KEY), address_cache_size=1000)
+        self.assertEqual(cp.load_address_cache(path),
+                         len(set(raw for (raw, _) in testvector)) + 20)
+        self.assertEqual(cp.anonymize_many([raw for (raw, _) in testvector]),
+                         [anon for (_, anon) in testvector])
+        self.assertEqual(cp.anonymize_bin_many(addrs, 6), expected)
+        self.assertEqual(cp.address_cache_info().misses, 0)
+        cp = CryptoPAn(bytes(32), address_cache_size=1000)
+        with self.assertRaises(KeyFingerprintError):
+            cp.load_address_cache(path)
+        cp = CryptoPAn(bytes(REFERENCE_KEY), address_cache_size=1000, embedded_ipv4=True)
+        with self.assertRaises(ValueError):
+            cp.load_address_cache(path)
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+class Deanonymize(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        for options in ({}, {'cache_size': 1000}, {'backend': 'python'}):
+            cp = CryptoPAn(bytes(REFERENCE_KEY), **options)
+            for (raw, anon) in testvector:
+                self.assertEqual(cp.deanonymize(anon), raw)
+            self.assertEqual(cp.deanonymize_many([anon for (_, anon) in testvector]),
+                             [raw for (raw, _) in testvector])
+
+    def test_ipv6(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY), cache_size=1000)
+        addrs = [random.randint(0, (2**128) - 1) for _ in range(50)]
+        addrs += [(addrs[0] >> 64 << 64) | i for i in range(50)]
+        anon = cp.anonymize_bin_many(addrs, 6)
+        self.assertEqual(cp.deanonymize_bin_many(anon, 6), addrs)
+        self.assertEqual([cp.deanonymize_bin(addr, 6) for addr in anon], addrs)
+
+    def test_prefix_table(self):
+        testvector = read_testvector()
+        path = os.path.join(tempfile.mkdtemp(), "table")
+        CryptoPAn(bytes(REFERENCE_KEY)).save_table(path, depth=8)
+        cp = CryptoPAn(bytes(REFERENCE_KEY), table=path)
+        self.assertEqual(cp.deanonymize_many([anon for (_, anon) in testvector]),
+                         [raw for (raw, _) in testvector])
+        del cp
+        # the inverse of the table, with and without numpy
+        for depth in (8, 17):
+            CryptoPAn(bytes(REFERENCE_KEY)).save_table(path, depth=depth)
+            inverses = []
+            for hide_numpy in (False, True):
+                numpy_module = sys.modules.get('numpy')
+                if hide_numpy:
+                    sys.modules['numpy'] = None
+                try:
+                    cp = CryptoPAn(bytes(REFERENCE_KEY), cache_size=1000, table=path)
+                    self.assertEqual(cp.deanonymize_many([anon for (_, anon) in testvector]),
+                                     [raw for (raw, _) in testvector])
+                    inverses.append(list(cp._table_inverse()))
+                finally:
+                    if hide_numpy:
+                        if numpy_module is None:
+                            del sys.modules['numpy']
+                        else:
+                            sys.modules['numpy'] = numpy_module
+            self.assertEqual(inverses[0], inverses[1])
+            for prefix in random.sample(range(1 << depth), 100):
+                flip_bits = cp._table_lookup(prefix << (128 - depth))
+                self.assertEqual(inverses[0][prefix ^ flip_bits], flip_bits)
+            del cp
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+class Policy(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        policy = AddressPolicy(cp, passthrough=['127.0.0.0/8'],
+                               preserve=['10.0.0.0/8', '10.1.0.0/16', '2001:db8::/32'])
+        raws = [raw for (raw, _) in testvector] + ['127.0.0.1', '10.1.2.3', '10.2.3.4']
+        result = policy.anonymize_many(raws)
+        self.assertEqual(result[:len(testvector)], [anon for (_, anon) in testvector])
+        self.assertEqual(result[len(testvector)], '127.0.0.1')
+        self.assertTrue(result[-2].startswith('10.1.'))
+        self.assertTrue(result[-1].startswith('10.'))
+        self.assertEqual(policy.classify('10.1.2.3'), 'preserve')
+        self.assertIsNone(policy.classify('192.0.2.1'))
+        self.assertEqual(policy.match_bin(0x0a010203, 4), ('preserve', 0x0a010000, 16))
+        self.assertTrue(policy.anonymize('2001:db8::1').startswith('2001:db8:'))
+
+    def test_collision(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        anon = cp.anonymize_bin(0xc0000201, 4)
+        policy = AddressPolicy(cp, special=['%d.0.0.0/8' % (anon >> 24)])
+        with self.assertRaises(PolicyCollisionError):
+            policy.anonymize_bin(0xc0000201, 4)
+
+
+class IPAddressCryptPreserve(unittest.TestCase):
+    def test_overlapping(self):
+        """Overlapping preserved ranges resolve to the first listed one."""
+        from ipaddresscrypto import IPAddressCrypt
+        wide = mk_ip_network('10.0.0.0/8')
+        narrow = mk_ip_network('10.1.0.0/16')
+        for (ranges, expected) in (([wide, narrow], wide), ([narrow, wide], narrow)):
+            crypt = IPAddressCrypt(bytes(REFERENCE_KEY), preserve_prefix=ranges)
+            self.assertEqual(crypt.get_preserve_prefix_net(mk_ip_address('10.1.2.3')), expected)
+            self.assertIn(crypt.anonymize('10.1.2.3'), expected)
+            self.assertEqual(crypt.get_preserve_prefix_net(mk_ip_address('10.2.3.4')), wide)
+
+    def test_low_ipv6(self):
+        """An IPv6 range with a network value below 2**32 stays IPv6."""
+        from ipaddresscrypto import IPAddressCrypt
+        net = mk_ip_network('::/100')
+        crypt = IPAddressCrypt(bytes(REFERENCE_KEY), preserve_prefix=[net])
+        self.assertEqual(crypt.get_preserve_prefix_net(mk_ip_address('::1:2')), net)
+        self.assertIn(crypt.anonymize('::1:2'), net)
+        self.assertIsNone(crypt.get_preserve_prefix_net(mk_ip_address('0.0.1.2')))
+
+
+class MultiKey(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        mcp = MultiCryptoPAn([bytes(REFERENCE_KEY), bytes(32)], cache_size=1000)
+        other = CryptoPAn(bytes(32))
+        raws = [raw for (raw, _) in testvector] + ['2001:db8::1']
+        (result, other_result) = mcp.anonymize_many(raws)
+        self.assertEqual(result[:-1], [anon for (_, anon) in testvector])
+        self.assertEqual(other_result, [other.anonymize(raw) for raw in raws])
+        self.assertEqual(mcp.anonymize(raws[0]), [result[0], other_result[0]])
+        self.assertEqual(mcp.anonymize_bin(1, 6), [CryptoPAn(bytes(REFERENCE_KEY)).anonymize_bin(1, 6),
+                                                   other.anonymize_bin(1, 6)])
+
+    def test_text(self):
+        keys = [bytes(REFERENCE_KEY), bytes(32), bytes(range(32))]
+        text = MultiTextAnonymizer(MultiCryptoPAn(keys), memo_size=4)
+        data = b"".join(("%s -> [%s]:80, 12:30:45 ab:cd:ef:01:23:45 ::1 fe80::1%%eth0\n"
+                         % (raw, raw)).encode() for (raw, _) in read_testvector())
+        for (key, result) in zip(keys, text.sub(data)):
+            self.assertEqual(result, TextAnonymizer(CryptoPAn(key)).sub(data))
+        self.assertEqual(text.addresses, 5 * len(read_testvector()))
+
+
+class Command(unittest.TestCase):
+    """The yacryptopan command, run through main()."""
+    def setUp(self):
+        self.hexkey = bytes(REFERENCE_KEY).hex()
+        self.data = b"".join(("%s -> [2001:db8::%x]:80\n" % (raw, i)).encode()
+                             for (i, (raw, _)) in enumerate(read_testvector()))
+        self.expected = TextAnonymizer(CryptoPAn(bytes(REFERENCE_KEY))).sub(self.data)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.tmpdir):
+            os.remove(os.path.join(self.tmpdir, name))
+        os.rmdir(self.tmpdir)
+
+    def run_main(self, argv, stdin=b''):
+        """Returns the exit status, the standard output (bytes) and the
+        standard error of main(argv)."""
+        import io
+        import yacryptopan
+        streams = (sys.stdin, sys.stdout, sys.stderr)
+        sys.stdin = io.TextIOWrapper(io.BytesIO(stdin))
+        sys.stdout = io.TextIOWrapper(io.BytesIO())
+        sys.stderr = io.StringIO()
+        try:
+            try:
+                status = yacryptopan.main(argv)
+            except SystemExit as e:
+                status = e.code
+            return (status, sys.stdout.buffer.getvalue(), sys.stderr.getvalue())
+        finally:
+            (sys.stdin, sys.stdout, sys.stderr) = streams
+
+    def path(self, name, data=None):
+        path = os.path.join(self.tmpdir, name)
+        if data is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+    def test_stream(self):
+        for options in ([], ['--cache-size', '1000'], ['--block-size', '7']):
+            self.assertEqual(self.run_main(['-k', self.hexkey] + options, self.data),
+                             (0, self.expected, ''))
+
+    def test_key_file(self):
+        path = self.path("key", bytes(REFERENCE_KEY))
+        self.assertEqual(self.run_main(['--key-file', path], self.data),
+                         (0, self.expected, ''))
+
+    def test_multi_key(self):
+        inpath = self.path("in.txt", self.data)
+        other = bytes(range(32))
+        (status, stdout, _) = self.run_main(
+            ['-k', self.hexkey, '-o', self.path("out1"),
+             '-k', other.hex(), '-o', self.path("out2"), inpath, inpath])
+        self.assertEqual((status, stdout), (0, b''))
+        for (name, key) in (("out1", bytes(REFERENCE_KEY)), ("out2", other)):
+            with open(self.path(name), 'rb') as f:
+                self.assertEqual(f.read(), 2 * TextAnonymizer(CryptoPAn(key)).sub(self.data))
+
+    def test_stats(self):
+        (status, stdout, stderr) = self.run_main(['-k', self.hexkey, '--stats'], self.data)
+        self.assertEqual((status, stdout), (0, self.expected))
+        self.assertIn('%d bytes in, ' % len(self.data), stderr)
+        self.assertIn(' %d addresses ' % (2 * len(read_testvector())), stderr)
+
+    def test_errors(self):
+        for argv in ([],
+                     ['-k', 'xyz'],
+                     ['-k', self.hexkey[:-2]],
+                     ['-k', self.hexkey, '-k', self.hexkey],
+                     ['-k', self.hexkey, '-o', self.path("out1"), '-o', self.path("out2")],
+                     ['-k', self.hexkey, '--cache-size', '-1'],
+                     ['-k', self.hexkey, '--block-size', '0']):
+            (status, stdout, stderr) = self.run_main(argv, self.data)
+            self.assertEqual((status, stdout), (2, b''), argv)
+            self.assertIn('error:', stderr)
+
+
+class PrefixBits(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        cp = CryptoPAn(bytes(REFERENCE_KEY), cache_size=1000)
+        for (raw, anon) in testvector:
+            self.assertEqual(cp.anonymize(raw, prefix_bits=32), anon)
+            raw_fields = raw.split('.')
+            anon_fields = anon.split('.')
+            self.assertEqual(cp.anonymize(raw, prefix_bits=24).split('.'),
+                             anon_fields[:3] + raw_fields[3:])
+            self.assertEqual(cp.anonymize(raw, prefix_bits={4: 16}, host_bits='zero').split('.'),
+                             anon_fields[:2] + ['0', '0'])
+
+    def test_ipv6(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY), instrument=True)
+        addr = random.randint(0, (2**128) - 1)
+        full = cp.anonymize_bin(addr, 6)
+        cp.stats_clear()
+        aaddr = cp.anonymize_bin(addr, 6, prefix_bits=64)
+        self.assertEqual(aaddr, (full >> 64 << 64) | (addr & (2**64 - 1)))
+        self.assertEqual(cp.stats().aes_blocks, 64)
+        self.assertEqual(cp.anonymize_bin(addr, 6, 64, 'zero'), full >> 64 << 64)
+        self.assertEqual(cp.anonymize_bin(addr, 6, 0), addr)
+
+
+class EmbeddedIPv4(unittest.TestCase):
+    def test_sample_trace(self):
+        testvector = read_testvector()
+        for options in ({}, {'cache_size': 1000}, {'backend': 'python'}):
+            cp = CryptoPAn(bytes(REFERENCE_KEY), embedded_ipv4=True, **options)
+            for prefix in ('::ffff:', '64:ff9b::'):
+                raws = [prefix + raw for (raw, _) in testvector]
+                result = cp.anonymize_many(raws)
+                values = [int(mk_ip_address(addr)) for addr in result]
+                self.assertEqual([str(mk_ip_address(value & 0xffffffff, 4)) for value in values],
+                                 [anon for (_, anon) in testvector])
+                self.assertEqual(len(set(value >> 32 for value in values)), 1)
+                self.assertEqual(cp.deanonymize_bin_many(values, 6),
+                                 [int(mk_ip_address(raw)) for raw in raws])
+
+    def test_6to4(self):
+        cp = CryptoPAn(bytes(REFERENCE_KEY), embedded_ipv4=True)
+        plain = CryptoPAn(bytes(REFERENCE_KEY))
+        addrs = [(0x2002 << 112) | random.randint(0, (2**112) - 1) for _ in range(50)]
+        addrs += [random.randint(0, (2**128) - 1) for _ in range(50)]
+        anon = cp.anonymize_bin_many(addrs, 6)
+        for (addr, aaddr) in zip(addrs[:50], anon):
+            self.assertEqual(aaddr >> 112, plain.anonymize_bin(addr, 6) >> 112)
+            self.assertEqual((aaddr >> 80) & 0xffffffff,
+                             plain.anonymize_bin((addr >> 80) & 0xffffffff, 4))
+            self.assertEqual(aaddr & (2**80 - 1), plain.anonymize_bin(addr, 6) & (2**80 - 1))
+        self.assertEqual(anon[50:], plain.anonymize_bin_many(addrs[50:], 6))
+        self.assertEqual(cp.deanonymize_bin_many(anon, 6), addrs)
+        net = '2002:c000:201:1::/120'
+        self.assertEqual(list(cp.anonymize_range(net)),
+                         cp.anonymize_many([str(addr) for addr in mk_ip_network(net)]))
+
+
 class Statistical(unittest.TestCase):
     def test_ipv6_hamming(self):
         """The hamming distance between entcrypted IPv6 addresses which
@@ -307,7 +1013,6 @@ class Statistical(unittest.TestCase):
     # test all tests which only do prefix_preserving with random key again
 
 
-@unittest.skipUnless(sys.version_info > (3, 4), "Examples require at least python 3")
 class Examples(unittest.TestCase):
     """Run the example code with a key where we know that we get plausible results"""
     def test_anonymize_all_the_things(self):
@@ -335,6 +1040,319 @@ f33c:8ca3:ef0f:e019:e7ff:f1e3:f91f:f800/7 f33c:8ca3:ef0f:e019:e7ff:f1e3:f91f:f80
 """
         self.assertEqual(ret.stdout, expected)
 
+    def test_anonymize_pcap(self):
+        """Rewrite a pcap and a pcapng file with an IPv4/TCP and a tagged
+        IPv6/UDP packet, and check the addresses and the checksums."""
+        import struct
+        example_prog = "../pcap/anonymize_pcap.py"
+        self.assertTrue(os.path.isfile(example_prog))
+        key = '8009ab3a605435bea0c385bea18485d8b0a1103d6590bdf48c968be5de53836e'
+        cp = CryptoPAn(bytes(bytearray.fromhex(key)))
+
+        def checksum(data):
+            if len(data) % 2:
+                data += b'\0'
+            total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+            while total >> 16:
+                total = (total & 0xffff) + (total >> 16)
+            return ~total & 0xffff
+
+        def ipv4_tcp(src, dst):
+            tcp = bytearray(struct.pack('!HHIIBBHHH', 1234, 80, 1, 0, 5 << 4, 2, 1024, 0, 0) + b'hello')
+            ip = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 1, 0, 64, 6, 0, src, dst))
+            struct.pack_into('!H', ip, 10, checksum(bytes(ip)))
+            pseudo = src + dst + struct.pack('!BBH', 0, 6, len(tcp))
+            struct.pack_into('!H', tcp, 16, checksum(pseudo + bytes(tcp)))
+            return b'\x00' * 12 + b'\x08\x00' + bytes(ip + tcp)
+
+        def ipv6_udp(src, dst):
+            udp = bytearray(struct.pack('!HHHH', 53, 53, 8 + 3, 0) + b'abc')
+            pseudo = src + dst + struct.pack('!I3xB', len(udp), 17)
+            struct.pack_into('!H', udp, 6, checksum(pseudo + bytes(udp)))
+            ip = struct.pack('!IHBB16s16s', 6 << 28, len(udp), 17, 64, src, dst)
+            return b'\x00' * 12 + b'\x81\x00\x00\x01\x86\xdd' + ip + bytes(udp)
+
+        def check(packet):
+            if packet[12:14] == b'\x08\x00':
+                ip = packet[14:34]
+                self.assertEqual(checksum(ip), 0)
+                self.assertEqual(ip[12:16], cp.anonymize_packed(mk_ip_address('192.0.2.1').packed))
+                self.assertEqual(ip[16:20], cp.anonymize_packed(mk_ip_address('198.51.100.7').packed))
+                pseudo = ip[12:20] + struct.pack('!BBH', 0, 6, len(packet) - 34)
+                self.assertEqual(checksum(pseudo + packet[34:]), 0)
+            else:
+                ip = packet[18:58]
+                self.assertEqual(ip[8:24], cp.anonymize_packed(mk_ip_address('2001:db8::1').packed))
+                pseudo = ip[8:40] + struct.pack('!I3xB', len(packet) - 58, 17)
+                self.assertEqual(checksum(pseudo + packet[58:]), 0)
+
+        packets = [ipv4_tcp(mk_ip_address('192.0.2.1').packed, mk_ip_address('198.51.100.7').packed),
+                   ipv6_udp(mk_ip_address('2001:db8::1').packed, mk_ip_address('2001:db8::2').packed)]
+        pcap = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+        for packet in packets:
+            pcap += struct.pack('<IIII', 0, 0, len(packet), len(packet)) + packet
+        pcapng = struct.pack('<IIIHHqI', 0x0a0d0d0a, 28, 0x1a2b3c4d, 1, 0, -1, 28)
+        pcapng += struct.pack('<IIHHII', 1, 20, 1, 0, 65535, 20)
+        for packet in packets:
+            padded = packet + b'\0' * (-len(packet) % 4)
+            pcapng += struct.pack('<IIIIIII', 6, 32 + len(padded), 0, 0, 0, len(packet), len(packet))
+            pcapng += padded + struct.pack('<I', 32 + len(padded))
+        # an IDB with the if_IPv4addr option, a Name Resolution Block and
+        # an obsolete Packet Block, which come out as in pcapng
+        blocks = pcapng[:28]
+        blocks += struct.pack('<IIHHI', 1, 36, 1, 0, 65535)
+        blocks += struct.pack('<HH4s4sHHI', 4, 8, packets[0][26:30], b'\xff' * 4, 0, 0, 36)
+        nrb = struct.pack('<HH4s8sHH', 1, 12, packets[0][26:30], b'host\0\0\0\0', 0, 0)
+        blocks += struct.pack('<II', 4, 12 + len(nrb)) + nrb + struct.pack('<I', 12 + len(nrb))
+        padded = packets[0] + b'\0' * (-len(packets[0]) % 4)
+        blocks += struct.pack('<IIHHIIII', 2, 32 + len(padded), 0, 0, 0, 0,
+                              len(packets[0]), len(packets[0]))
+        blocks += padded + struct.pack('<I', 32 + len(padded))
+        blocks += pcapng[28 + 20 + 32 + len(padded):]
+
+        tmpdir = tempfile.mkdtemp()
+        for (name, data) in (("test.pcap", pcap), ("test.pcapng", pcapng),
+                             ("test-blocks.pcapng", blocks)):
+            inpath = os.path.join(tmpdir, name)
+            outpath = os.path.join(tmpdir, "anon-" + name)
+            with open(inpath, 'wb') as f:
+                f.write(data)
+            ret = subprocess.run([sys.executable, example_prog, key, inpath, outpath],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.assertEqual(ret.returncode, 0)
+            with open(outpath, 'rb') as f:
+                anon = f.read()
+            self.assertEqual(len(anon), len(pcapng if name == "test-blocks.pcapng" else data))
+            self.assertNotIn(packets[0][26:30], anon)
+            if name == "test.pcap":
+                offsets = [24 + 16, 24 + 16 + len(packets[0]) + 16]
+            else:
+                offsets = [28 + 20 + 28, 28 + 20 + 32 + len(packets[0]) + (-len(packets[0]) % 4) + 28]
+            for (offset, packet) in zip(offsets, packets):
+                check(anon[offset:offset + len(packet)])
+            os.remove(inpath)
+            os.remove(outpath)
+        os.rmdir(tmpdir)
+
+    def test_anonymize_pcap_memo(self):
+        """Bound the memo of the packet capture anonymizer."""
+        sys.path.insert(0, "../pcap")
+        try:
+            from anonymize_pcap import PcapAnonymizer
+        finally:
+            sys.path.pop(0)
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        anonymizer = PcapAnonymizer(cp, memo_size=2)
+        for (raw, anon) in read_testvector()[:5]:
+            packed = bytes(map(int, raw.split('.')))
+            self.assertEqual(anonymizer._anonymize_address(packed)[0],
+                             bytes(map(int, anon.split('.'))))
+            self.assertLessEqual(len(anonymizer._memo), 2)
+
+
+    def test_anonymize_columns(self):
+        """Anonymize two address columns of a CSV file in small batches."""
+        import csv
+        example_prog = "../columnar/anonymize_columns.py"
+        self.assertTrue(os.path.isfile(example_prog))
+        key = '8009ab3a605435bea0c385bea18485d8b0a1103d6590bdf48c968be5de53836e'
+        cp = CryptoPAn(bytes(bytearray.fromhex(key)))
+        rows = [['ts', 'src', 'dst', 'bytes']]
+        for i in range(100):
+            rows.append([str(i), '192.0.2.%d' % (i % 7), '2001:db8::%x' % (i % 5) if i % 3 else '', str(i * 10)])
+        tmpdir = tempfile.mkdtemp()
+        inpath = os.path.join(tmpdir, "flows.csv")
+        outpath = os.path.join(tmpdir, "anon-flows.csv")
+        with open(inpath, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+        ret = subprocess.run([sys.executable, example_prog, key, inpath, outpath,
+                              '-c', 'src', '-c', 'dst', '--batch-size', '16'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(ret.returncode, 0)
+        with open(outpath, newline='') as f:
+            anon = list(csv.reader(f))
+        self.assertEqual(len(anon), len(rows))
+        self.assertEqual(anon[0], rows[0])
+        for (row, arow) in zip(rows[1:], anon[1:]):
+            self.assertEqual(arow[0], row[0])
+            self.assertEqual(arow[1], cp.anonymize(row[1], fast=True))
+            self.assertEqual(arow[2], cp.anonymize(row[2], fast=True) if row[2] else '')
+            self.assertEqual(arow[3], row[3])
+        os.remove(inpath)
+        os.remove(outpath)
+        os.rmdir(tmpdir)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_anonymize_columns_arrow(self):
+        """Anonymize address string and IPv4 value columns of CSV and
+        Parquet files through pyarrow."""
+        import pyarrow.csv
+        import pyarrow.parquet
+        sys.path.insert(0, "../columnar")
+        try:
+            from anonymize_columns import ColumnAnonymizer
+        finally:
+            sys.path.pop(0)
+        cp = CryptoPAn(bytes(REFERENCE_KEY))
+        raws = [raw for (raw, _) in read_testvector()]
+        values = [int(mk_ip_address(raw)) for raw in raws]
+        strings = [raw if i % 7 else None for (i, raw) in enumerate(raws)]
+        strings[1] = '2001:db8::1'
+        tmpdir = tempfile.mkdtemp()
+        inpath = os.path.join(tmpdir, "flows.parquet")
+        outpath = os.path.join(tmpdir, "anon-flows.parquet")
+        pyarrow.parquet.write_table(pyarrow.table({
+            'src': pyarrow.array(strings, type=pyarrow.string()),
+            'v4': pyarrow.array(values, type=pyarrow.uint32()),
+            'v4_64': pyarrow.array([None] + values[1:], type=pyarrow.int64()),
+            'bytes': pyarrow.array(range(len(raws)), type=pyarrow.int32())}), inpath)
+        anonymizer = ColumnAnonymizer(cp, ['src', 'v4', 'v4_64'], batch_size=16)
+        anonymizer.anonymize_file(inpath, outpath)
+        anon = pyarrow.parquet.read_table(outpath).to_pydict()
+        self.assertEqual(anon['src'], [cp.anonymize(raw, fast=True) if raw else None
+                                       for raw in strings])
+        self.assertEqual(anon['v4'], [cp.anonymize_bin(value, 4) for value in values])
+        self.assertEqual(anon['v4_64'], [None] + anon['v4'][1:])
+        self.assertEqual(anon['bytes'], list(range(len(raws))))
+
+        # only uint32 and int64 columns hold IPv4 values, from 0 to 2**32 - 1
+        with self.assertRaises(ValueError):
+            ColumnAnonymizer(cp, ['bytes']).anonymize_file(inpath, outpath)
+        pyarrow.parquet.write_table(pyarrow.table({
+            'v4': pyarrow.array([1, -1, 2**32], type=pyarrow.int64())}), inpath)
+        with self.assertRaises(AddressValueError):
+            ColumnAnonymizer(cp, ['v4']).anonymize_file(inpath, outpath)
+        ColumnAnonymizer(cp, ['v4'], invalid='keep').anonymize_file(inpath, outpath)
+        self.assertEqual(pyarrow.parquet.read_table(outpath).column('v4').to_pylist(),
+                         [cp.anonymize_bin(1, 4), -1, 2**32])
+        os.remove(inpath)
+        os.remove(outpath)
+
+        inpath = os.path.join(tmpdir, "flows.csv")
+        outpath = os.path.join(tmpdir, "anon-flows.csv")
+        pyarrow.csv.write_csv(pyarrow.table({
+            'src': pyarrow.array(raws, type=pyarrow.string()),
+            'bytes': pyarrow.array(range(len(raws)), type=pyarrow.int64())}), inpath)
+        ColumnAnonymizer(cp, ['src'], batch_size=16).anonymize_file(inpath, outpath)
+        anon = pyarrow.csv.read_csv(outpath, convert_options=pyarrow.csv.ConvertOptions(
+            column_types={'src': pyarrow.string()})).to_pydict()
+        self.assertEqual(anon['src'], [cp.anonymize(raw, fast=True) for raw in raws])
+        self.assertEqual(anon['bytes'], list(range(len(raws))))
+        os.remove(inpath)
+        os.remove(outpath)
+        os.rmdir(tmpdir)
+
+    def test_anonymization_service(self):
+        """Anonymize the reference test vector through the asyncio service
+        with concurrent clients."""
+        import asyncio
+        sys.path.insert(0, "../service")
+        try:
+            from anonymization_service import AnonymizationService, AnonymizationClient
+        finally:
+            sys.path.pop(0)
+        testvector = read_testvector()
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "service.sock")
+
+        async def run():
+            service = AnonymizationService(CryptoPAn(bytes(REFERENCE_KEY)))
+            server = await service.start(path=path)
+            clients = [await AnonymizationClient.connect(path=path) for _ in range(4)]
+            result = await asyncio.gather(*[clients[i % 4].anonymize(raw)
+                                            for (i, (raw, _)) in enumerate(testvector)])
+            with self.assertRaises(AddressValueError):
+                await clients[0].anonymize("foo")
+            # rejected before they are sent, and the responses stay in order
+            for addr in ("192.0.2.1\n192.0.2.2", "192.0.2.1\r", "192.0.2.\u0661"):
+                with self.assertRaises(AddressValueError):
+                    await clients[0].anonymize(addr)
+            self.assertEqual(await clients[0].anonymize(testvector[0][0]),
+                             testvector[0][1])
+            for client in clients:
+                await client.close()
+            server.close()
+            await server.wait_closed()
+            await service.close()
+            self.assertLess(service.batches, len(testvector))
+            return result
+
+        result = asyncio.run(run())
+        self.assertEqual(result, [anon for (_, anon) in testvector])
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(tmpdir)
+
+    def test_anonymization_service_error(self):
+        """Answer a request the service failed to anonymize with an
+        error, and keep serving the connection."""
+        import asyncio
+        sys.path.insert(0, "../service")
+        try:
+            from anonymization_service import AnonymizationService, AnonymizationClient
+        finally:
+            sys.path.pop(0)
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "service.sock")
+
+        class FailingCryptoPAn(object):
+            def anonymize_many(self, addrs, fast=False):
+                if '192.0.2.1' in addrs:
+                    raise RuntimeError('failed')
+                return ['anonymized'] * len(addrs)
+
+        async def run():
+            service = AnonymizationService(FailingCryptoPAn(), max_delay=0)
+            server = await service.start(path=path)
+            client = await AnonymizationClient.connect(path=path)
+            with self.assertRaises(RuntimeError):
+                await client.anonymize('192.0.2.1')
+            self.assertEqual(await client.anonymize('192.0.2.2'), 'anonymized')
+            await client.close()
+            server.close()
+            await server.wait_closed()
+            await service.close()
+
+        asyncio.run(asyncio.wait_for(run(), 10))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(tmpdir)
+
+    def test_anonymization_service_closed(self):
+        """Fail the pending requests of a client when the service closes
+        the connection."""
+        import asyncio
+        sys.path.insert(0, "../service")
+        try:
+            from anonymization_service import AnonymizationClient
+        finally:
+            sys.path.pop(0)
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "service.sock")
+
+        async def handle(reader, writer):
+            await reader.readline()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_unix_server(handle, path)
+            client = await AnonymizationClient.connect(path=path)
+            result = await asyncio.gather(client.anonymize('192.0.2.1'),
+                                          client.anonymize('192.0.2.2'),
+                                          return_exceptions=True)
+            with self.assertRaises(ConnectionError):
+                await client.anonymize('192.0.2.3')
+            await client.close()
+            server.close()
+            await server.wait_closed()
+            return result
+
+        for error in asyncio.run(asyncio.wait_for(run(), 10)):
+            self.assertIsInstance(error, ConnectionError)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(tmpdir)
+
 
 if __name__ == '__main__':
     unittest.main()
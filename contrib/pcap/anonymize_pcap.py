@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+"""
+Anonymize the IPv4 and IPv6 addresses in a pcap or pcapng file.
+
+The source and destination addresses of the IP headers are replaced
+with the CryptoPAn anonymized ones, and the IPv4 header checksum and
+the TCP, UDP and ICMPv6 checksums are updated incrementally (RFC 1624)
+so that they stay valid.  Packets are parsed with struct only, the
+input file is mmap'ed and the output written through a large buffer.
+
+Supported link types are Ethernet (with 802.1Q/802.1ad tags), Linux
+cooked capture and raw IP.  Addresses carried elsewhere (ARP, ICMP
+error payloads, tunnels, application data) are left untouched.
+
+In pcapng files, the packets of Enhanced, Simple and obsolete Packet
+Blocks are rewritten.  Name Resolution Blocks, which map the original
+addresses to host names, are dropped, and so are the address options
+(if_IPv4addr, if_IPv6addr) of Interface Description Blocks.
+"""
+
+import mmap
+import struct
+import sys
+import time
+from binascii import unhexlify
+from yacryptopan import CryptoPAn
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+# the offset of the checksum field in the transport headers which
+# include the addresses in their checksum
+PROTO_CHECKSUM_OFFSET = {6: 16, 17: 6, 58: 2}
+PROTO_UDP = 17
+# IPv6 extension headers which may precede the transport header
+IPV6_EXT_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+
+PCAP_MAGICS = (0xa1b2c3d4, 0xa1b23c4d)
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IDB = 1
+PCAPNG_PB = 2
+PCAPNG_SPB = 3
+PCAPNG_NRB = 4
+PCAPNG_EPB = 6
+PCAPNG_OPT_ENDOFOPT = 0
+# the IDB options holding addresses of the interface
+PCAPNG_IDB_ADDRESS_OPTIONS = (4, 5)
+
+
+def _ones_complement_sum(data):
+    """Returns the 16 bits one's complement sum of the bytes."""
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+
+def _update_checksum(packet, offset, delta, udp=False):
+    """Adds delta to the checksum at the offset (RFC 1624 eqn. 3)."""
+    (checksum,) = struct.unpack_from('!H', packet, offset)
+    if udp and checksum == 0:
+        # no checksum (UDP over IPv4)
+        return
+    total = (~checksum & 0xffff) + delta
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    checksum = ~total & 0xffff
+    if udp and checksum == 0:
+        checksum = 0xffff
+    struct.pack_into('!H', packet, offset, checksum)
+
+
+def _strip_idb_addresses(block, endian):
+    """Returns the Interface Description Block without its address
+    options."""
+    options = []
+    offset = 16
+    end = len(block) - 4
+    while offset + 4 <= end:
+        (code, length) = struct.unpack_from(endian + 'HH', block, offset)
+        size = 4 + length + (-length % 4)
+        if code == PCAPNG_OPT_ENDOFOPT:
+            break
+        if code not in PCAPNG_IDB_ADDRESS_OPTIONS:
+            options.append(block[offset:offset + size])
+        offset += size
+    if options:
+        options.append(struct.pack(endian + 'HH', PCAPNG_OPT_ENDOFOPT, 0))
+    body = block[8:16] + b''.join(options)
+    length = len(body) + 12
+    return (struct.pack(endian + 'II', PCAPNG_IDB, length) + body
+            + struct.pack(endian + 'I', length))
+
+
+class PcapAnonymizer(object):
+    """Anonymize the addresses of packet captures with a CryptoPAn instance."""
+
+    def __init__(self, cp, memo_size=1000000):
+        """
+        Args:
+            cp: the CryptoPAn instance.
+            memo_size: the maximum number of distinct addresses whose
+                 results are remembered.  The memo is cleared when full.
+        """
+        self._cp = cp
+        self._memo_size = memo_size
+        # packed address -> (anonymized packed address, checksum delta)
+        self._memo = {}
+        self.packets = 0
+        self.bytes = 0
+
+    def _anonymize_address(self, addr):
+        result = self._memo.get(addr)
+        if result is None:
+            anon = self._cp.anonymize_packed(addr)
+            # the one's complement difference of the old and new address
+            delta = (_ones_complement_sum(anon)
+                     + (~_ones_complement_sum(addr) & 0xffff))
+            result = (anon, delta)
+            if len(self._memo) >= self._memo_size:
+                self._memo.clear()
+            self._memo[addr] = result
+        return result
+
+    def _rewrite_addresses(self, packet, offset, width):
+        """Replaces the source and destination addresses at the offset and
+        returns the checksum delta."""
+        end = offset + 2 * width
+        (src, src_delta) = self._anonymize_address(bytes(packet[offset:offset + width]))
+        (dst, dst_delta) = self._anonymize_address(bytes(packet[offset + width:end]))
+        packet[offset:end] = src + dst
+        return src_delta + dst_delta
+
+    def _rewrite_transport(self, packet, proto, offset, end, delta):
+        checksum_offset = PROTO_CHECKSUM_OFFSET.get(proto)
+        if checksum_offset is not None and offset + checksum_offset + 2 <= end:
+            _update_checksum(packet, offset + checksum_offset, delta,
+                             udp=(proto == PROTO_UDP))
+
+    def _rewrite_ipv4(self, packet, offset):
+        end = len(packet)
+        if end - offset < 20:
+            return
+        ihl = (packet[offset] & 0x0f) * 4
+        if ihl < 20:
+            return
+        delta = self._rewrite_addresses(packet, offset + 12, 4)
+        _update_checksum(packet, offset + 10, delta)
+        (fragment,) = struct.unpack_from('!H', packet, offset + 6)
+        if fragment & 0x1fff == 0:
+            self._rewrite_transport(packet, packet[offset + 9], offset + ihl,
+                                    end, delta)
+
+    def _rewrite_ipv6(self, packet, offset):
+        end = len(packet)
+        if end - offset < 40:
+            return
+        delta = self._rewrite_addresses(packet, offset + 8, 16)
+        proto = packet[offset + 6]
+        offset += 40
+        while offset + 8 <= end:
+            if proto in IPV6_EXT_HEADERS:
+                (proto, length) = (packet[offset], (packet[offset + 1] + 1) * 8)
+                offset += length
+            elif proto == IPV6_FRAGMENT:
+                (fragment,) = struct.unpack_from('!H', packet, offset + 2)
+                if fragment & 0xfff8:
+                    return
+                proto = packet[offset]
+                offset += 8
+            else:
+                self._rewrite_transport(packet, proto, offset, end, delta)
+                return
+
+    def rewrite_packet(self, packet, linktype):
+        """Anonymizes the packet (a bytearray) in place."""
+        self.packets += 1
+        self.bytes += len(packet)
+        if linktype == LINKTYPE_ETHERNET:
+            offset = 12
+            if len(packet) < 14:
+                return
+            (ethertype,) = struct.unpack_from('!H', packet, offset)
+            while ethertype in ETHERTYPE_VLAN and len(packet) >= offset + 6:
+                offset += 4
+                (ethertype,) = struct.unpack_from('!H', packet, offset)
+            offset += 2
+        elif linktype == LINKTYPE_LINUX_SLL:
+            if len(packet) < 16:
+                return
+            (ethertype,) = struct.unpack_from('!H', packet, 14)
+            offset = 16
+        elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+            if not packet:
+                return
+            offset = 0
+            ethertype = ETHERTYPE_IPV4 if packet[0] >> 4 == 4 else ETHERTYPE_IPV6
+        else:
+            return
+        if ethertype == ETHERTYPE_IPV4 and len(packet) > offset and packet[offset] >> 4 == 4:
+            self._rewrite_ipv4(packet, offset)
+        elif ethertype == ETHERTYPE_IPV6 and len(packet) > offset and packet[offset] >> 4 == 6:
+            self._rewrite_ipv6(packet, offset)
+
+    def rewrite_pcap(self, data, out):
+        """Rewrites a pcap file held in data (bytes or mmap) to out."""
+        (magic,) = struct.unpack_from('<I', data, 0)
+        endian = '<' if magic in PCAP_MAGICS else '>'
+        linktype = struct.unpack_from(endian + 'I', data, 20)[0] & 0x0fffffff
+        out.write(data[:24])
+        record = struct.Struct(endian + 'IIII')
+        offset = 24
+        while offset + record.size <= len(data):
+            caplen = record.unpack_from(data, offset)[2]
+            start = offset + record.size
+            packet = bytearray(data[start:start + caplen])
+            self.rewrite_packet(packet, linktype)
+            out.write(data[offset:start])
+            out.write(packet)
+            offset = start + caplen
+
+    def rewrite_pcapng(self, data, out):
+        """Rewrites a pcapng file held in data (bytes or mmap) to out."""
+        endian = '<'
+        linktypes = []
+        offset = 0
+        while offset + 12 <= len(data):
+            (block_type,) = struct.unpack_from(endian + 'I', data, offset)
+            if block_type == PCAPNG_SHB:
+                (order,) = struct.unpack_from('<I', data, offset + 8)
+                endian = '<' if order == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                linktypes = []
+            (length,) = struct.unpack_from(endian + 'I', data, offset + 4)
+            if length < 12:
+                raise ValueError('broken pcapng block at %d' % offset)
+            block = data[offset:offset + length]
+            if block_type == PCAPNG_NRB:
+                offset += length
+                continue
+            if block_type == PCAPNG_IDB:
+                linktypes.append(struct.unpack_from(endian + 'H', block, 8)[0])
+                block = _strip_idb_addresses(block, endian)
+            elif block_type in (PCAPNG_EPB, PCAPNG_PB, PCAPNG_SPB):
+                if block_type == PCAPNG_EPB:
+                    (interface, caplen) = struct.unpack_from(endian + 'I8xI', block, 8)
+                    start = 28
+                elif block_type == PCAPNG_PB:
+                    (interface, caplen) = struct.unpack_from(endian + 'H10xI', block, 8)
+                    start = 28
+                else:
+                    (interface, caplen) = (0, struct.unpack_from(endian + 'I', block, 8)[0])
+                    caplen = min(caplen, length - 16)
+                    start = 12
+                if interface >= len(linktypes):
+                    raise ValueError('unknown pcapng interface %d' % interface)
+                block = bytearray(block)
+                packet = block[start:start + caplen]
+                self.rewrite_packet(packet, linktypes[interface])
+                block[start:start + caplen] = packet
+            out.write(block)
+            offset += length
+
+    def rewrite_file(self, inpath, outpath):
+        """Rewrites the pcap or pcapng file inpath to outpath."""
+        with open(inpath, 'rb') as f, open(outpath, 'wb', buffering=1 << 20) as out:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                (magic,) = struct.unpack_from('<I', data, 0)
+                if magic == PCAPNG_SHB:
+                    self.rewrite_pcapng(data, out)
+                elif magic in PCAP_MAGICS or struct.unpack_from('>I', data, 0)[0] in PCAP_MAGICS:
+                    self.rewrite_pcap(data, out)
+                else:
+                    raise ValueError('%s is neither a pcap nor a pcapng file' % inpath)
+            finally:
+                data.close()
+
+
+def main(argv):
+    if len(argv) != 4:
+        print("Usage: {} hexlified_key input.pcap output.pcap".format(argv[0]),
+              file=sys.stderr)
+        return 2
+    key = unhexlify(argv[1])
+    assert len(key) == 32, "hexlified encoded key of 32 bytes"
+    # the memo of the anonymizer stands for the prefix cache, which would
+    # disable the C accelerator
+    anonymizer = PcapAnonymizer(CryptoPAn(key))
+    stime = time.time()
+    anonymizer.rewrite_file(argv[2], argv[3])
+    dtime = time.time() - stime
+    print("{} packets, {} bytes in {:.3f} s, {:.2f} MB/s".format(
+        anonymizer.packets, anonymizer.bytes, dtime,
+        anonymizer.bytes / dtime / 1e6 if dtime else 0.0), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+An asyncio anonymization service sharing one CryptoPAn instance, and
+its prefix cache, among many clients.
+
+The protocol is line based: a client sends one IP address per line and
+gets the anonymized address back on a line, in the request order.  An
+address which cannot be parsed is answered with "!invalid", and a
+request the service failed to anonymize with "!error".  Requests
+from all the connections are collected into micro batches, which are
+anonymized with CryptoPAn.anonymize_many() in an executor so that the
+event loop never waits for AES.
+
+Usage: anonymization_service.py hexlified_key [--port PORT | --unix PATH]
+"""
+
+import argparse
+import asyncio
+import sys
+from binascii import unhexlify
+from concurrent.futures import ThreadPoolExecutor
+from yacryptopan import AddressValueError, CryptoPAn
+try:
+    import _yacryptopan
+except ImportError:
+    # the optional C accelerator of yacryptopan is not built
+    _yacryptopan = None
+
+INVALID = '!invalid'
+ERROR = '!error'
+
+
+def _anonymize_batch(cp, addrs):
+    try:
+        return cp.anonymize_many(addrs, fast=True)
+    except AddressValueError:
+        result = []
+        for addr in addrs:
+            try:
+                result.append(cp.anonymize(addr, fast=True))
+            except AddressValueError:
+                result.append(INVALID)
+        return result
+
+
+class AnonymizationService(object):
+    """Serve a CryptoPAn instance, batching the concurrent requests."""
+
+    def __init__(self, cp, max_delay=0.002, max_batch=1000):
+        """
+        Args:
+            cp: the CryptoPAn instance to serve.
+            max_delay: the longest time in seconds a request waits for
+                more requests to join its batch.
+            max_batch: the largest number of addresses in a batch.
+        """
+        self._cp = cp
+        self._max_delay = max_delay
+        self._max_batch = max_batch
+        self._queue = None
+        # a single worker, as a CryptoPAn instance is not thread-safe
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.requests = 0
+        self.batches = 0
+
+    async def anonymize(self, addr):
+        """Anonymize an address string as a part of the next batch."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((addr, future))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_delay
+            while len(batch) < self._max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            addrs = [addr for (addr, _) in batch]
+            try:
+                result = await loop.run_in_executor(
+                    self._executor, _anonymize_batch, self._cp, addrs)
+            except Exception as e:
+                for (_, future) in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.requests += len(batch)
+            self.batches += 1
+            for ((_, future), aaddr) in zip(batch, result):
+                if not future.done():
+                    future.set_result(aaddr)
+
+    async def _handle_client(self, reader, writer):
+        pending = asyncio.Queue()
+
+        async def respond():
+            while True:
+                future = await pending.get()
+                if future is None:
+                    break
+                try:
+                    aaddr = await future
+                except Exception:
+                    # answer the request anyway to keep the responses in
+                    # the request order
+                    aaddr = ERROR
+                writer.write(aaddr.encode('ascii') + b'\n')
+                if pending.empty():
+                    await writer.drain()
+
+        responder = asyncio.ensure_future(respond())
+        try:
+            async for line in reader:
+                addr = line.strip().decode('ascii', 'replace')
+                await pending.put(asyncio.ensure_future(self.anonymize(addr)))
+        finally:
+            await pending.put(None)
+            await responder
+            writer.close()
+
+    async def start(self, port=None, path=None, host='127.0.0.1'):
+        """Starts listening on a localhost TCP port or a Unix socket.
+
+        Returns:
+            The asyncio server object.
+        """
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        if path is not None:
+            return await asyncio.start_unix_server(self._handle_client, path)
+        return await asyncio.start_server(self._handle_client, host, port)
+
+    async def close(self):
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
+
+
+class AnonymizationClient(object):
+    """A pipelining client of AnonymizationService."""
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._waiting = asyncio.Queue()
+        # the ConnectionError raised once the receiver has stopped
+        self._error = None
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    @classmethod
+    async def connect(cls, port=None, path=None, host='127.0.0.1'):
+        if path is not None:
+            (reader, writer) = await asyncio.open_unix_connection(path)
+        else:
+            (reader, writer) = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _receive(self):
+        try:
+            async for line in self._reader:
+                future = await self._waiting.get()
+                if not future.cancelled():
+                    future.set_result(line.strip().decode('ascii'))
+            self._error = ConnectionError('the service closed the connection')
+        except Exception as e:
+            self._error = ConnectionError('the connection failed: {}'.format(e))
+        finally:
+            if self._error is None:
+                # cancelled by close()
+                self._error = ConnectionError('the client is closed')
+            # no response will come for the pending requests
+            while not self._waiting.empty():
+                future = self._waiting.get_nowait()
+                if not future.done():
+                    future.set_exception(self._error)
+
+    async def anonymize(self, addr):
+        """Returns the anonymized address string, or raises
+        AddressValueError if the service could not parse it (or it is
+        not a single ASCII line), RuntimeError if the service failed to
+        anonymize it, or ConnectionError if the connection is closed or
+        failed."""
+        if self._error is not None:
+            raise self._error
+        # checked before the request is queued, as every queued request
+        # must be sent as exactly one line
+        try:
+            line = addr.encode('ascii') + b'\n'
+        except UnicodeEncodeError:
+            raise AddressValueError
+        if b'\n' in line[:-1] or b'\r' in line:
+            raise AddressValueError
+        future = asyncio.get_running_loop().create_future()
+        await self._waiting.put(future)
+        self._writer.write(line)
+        result = await future
+        if result == INVALID:
+            raise AddressValueError
+        if result == ERROR:
+            raise RuntimeError('the service failed to anonymize ' + addr)
+        return result
+
+    async def close(self):
+        self._writer.close()
+        self._receiver.cancel()
+        try:
+            await self._receiver
+        except asyncio.CancelledError:
+            pass
+
+
+async def serve(key, args):
+    service = AnonymizationService(CryptoPAn(key, cache_size=args.cache_size or None),
+                                   max_delay=args.max_delay,
+                                   max_batch=args.max_batch)
+    server = await service.start(port=args.port, path=args.unix)
+    print("listening on {}".format(args.unix or args.port), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('key', help='the 32 bytes key as 64 hex digits')
+    parser.add_argument('--port', type=int, default=8653)
+    parser.add_argument('--unix', help='listen on this Unix socket path')
+    parser.add_argument('--max-delay', type=float, default=0.002)
+    parser.add_argument('--max-batch', type=int, default=1000)
+    # an instance with a prefix cache does not use the C accelerator,
+    # which is faster than the cache
+    default_cache_size = 0 if _yacryptopan is not None else 1000000
+    parser.add_argument('--cache-size', type=int, default=default_cache_size,
+                        help='the size of the prefix cache, 0 for none; it '
+                             'disables the C accelerator (default: %d)'
+                             % default_cache_size)
+    args = parser.parse_args()
+    key = unhexlify(args.key)
+    assert len(key) == 32, "hexlified encoded key of 32 bytes"
+    try:
+        asyncio.run(serve(key, args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for anonymization_service.py.
+
+Opens a number of concurrent connections, each sending random IPv4
+addresses one at a time, and reports the request rate and the p50/p99
+latencies.
+
+Usage: loadgen.py [--port PORT | --unix PATH] [--clients N] [--requests N]
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from anonymization_service import AnonymizationClient
+
+
+async def client_run(args, latencies):
+    client = await AnonymizationClient.connect(port=args.port, path=args.unix)
+    for _ in range(args.requests):
+        addr = '10.%d.%d.%d' % tuple(random.randint(0, 255) for _ in range(3))
+        stime = time.perf_counter()
+        await client.anonymize(addr)
+        latencies.append(time.perf_counter() - stime)
+    await client.close()
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def run(args):
+    latencies = []
+    stime = time.perf_counter()
+    await asyncio.gather(*[client_run(args, latencies) for _ in range(args.clients)])
+    dtime = time.perf_counter() - stime
+    latencies.sort()
+    print("%d requests in %.3f s: %.1f requests/sec, p50 %.3f ms, p99 %.3f ms"
+          % (len(latencies), dtime, len(latencies) / dtime,
+             percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for anonymization_service.py.")
+    parser.add_argument('--port', type=int, default=8653)
+    parser.add_argument('--unix', help='connect to this Unix socket path')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=1000)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,7 @@
 #!/usr/bin/env python
 
-from __future__ import print_function
-
-from setuptools import setup
-import sys
-
+from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
 try:
     from pypandoc import convert
     read_md = lambda f: convert(f, 'rst')
@@ -12,9 +9,20 @@ except ImportError:
     print('pandoc is not installed.')
     read_md = lambda f: open(f, 'r').read()
 
-install_requires = ['pycryptodome>=3.4']
-if sys.version_info < (3, 3):
-    install_requires.extend(['netaddr>=0.7.15'])
+class optional_build_ext(build_ext):
+    """Builds the C accelerator if possible.  yacryptopan falls back to
+    the pure Python code without it."""
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            print('the C accelerator is not built: %s' % e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            print('the C accelerator is not built: %s' % e)
 
 setup(name='yacryptopan',
       version='1.0.1',
@@ -23,7 +31,13 @@ setup(name='yacryptopan',
       author='Keiichi SHIMA',
       author_email='keiichi@iijlab.net',
       py_modules=['yacryptopan'],
-      install_requires=install_requires,
+      ext_modules=[Extension('_yacryptopan', ['_yacryptopan.c'],
+                             libraries=['crypto'])],
+      cmdclass={'build_ext': optional_build_ext},
+      python_requires='>=3.8',
+      install_requires=['pycryptodome>=3.4'],
+      extras_require={'numpy': ['numpy'], 'cryptography': ['cryptography']},
+      entry_points={'console_scripts': ['yacryptopan = yacryptopan:main']},
       classifiers=[
           'Development Status :: 4 - Beta',
           'Environment :: Console',
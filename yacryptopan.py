@@ -22,105 +22,1049 @@ License: BSD
 
 """
 
-from __future__ import print_function
-
-import logging
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
 
 from array import array
-from Crypto.Cipher import AES
-from functools import reduce
+from collections import deque, namedtuple, OrderedDict
 import sys
-if sys.version_info < (3, 3):
-    import netaddr
-else:
+try:
+    # the functions of the socket module without importing the module,
+    # which pulls in selectors and enum
+    from _socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+except ImportError:
+    from socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+try:
+    import _yacryptopan
+except ImportError:
+    # the optional C accelerator is not built
+    _yacryptopan = None
+
+# The modules which are slow to import (the address parser, hashlib,
+# logging and re) are imported at their first use, so that short-lived
+# jobs using only a part of this module do not pay for the rest.
+ipaddress = None
+
+def _import_parser():
+    """Imports the address parser module.
+    """
+    global ipaddress
     import ipaddress
 
-_logger = logging.getLogger(__name__)
+# The bit masks to take the padding bits after a prefix of each length.
+# _MASKS[0] has all the 128 bits set, and _MASKS[127] only the last one.
+_MASKS = [((1 << 128) - 1) >> l for l in range(128)]
 
 class AddressValueError(ValueError):
-    """Exception class raised when the IP address parser (the netaddr
-    module in Python < 3.3 or ipaddress module) failed.
+    """Exception class raised when the IP address parser (the
+    ipaddress module) failed.
+
+    """
+    pass
+
+class KeyFingerprintError(ValueError):
+    """Exception class raised when a precomputed file was created with
+    a key different from the key of the CryptoPAn instance.
 
     """
     pass
 
+class PolicyCollisionError(ValueError):
+    """Exception class raised when an AddressPolicy anonymizes an
+    address into one of its ranges.  Another key avoids it.
+
+    """
+    pass
+
+def _key_fingerprint(key):
+    """Returns a digest identifying the key without revealing it.
+    """
+    import hashlib
+    return hashlib.sha256(b'yacryptopan key fingerprint' + key).digest()
+
+# The precomputed prefix table file starts with this header (magic,
+# format version, table depth, key fingerprint), followed by one big
+# endian entry for each prefix of depth bits.  An entry holds the depth
+# flip bits of the prefix, the first flip bit being the most significant.
+_TABLE_MAGIC = b'YACPTABL'
+_TABLE_VERSION = 1
+_TABLE_HEADER = struct.Struct('>8sBB6x32s')
+_TABLE_TYPECODES = {1: 'B', 2: 'H', 4: 'I'}
+# save_table() computes and writes the table in subtrees of this depth
+_TABLE_CHUNK_BITS = 16
+
+# The address cache snapshot file starts with this header (magic, format
+# version, flags, number of IPv4 and IPv6 entries, key fingerprint),
+# followed by the IPv4 and then the IPv6 entries.  An entry is a pair of big endian
+# (address, anonymized address) of 4 or 16 bytes each.  The entries of a
+# version are written from the least recently used one.
+_SNAPSHOT_MAGIC = b'YACPADDR'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('>8sBB2xII32s')
+# the snapshot flag of an instance created with embedded_ipv4=True
+_SNAPSHOT_EMBEDDED_IPV4 = 1
+
+# The IPv6 ranges embedding an IPv4 address right after their prefix, as
+# (network value, prefix length): IPv4-mapped (::ffff:0:0/96), NAT64
+# (64:ff9b::/96) and 6to4 (2002::/16) addresses.
+_EMBEDDED_IPV4 = (
+    (0xffff << 32, 96),
+    (0x64ff9b << 96, 96),
+    (0x2002 << 112, 16),
+)
+
+def _table_width(depth):
+    """Returns the size in bytes of one table entry of the depth.
+    """
+    if depth <= 8:
+        return 1
+    if depth <= 16:
+        return 2
+    return 4
+
+class _PythonAES(object):
+    """A pure Python AES-128-ECB cipher.
+
+    This is the slow reference backend, which needs no other library.
+    """
+    _tables = None
+
+    @classmethod
+    def _gen_tables(cls):
+        """Generates the S-box and the four round tables.
+        """
+        rotl8 = lambda x, n: ((x << n) | (x >> (8 - n))) & 0xff
+        sbox = [0] * 256
+        p = q = 1
+        while True:
+            # p runs over GF(2^8) multiplied by 3, q over its inverse
+            p = (p ^ (p << 1) ^ (0x1b if p & 0x80 else 0)) & 0xff
+            q ^= q << 1
+            q ^= q << 2
+            q ^= q << 4
+            q &= 0xff
+            if q & 0x80:
+                q ^= 0x09
+            sbox[p] = (q ^ rotl8(q, 1) ^ rotl8(q, 2) ^ rotl8(q, 3)
+                       ^ rotl8(q, 4) ^ 0x63)
+            if p == 1:
+                break
+        sbox[0] = 0x63
+        t0 = []
+        for x in sbox:
+            x2 = ((x << 1) ^ (0x1b if x & 0x80 else 0)) & 0xff
+            t0.append((x2 << 24) | (x << 16) | (x << 8) | (x2 ^ x))
+        rotr = lambda t, n: [((w >> n) | (w << (32 - n))) & 0xffffffff
+                             for w in t]
+        cls._tables = (sbox, t0, rotr(t0, 8), rotr(t0, 16), rotr(t0, 24))
+
+    def __init__(self, key):
+        assert(len(key) == 16)
+        if _PythonAES._tables is None:
+            _PythonAES._gen_tables()
+        sbox = self._tables[0]
+        w = list(struct.unpack('>4I', key))
+        rcon = 1
+        for i in range(4, 44):
+            t = w[i - 1]
+            if i % 4 == 0:
+                t = ((sbox[(t >> 16) & 0xff] << 24) | (sbox[(t >> 8) & 0xff] << 16)
+                     | (sbox[t & 0xff] << 8) | sbox[t >> 24]) ^ (rcon << 24)
+                rcon = ((rcon << 1) ^ (0x1b if rcon & 0x80 else 0)) & 0xff
+            w.append(w[i - 4] ^ t)
+        self._round_keys = [w[i:i + 4] for i in range(0, 44, 4)]
+
+    def encrypt(self, data):
+        (sbox, t0, t1, t2, t3) = self._tables
+        round_keys = self._round_keys
+        words = struct.unpack('>%dI' % (len(data) // 4), data)
+        result = []
+        for i in range(0, len(words), 4):
+            k = round_keys[0]
+            s0 = words[i] ^ k[0]
+            s1 = words[i + 1] ^ k[1]
+            s2 = words[i + 2] ^ k[2]
+            s3 = words[i + 3] ^ k[3]
+            for k in round_keys[1:10]:
+                (s0, s1, s2, s3) = (
+                    t0[s0 >> 24] ^ t1[(s1 >> 16) & 0xff] ^ t2[(s2 >> 8) & 0xff] ^ t3[s3 & 0xff] ^ k[0],
+                    t0[s1 >> 24] ^ t1[(s2 >> 16) & 0xff] ^ t2[(s3 >> 8) & 0xff] ^ t3[s0 & 0xff] ^ k[1],
+                    t0[s2 >> 24] ^ t1[(s3 >> 16) & 0xff] ^ t2[(s0 >> 8) & 0xff] ^ t3[s1 & 0xff] ^ k[2],
+                    t0[s3 >> 24] ^ t1[(s0 >> 16) & 0xff] ^ t2[(s1 >> 8) & 0xff] ^ t3[s2 & 0xff] ^ k[3])
+            k = round_keys[10]
+            for (a, b, c, d, kw) in ((s0, s1, s2, s3, k[0]), (s1, s2, s3, s0, k[1]),
+                                     (s2, s3, s0, s1, k[2]), (s3, s0, s1, s2, k[3])):
+                result.append(((sbox[a >> 24] << 24) | (sbox[(b >> 16) & 0xff] << 16)
+                               | (sbox[(c >> 8) & 0xff] << 8) | sbox[d & 0xff]) ^ kw)
+        return struct.pack('>%dI' % len(result), *result)
+
+class _CryptographyAES(object):
+    """An AES-128-ECB cipher of the cryptography package (OpenSSL).
+    """
+    def __init__(self, key):
+        from cryptography.hazmat.primitives.ciphers import (Cipher,
+                                                            algorithms, modes)
+        # ECB keeps no state between blocks, so the encryptor is never
+        # finalized and serves all the calls.
+        self.encrypt = Cipher(algorithms.AES(key), modes.ECB()).encryptor().update
+
+def _new_pycryptodome_aes(key):
+    """Returns an AES-128-ECB cipher of PyCryptodome.
+    """
+    from Crypto.Cipher import AES
+    return AES.new(key, AES.MODE_ECB)
+
+# The AES-ECB backends: name -> function returning a cipher object with
+# an encrypt(data) method for a 16 bytes key.
+_BACKENDS = OrderedDict([
+    ('pycryptodome', _new_pycryptodome_aes),
+    ('cryptography', _CryptographyAES),
+    ('python', _PythonAES),
+])
+
+def available_backends():
+    """Returns the names of the AES backends which can be used here.
+    """
+    names = []
+    for (name, new_cipher) in _BACKENDS.items():
+        # the python backend needs no library, and its tables are only
+        # built for an instance using it
+        if name != 'python':
+            try:
+                new_cipher(b'\0' * 16)
+            except ImportError:
+                continue
+        names.append(name)
+    return names
+
+_default_backend = None
+_fastest_backend = None
+
+def _select_backend(fastest=False):
+    """Returns the name of the AES backend used when none is given: the
+    first one of _BACKENDS which can be imported.
+
+    With fastest=True, the available backends are timed instead, once
+    per process, with the typical call of encrypting the 32 prefixes of
+    an IPv4 address, and the fastest one is returned.
+    """
+    global _default_backend, _fastest_backend
+    if not fastest:
+        if _default_backend is None:
+            for (name, new_cipher) in _BACKENDS.items():
+                try:
+                    if name != 'python':
+                        new_cipher(b'\0' * 16)
+                except ImportError:
+                    continue
+                _default_backend = name
+                break
+        return _default_backend
+    if _fastest_backend is None:
+        data = b'\0' * 16 * 32
+        timing = []
+        for name in available_backends():
+            if name == 'python' and timing:
+                continue
+            cipher = _BACKENDS[name](b'\0' * 16)
+            stime = time.perf_counter()
+            for _ in range(100):
+                cipher.encrypt(data)
+            timing.append((time.perf_counter() - stime, name))
+        _fastest_backend = min(timing)[1]
+        import logging
+        logging.getLogger(__name__).debug('selected the %s AES backend',
+                                          _fastest_backend)
+    return _fastest_backend
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+Stats = namedtuple('Stats', ['ipv4_addresses', 'ipv6_addresses',
+                             'aes_calls', 'aes_blocks',
+                             'cache_hits', 'cache_misses',
+                             'address_cache_hits', 'address_cache_misses',
+                             'parse_time', 'core_time', 'format_time',
+                             'ipv4_deanonymized', 'ipv6_deanonymized',
+                             'deanonymize_time'])
+
+# Maps the first byte of an encrypted block to the ASCII digit of its
+# most significant bit, the flip bit, so that the flip bits of many
+# blocks can be converted to an int by int(..., 2) in one go.
+_FLIP_DIGITS = bytes(0x30 + (i >> 7) for i in range(256))
+
+# The prefix cache keeps the prefixes whose length is a multiple of this.
+_CACHE_STRIDE = 8
+
+# anonymize_range_bin() processes the subtrees of 2**_RANGE_CHUNK_BITS
+# addresses at the bottom of the prefix tree level by level.
+_RANGE_CHUNK_BITS = 12
+
+class _PrefixCache(object):
+    """A size-bounded LRU map from an address prefix to its flip bits.
+
+    A prefix of pos bits taken from the 128 bits extended address is
+    stored as the int value ((1 << pos) | prefix), mapped to the pos
+    flip bits of the prefix.  The leading 1 bit keeps prefixes of
+    different lengths apart, so one flat dict can hold the whole prefix
+    tree.  Only every _CACHE_STRIDE bits long prefix is stored, so an
+    address needs a few lookups only.  Each entry costs roughly 100
+    bytes.
+
+    The prefixes of anonymized addresses, used by deanonymization, are
+    stored negated, mapped to the flip bits of the original prefix.
+    """
+    def __init__(self, maxsize):
+        assert(maxsize > 0)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._nodes = OrderedDict()
+
+    def lookup(self, ext_addr, start, pos_max, reverse=False):
+        """Finds the longest cached prefix of the address which is longer
+        than start bits and shorter than pos_max bits.
+
+        Args:
+            reverse: True if ext_addr is an anonymized address.
+
+        Returns:
+            A (pos, flip_bits) tuple of the prefix, or (start, None) if
+            none is cached.
+        """
+        nodes = self._nodes
+        sign = -1 if reverse else 1
+        for pos in range((pos_max - 1) // _CACHE_STRIDE * _CACHE_STRIDE,
+                         start, -_CACHE_STRIDE):
+            node = sign * ((ext_addr >> (128 - pos)) | (1 << pos))
+            flip_bits = nodes.get(node)
+            if flip_bits is not None:
+                self.hits += 1
+                nodes.move_to_end(node)
+                return (pos, flip_bits)
+        self.misses += 1
+        return (start, None)
+
+    def store(self, ext_addr, start, pos_max, flip_bits, reverse=False):
+        """Stores the prefixes of the address longer than start bits,
+        evicting the least recently used ones when the cache is full.
+
+        Args:
+            flip_bits: the pos_max flip bits of the address.
+            reverse: True if ext_addr is an anonymized address.
+        """
+        nodes = self._nodes
+        sign = -1 if reverse else 1
+        for pos in range((start // _CACHE_STRIDE + 1) * _CACHE_STRIDE,
+                         pos_max, _CACHE_STRIDE):
+            nodes[sign * ((ext_addr >> (128 - pos)) | (1 << pos))] = flip_bits >> (pos_max - pos)
+        while len(nodes) > self.maxsize:
+            nodes.popitem(last=False)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._nodes))
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self._nodes.clear()
+
+class _LockedPrefixCache(_PrefixCache):
+    """A _PrefixCache which can be shared by threads.
+    """
+    def __init__(self, maxsize):
+        super(_LockedPrefixCache, self).__init__(maxsize)
+        self._lock = threading.Lock()
+
+    def lookup(self, ext_addr, start, pos_max, reverse=False):
+        with self._lock:
+            return super(_LockedPrefixCache, self).lookup(ext_addr, start,
+                                                          pos_max, reverse)
+
+    def store(self, ext_addr, start, pos_max, flip_bits, reverse=False):
+        with self._lock:
+            super(_LockedPrefixCache, self).store(ext_addr, start, pos_max,
+                                                  flip_bits, reverse)
+
+    def info(self):
+        with self._lock:
+            return super(_LockedPrefixCache, self).info()
+
+    def clear(self):
+        with self._lock:
+            super(_LockedPrefixCache, self).clear()
+
+class _AddressCache(object):
+    """A size-bounded LRU map from an address to its anonymized address.
+
+    An address is stored as a (version, value) tuple.  Each entry costs
+    roughly 150 bytes.
+    """
+    def __init__(self, maxsize):
+        assert(maxsize > 0)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, version, addr):
+        """Returns the anonymized address, or None if it is not cached.
+        """
+        aaddr = self._entries.get((version, addr))
+        if aaddr is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end((version, addr))
+        return aaddr
+
+    def put(self, version, addr, aaddr):
+        """Stores the anonymized address, evicting the least recently
+        used one when the cache is full.
+        """
+        entries = self._entries
+        entries[(version, addr)] = aaddr
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+    def items(self):
+        """Returns a list of ((version, addr), aaddr) from the least
+        recently used one.
+        """
+        return list(self._entries.items())
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._entries))
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries.clear()
+
+class _LockedAddressCache(_AddressCache):
+    """An _AddressCache which can be shared by threads.
+    """
+    def __init__(self, maxsize):
+        super(_LockedAddressCache, self).__init__(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, version, addr):
+        with self._lock:
+            return super(_LockedAddressCache, self).get(version, addr)
+
+    def put(self, version, addr, aaddr):
+        with self._lock:
+            super(_LockedAddressCache, self).put(version, addr, aaddr)
+
+    def items(self):
+        with self._lock:
+            return super(_LockedAddressCache, self).items()
+
+    def info(self):
+        with self._lock:
+            return super(_LockedAddressCache, self).info()
+
+    def clear(self):
+        with self._lock:
+            super(_LockedAddressCache, self).clear()
+
+class _Stats(object):
+    """The counters of an instrumented CryptoPAn instance.
+    """
+    def __init__(self, hook=None, thread_safe=False):
+        self._hook = hook
+        self._lock = threading.Lock() if thread_safe else None
+        self.clear()
+
+    def clear(self):
+        # the dicts are updated in place, the wrappers refer to them
+        self.addresses = getattr(self, 'addresses', {})
+        self.addresses.update({4: 0, 6: 0})
+        self.deanonymized = getattr(self, 'deanonymized', {})
+        self.deanonymized.update({4: 0, 6: 0})
+        self.times = getattr(self, 'times', {})
+        self.times.update({'parse': 0.0, 'core': 0.0, 'format': 0.0,
+                           'deanonymize': 0.0})
+        self.aes_calls = 0
+        self.aes_blocks = 0
+
+    def add_aes(self, calls, blocks):
+        if self._lock is not None:
+            with self._lock:
+                self.aes_calls += calls
+                self.aes_blocks += blocks
+        else:
+            self.aes_calls += calls
+            self.aes_blocks += blocks
+
+    def record(self, stage, version, count, seconds):
+        """Records count addresses of the version which went through the
+        stage ('parse', 'core', 'format' or 'deanonymize') in seconds,
+        and calls the hook.  The addresses are counted at the core and
+        deanonymize stages.
+        """
+        if self._lock is not None:
+            with self._lock:
+                self._record(stage, version, count, seconds)
+        else:
+            self._record(stage, version, count, seconds)
+        if self._hook is not None:
+            self._hook(stage, version, count, seconds)
+
+    def _record(self, stage, version, count, seconds):
+        if stage == 'core':
+            self.addresses[version] += count
+        elif stage == 'deanonymize':
+            self.deanonymized[version] += count
+        self.times[stage] += seconds
+
+    def timed(self, stage, func, measure):
+        """Returns a wrapper of func recording the stage.  measure(result,
+        *args, **kwargs) returns the (version, count) of a call.
+        """
+        perf_counter = time.perf_counter
+        if self._lock is not None or self._hook is not None:
+            def wrapper(*args, **kwargs):
+                stime = perf_counter()
+                result = func(*args, **kwargs)
+                seconds = perf_counter() - stime
+                (version, count) = measure(result, *args, **kwargs)
+                self.record(stage, version, count, seconds)
+                return result
+            return wrapper
+        # the common case, inlined
+        times = self.times
+        counts = {'core': self.addresses,
+                  'deanonymize': self.deanonymized}.get(stage)
+        def wrapper(*args, **kwargs):
+            stime = perf_counter()
+            result = func(*args, **kwargs)
+            times[stage] += perf_counter() - stime
+            if counts is not None:
+                (version, count) = measure(result, *args, **kwargs)
+                counts[version] += count
+            return result
+        return wrapper
+
+    def timed_iter(self, stage, func, version_of):
+        """Returns a wrapper of func, which returns an iterator of
+        addresses, recording the stage for all the addresses iterated
+        when the iteration ends.  version_of(*args, **kwargs) returns
+        the version of a call.
+        """
+        perf_counter = time.perf_counter
+        def iterate(version, items):
+            count = 0
+            seconds = 0.0
+            try:
+                while True:
+                    stime = perf_counter()
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        seconds += perf_counter() - stime
+                        return
+                    seconds += perf_counter() - stime
+                    count += 1
+                    yield item
+            finally:
+                self.record(stage, version, count, seconds)
+        def wrapper(*args, **kwargs):
+            # the function is called now for its argument checks
+            return iterate(version_of(*args, **kwargs),
+                           iter(func(*args, **kwargs)))
+        return wrapper
+
+class _CountingCipher(object):
+    """An AES cipher counting the calls and the blocks encrypted.
+    """
+    def __init__(self, cipher, stats):
+        self._cipher = cipher
+        self._stats = stats
+
+    def encrypt(self, data):
+        self._stats.add_aes(1, len(data) // 16)
+        return self._cipher.encrypt(data)
+
+class _CountingCore(object):
+    """A C accelerator counting the AES calls and blocks it makes.
+    """
+    def __init__(self, core, stats):
+        self._core = core
+        self._stats = stats
+
+    def anonymize_buffer(self, buf, width):
+        # one AES call of width * 8 blocks per address
+        count = len(buf) // width
+        self._stats.add_aes(count, count * width * 8)
+        return self._core.anonymize_buffer(buf, width)
+
+    def deanonymize_buffer(self, buf, width):
+        # one AES call of one block per bit
+        blocks = len(buf) // width * width * 8
+        self._stats.add_aes(blocks, blocks)
+        return self._core.deanonymize_buffer(buf, width)
+
+class _ThreadLocalCipher(object):
+    """An AES-ECB cipher which creates a cipher object per thread.
+    """
+    def __init__(self, new_cipher, key):
+        self._new_cipher = new_cipher
+        self._key = key
+        self._local = threading.local()
+
+    def encrypt(self, data):
+        cipher = getattr(self._local, 'cipher', None)
+        if cipher is None:
+            cipher = self._local.cipher = self._new_cipher(self._key)
+        return cipher.encrypt(data)
+
+# The instances returned by CryptoPAn.shared(), by (class, key
+# fingerprint, options).
+_shared_instances = {}
+_shared_lock = threading.Lock()
+
 class CryptoPAn(object):
     """Anonymize IP addresses keepting prefix consitency.
+
+    An instance must not be used by several threads at once unless it
+    is created with thread_safe=True.
+
+    When the optional C accelerator (the _yacryptopan extension module)
+    is built, instances without a prefix cache or a prefix table use it
+    for the integer, packed and NumPy functions.  It is faster than the
+    cache and the table of the pure Python code.
     """
-    def __init__(self, key):
+    def __init__(self, key, cache_size=None, table=None, thread_safe=False,
+                 backend=None, address_cache_size=None, instrument=False,
+                 stats_hook=None, embedded_ipv4=False):
         """Initialize a CryptoPAn() instance.
 
         Args:
             key: a 32 bytes object used for AES key and padding when
                  performing a block cipher operation. The first 16 bytes
                  are used for the AES key, and the latter for padding.
+            cache_size: the maximum number of prefixes whose flip bits
+                 are kept in memory (roughly 100 bytes each).  Addresses
+                 sharing a prefix reuse the cached AES results of that
+                 prefix.  None (default) disables the cache.
+            table: the path of a prefix table file made by save_table()
+                 with the same key.  The file is mmap'ed read-only, so
+                 processes loading the same table share its memory.
+                 The flip bits of the prefixes deeper than the table are
+                 computed (and cached if cache_size is given) as usual.
+                 The first deanonymization builds an inverse of the
+                 table, as large as the table, in memory.
+            thread_safe: if True, the instance can be shared by threads.
+                 Each thread gets its own AES cipher object and the
+                 prefix cache is guarded by a lock.  The AES library
+                 releases the GIL while encrypting, so threads calling
+                 the batch functions (e.g. anonymize_many()) with large
+                 enough batches run the AES work in parallel.
+            backend: the AES implementation, one of 'pycryptodome',
+                 'cryptography' (OpenSSL) and 'python' (a slow pure
+                 Python reference).  All of them give the same results.
+                 None (default) uses the C accelerator when possible,
+                 and otherwise the first installed one of pycryptodome,
+                 cryptography and python, importing only that library.
+                 'fastest' times the installed backends once per process
+                 and uses the fastest one.
+            address_cache_size: the maximum number of addresses whose
+                 anonymized addresses are kept in memory (roughly 150
+                 bytes each), so that a repeated address costs no AES
+                 operation.  It can be saved and reloaded with
+                 save_address_cache() and load_address_cache().  None
+                 (default) disables the cache.
+            instrument: if True, count the addresses, the AES calls and
+                 the time spent parsing, anonymizing and formatting, to
+                 be read by stats().  The counting functions are only
+                 installed on instrumented instances, so the others pay
+                 nothing for it.
+            stats_hook: a function called as stats_hook(stage, version,
+                 count, seconds) after each parse, core (anonymize_bin()
+                 and the like), format or deanonymize step, e.g. to feed
+                 a metrics library.  It implies instrument=True.
+            embedded_ipv4: if True, the IPv4 address embedded in an
+                 IPv4-mapped (::ffff:0:0/96), NAT64 (64:ff9b::/96) or
+                 6to4 (2002::/16) IPv6 address is anonymized as the IPv4
+                 address itself, so that it matches the anonymized IPv4
+                 form, and with 32 AES rounds instead of 128.  The
+                 prefix of the range is anonymized as usual (once per
+                 instance), and the subnet and interface bits after a
+                 6to4 address are anonymized with their usual flip bits.
 
         Changelog: A bytes object (not string) is required for python3.
         """
         assert(len(key) == 32)
-        if sys.version_info.major < 3:
-            assert type(key) is str
-        else:
-            assert type(key) is bytes
-        self._cipher = AES.new(key[:16], AES.MODE_ECB)
-        self._padding = array('B')
-        if sys.version_info.major == 2:
-            # for Python2
-            self._padding.fromstring(self._cipher.encrypt(key[16:]))
+        assert type(key) is bytes
+        use_core = (_yacryptopan is not None and backend is None
+                    and cache_size is None and table is None)
+        if use_core:
+            # the C accelerator also serves as the AES cipher, so no AES
+            # backend is imported (or measured) for this instance.  It
+            # is created again with the padding below.
+            self._cipher = _yacryptopan.Core(key[:16], bytes(16))
         else:
-            # for Python3 (and later?)
-            self._padding.frombytes(self._cipher.encrypt(key[16:]))
-        self._padding_int = self._to_int(self._padding)
-        self._gen_masks()
+            if backend is None or backend == 'fastest':
+                new_cipher = _BACKENDS[_select_backend(backend == 'fastest')]
+            elif backend in _BACKENDS:
+                new_cipher = _BACKENDS[backend]
+            else:
+                raise ValueError('unknown AES backend %r' % (backend,))
+            if thread_safe:
+                self._cipher = _ThreadLocalCipher(new_cipher, key[:16])
+            else:
+                self._cipher = new_cipher(key[:16])
+        self._padding_int = int.from_bytes(self._cipher.encrypt(key[16:]),
+                                           'big')
+        self._masks = _MASKS
+        # the padding bits appended to a prefix of each length
+        self._paddings = [self._padding_int & mask for mask in self._masks]
+        self._fingerprint = _key_fingerprint(key)
+        self._cache = None
+        if cache_size is not None:
+            if thread_safe:
+                self._cache = _LockedPrefixCache(cache_size)
+            else:
+                self._cache = _PrefixCache(cache_size)
+        self._address_cache = None
+        if address_cache_size is not None:
+            if thread_safe:
+                self._address_cache = _LockedAddressCache(address_cache_size)
+            else:
+                self._address_cache = _AddressCache(address_cache_size)
+        # the anonymized network of each embedded IPv4 range, computed
+        # at its first use
+        self._embedded_prefixes = {} if embedded_ipv4 else None
+        self._table = None
+        self._table_inv = None
+        self._table_depth = 0
+        if table is not None:
+            self._load_table(table)
+        self._core = None
+        if use_core:
+            self._core = _yacryptopan.Core(key[:16],
+                                           self._padding_int.to_bytes(16, 'big'))
+            self._cipher = self._core
+        self._stats = None
+        if instrument or stats_hook is not None:
+            self._instrument(_Stats(stats_hook, thread_safe))
+
+    @classmethod
+    def shared(cls, key, **options):
+        """Returns an instance for the key and the options which is
+        shared in the process, creating it at the first call.
+
+        Short-lived jobs creating an instance per file or per request
+        can call this instead of CryptoPAn(key, ...) to skip the
+        construction and to share the caches.  The instances are kept
+        by a fingerprint of the key, not by the key itself.  A shared
+        instance used by several threads must be created with
+        thread_safe=True.
+
+        Args:
+            key: the 32 bytes key, as for CryptoPAn().
+            options: the other arguments of CryptoPAn().
 
-    def _gen_masks(self):
-        """Generates an array of bit masks to calculate n-bits padding data.
+        Returns:
+            The shared instance.
         """
-        mask128 = reduce (lambda x, y: (x << 1) | y, [1] * 128)
-        self._masks = [0] * 128
-        for l in range(128):
-            # self._masks[0]   <- 128bits all 1
-            # self._masks[127] <- 1
-            self._masks[l] = mask128 >> l
+        registry_key = (cls, _key_fingerprint(key),
+                        tuple(sorted(options.items())))
+        with _shared_lock:
+            cp = _shared_instances.get(registry_key)
+            if cp is None:
+                cp = _shared_instances[registry_key] = cls(key, **options)
+        return cp
 
-    def _to_array(self, int_value, int_value_len):
-        """Convert an int value to a byte array.
+    def _instrument(self, stats):
+        """Installs the counting and timing wrappers on the instance.
         """
-        byte_array = array('B')
-        for i in range(int_value_len):
-            byte_array.insert(0, (int_value >> (i * 8)) & 0xff)
-        return byte_array
+        self._stats = stats
+        self._cipher = _CountingCipher(self._cipher, stats)
+        if self._core is not None:
+            self._core = _CountingCore(self._core, stats)
+        measure_parse = lambda result, addr: (result[1], 1)
+        measure_format = lambda result, aaddr, version: (version, 1)
+        measure_bin = lambda result, addr, version, *args, **kwargs: (version, 1)
+        measure_many = lambda result, addrs, version: (version, len(result))
+        # each public call is counted once: the wrapped functions do not
+        # call each other through the instance
+        for (stage, name, measure) in (
+                ('parse', '_parse', measure_parse),
+                ('parse', '_parse_fast', measure_parse),
+                ('format', '_format', measure_format),
+                ('format', '_format_fast', measure_format),
+                ('core', 'anonymize_bin', measure_bin),
+                ('core', 'anonymize_bin_many', measure_many),
+                ('core', 'anonymize_network_bin',
+                 lambda result, addr, prefixlen, version: (version, 1)),
+                ('deanonymize', 'deanonymize_bin_many', measure_many),
+                ('core', 'anonymize_array',
+                 lambda result, addrs: (4, result.size)),
+                ('core', '_anonymize_buffer',
+                 lambda result, buf, width: (4 if width == 4 else 6,
+                                             len(result) // width))):
+            setattr(self, name, stats.timed(stage, getattr(self, name), measure))
+        self.anonymize_range_bin = stats.timed_iter(
+            'core', self.anonymize_range_bin,
+            lambda addr, prefixlen, version: version)
 
-    def _to_int(self, byte_array):
-        """Convert a byte array to an int value.
+    def stats(self):
+        """Returns the counters of an instance created with
+        instrument=True.
+
+        Returns:
+            A Stats(ipv4_addresses, ipv6_addresses, aes_calls,
+            aes_blocks, cache_hits, cache_misses, address_cache_hits,
+            address_cache_misses, parse_time, core_time, format_time,
+            ipv4_deanonymized, ipv6_deanonymized, deanonymize_time)
+            tuple, or None if the instance is not instrumented.  The
+            addresses count the anonymized addresses (a network counts
+            as one), and the deanonymized ones are counted apart.  The
+            times are in seconds.  The C accelerator makes one AES call
+            per address.
         """
-        return reduce(lambda x, y: (x << 8) | y, byte_array)
+        stats = self._stats
+        if stats is None:
+            return None
+        cache = self.cache_info() or CacheInfo(0, 0, 0, 0)
+        address_cache = self.address_cache_info() or CacheInfo(0, 0, 0, 0)
+        return Stats(stats.addresses[4], stats.addresses[6],
+                     stats.aes_calls, stats.aes_blocks,
+                     cache.hits, cache.misses,
+                     address_cache.hits, address_cache.misses,
+                     stats.times['parse'], stats.times['core'],
+                     stats.times['format'],
+                     stats.deanonymized[4], stats.deanonymized[6],
+                     stats.times['deanonymize'])
 
-    def anonymize(self, addr):
-        """Anonymize an IP address represented as a text string.
+    def stats_clear(self):
+        """Clears the counters of an instrumented instance.  The cache
+        statistics are cleared by cache_clear() and
+        address_cache_clear().
+        """
+        if self._stats is not None:
+            self._stats.clear()
+
+    def _load_table(self, path):
+        """Maps a prefix table file created by save_table().
+        """
+        with open(path, 'rb') as f:
+            table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(table) < _TABLE_HEADER.size:
+            raise ValueError('%s is not a prefix table file' % path)
+        (magic, version, depth, fingerprint) = _TABLE_HEADER.unpack_from(table)
+        if magic != _TABLE_MAGIC or version != _TABLE_VERSION:
+            raise ValueError('%s is not a prefix table file' % path)
+        if fingerprint != self._fingerprint:
+            raise KeyFingerprintError('%s was created with another key' % path)
+        width = _table_width(depth)
+        if len(table) != _TABLE_HEADER.size + (width << depth):
+            raise ValueError('%s is truncated' % path)
+        self._table = table
+        self._table_depth = depth
+        self._table_width = width
+
+    def _table_lookup(self, ext_addr):
+        """Returns the precomputed flip bits of the top of the address.
+        """
+        offset = (_TABLE_HEADER.size
+                  + (ext_addr >> (128 - self._table_depth)) * self._table_width)
+        return int.from_bytes(self._table[offset:offset + self._table_width],
+                              'big')
+
+    def save_table(self, path, depth=16):
+        """Precompute the flip bits of every prefix up to depth bits
+        and write them to a file to be loaded with CryptoPAn(key,
+        table=path).
+
+        The file embeds a fingerprint of the key and cannot be loaded
+        with another key.  It takes 2**depth entries of 1, 2 or 4 bytes
+        (128KB for the default depth 16).  A depth of 24 takes 64MB and
+        some time to compute.  The table is computed and written in
+        subtrees of 2**_TABLE_CHUNK_BITS entries, so the memory used does
+        not depend on the depth.
 
         Args:
-            addr: an IP address string.
+            path: the path of the file to write.
+            depth: the prefix length covered by the table (8 to 24).
+        """
+        assert(8 <= depth <= 24)
+        width = _table_width(depth)
+        # the prefixes of the subtrees, and their flip bits
+        split = max(depth - _TABLE_CHUNK_BITS, 0)
+        tops = self._table_levels([0], 0, 0, split)
+        with open(path, 'wb') as f:
+            f.write(_TABLE_HEADER.pack(_TABLE_MAGIC, _TABLE_VERSION, depth,
+                                       self._fingerprint))
+            for (prefix, flip_bits) in enumerate(tops):
+                entries = array(_TABLE_TYPECODES[width],
+                                self._table_levels([flip_bits], prefix,
+                                                   split, depth))
+                assert(entries.itemsize == width)
+                if sys.byteorder == 'little':
+                    entries.byteswap()
+                f.write(entries.tobytes())
+
+    def _table_levels(self, flip_bits, prefix, start, end):
+        """Returns the flip bits of the prefixes of end bits below a
+        prefix of start bits, given the flip bits of that prefix.
+
+        Each level is encrypted by one AES call.
+        """
+        # flip_bits[i] holds the flip bits of the i-th prefix of a level
+        for pos in range(start, end):
+            first = prefix << (pos - start)
+            f = self._cipher.encrypt(b''.join(
+                (((first + i) << (128 - pos)) | self._paddings[pos]).to_bytes(16, 'big')
+                for i in range(len(flip_bits))))
+            flip_bits = [(bits << 1) | (f[i * 16] >> 7)
+                         for (i, bits) in enumerate(flip_bits)
+                         for _ in (0, 1)]
+        return flip_bits
+
+    def cache_info(self):
+        """Returns the statistics of the prefix cache.
 
         Returns:
-            An anoymized IP address string.
+            A CacheInfo(hits, misses, maxsize, currsize) tuple, or None
+            if the instance was created without a cache.
         """
-        aaddr = None
-        if sys.version_info < (3, 3):
-            # for Python before 3.3
-            try:
-                ip = netaddr.IPNetwork(addr)
-            except netaddr.AddrFormatError:
-                raise AddressValueError
-            aaddr = self.anonymize_bin(ip.value, ip.version)
-        else:
-            # for newer Python3 (and later?)
-            try:
-                ip = ipaddress.ip_address(addr)
-            except (ValueError, ipaddress.AddressValueError) as e:
-                raise AddressValueError
-            aaddr = self.anonymize_bin(int(ip), ip.version)
-        if ip.version == 4:
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    def cache_clear(self):
+        """Clears the prefix cache and its statistics.
+        """
+        if self._cache is not None:
+            self._cache.clear()
+
+    def address_cache_info(self):
+        """Returns the statistics of the address cache.
+
+        Returns:
+            A CacheInfo(hits, misses, maxsize, currsize) tuple, or None
+            if the instance was created without an address cache.
+        """
+        if self._address_cache is None:
+            return None
+        return self._address_cache.info()
+
+    def address_cache_clear(self):
+        """Clears the address cache and its statistics.
+        """
+        if self._address_cache is not None:
+            self._address_cache.clear()
+
+    def save_address_cache(self, path):
+        """Write the entries of the address cache to a snapshot file, to
+        be loaded by load_address_cache() at the start of a later run.
+
+        The file embeds a fingerprint of the key and cannot be loaded
+        with another key.  It takes 8 bytes per IPv4 entry and 32 bytes
+        per IPv6 entry.
+
+        Args:
+            path: the path of the file to write.
+        """
+        if self._address_cache is None:
+            raise ValueError('the instance has no address cache')
+        entries = {4: [], 6: []}
+        for ((version, addr), aaddr) in self._address_cache.items():
+            entries[version].append((addr, aaddr))
+        ipv4 = array('I', [value for pair in entries[4] for value in pair])
+        assert(ipv4.itemsize == 4)
+        if sys.byteorder == 'little':
+            ipv4.byteswap()
+        with open(path, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION,
+                                          self._snapshot_flags(),
+                                          len(entries[4]), len(entries[6]),
+                                          self._fingerprint))
+            f.write(ipv4.tobytes())
+            f.write(b''.join([addr.to_bytes(16, 'big') + aaddr.to_bytes(16, 'big')
+                              for (addr, aaddr) in entries[6]]))
+
+    def load_address_cache(self, path):
+        """Load the entries of a snapshot file written by
+        save_address_cache() into the address cache.
+
+        The loaded entries become the most recently used ones.  If the
+        file holds more entries than the cache size, the least recently
+        used ones are dropped.
+
+        Args:
+            path: the path of the snapshot file.
+
+        Returns:
+            The number of entries read from the file.
+        """
+        if self._address_cache is None:
+            raise ValueError('the instance has no address cache')
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < _SNAPSHOT_HEADER.size:
+            raise ValueError('%s is not an address cache snapshot' % path)
+        (magic, version, flags, count4, count6, fingerprint) = \
+            _SNAPSHOT_HEADER.unpack_from(data)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise ValueError('%s is not an address cache snapshot' % path)
+        if fingerprint != self._fingerprint:
+            raise KeyFingerprintError('%s was created with another key' % path)
+        if flags != self._snapshot_flags():
+            raise ValueError('%s was created with another embedded_ipv4 mode'
+                             % path)
+        if len(data) != _SNAPSHOT_HEADER.size + count4 * 8 + count6 * 32:
+            raise ValueError('%s is truncated' % path)
+        offset = _SNAPSHOT_HEADER.size
+        ipv4 = array('I')
+        ipv4.frombytes(data[offset:offset + count4 * 8])
+        if sys.byteorder == 'little':
+            ipv4.byteswap()
+        put = self._address_cache.put
+        for i in range(0, len(ipv4), 2):
+            put(4, ipv4[i], ipv4[i + 1])
+        for offset in range(offset + count4 * 8, len(data), 32):
+            put(6, int.from_bytes(data[offset:offset + 16], 'big'),
+                int.from_bytes(data[offset + 16:offset + 32], 'big'))
+        return count4 + count6
+
+    def _snapshot_flags(self):
+        if self._embedded_prefixes is not None:
+            return _SNAPSHOT_EMBEDDED_IPV4
+        return 0
+
+    def _padded_blocks(self, ext_addr, start, pos_max):
+        """Returns the padded prefixes of the address from start bits to
+        pos_max - 1 bits long, as one bytes object of AES blocks.
+        """
+        paddings = self._paddings
+        return b''.join([((ext_addr >> (128 - pos) << (128 - pos))
+                          | paddings[pos]).to_bytes(16, 'big')
+                         for pos in range(start, pos_max)])
+
+    def _parse(self, addr):
+        """Parse an IP address into an int value and its version.
+        """
+        if ipaddress is None:
+            _import_parser()
+        try:
+            ip = ipaddress.ip_address(addr)
+        except (ValueError, ipaddress.AddressValueError) as e:
+            raise AddressValueError
+        return (int(ip), ip.version)
+
+    def _format(self, aaddr, version):
+        """Format an int value as an IP address string.
+        """
+        if version == 4:
             return '%d.%d.%d.%d' % (aaddr>>24, (aaddr>>16) & 0xff,
                                     (aaddr>>8) & 0xff, aaddr & 0xff)
         else:
@@ -133,38 +1077,1514 @@ class CryptoPAn(object):
                                                 (aaddr>>16) & 0xffff,
                                                 aaddr & 0xffff)
 
-    def anonymize_bin(self, addr, version):
+    def _parse_fast(self, addr):
+        """Parse an IP address string into an int value and its version
+        with inet_pton(), without creating an ipaddress object.
+        """
+        if not isinstance(addr, str):
+            return self._parse(addr)
+        try:
+            if ':' in addr:
+                return (int.from_bytes(inet_pton(AF_INET6, addr), 'big'), 6)
+            return (int.from_bytes(inet_pton(AF_INET, addr), 'big'), 4)
+        except (OSError, ValueError):
+            raise AddressValueError
+
+    def _format_fast(self, aaddr, version):
+        """Format an int value as an IP address string with inet_ntop(),
+        which compresses IPv6 addresses as recommended by RFC 5952.
+        """
+        if version == 4:
+            return inet_ntop(AF_INET, aaddr.to_bytes(4, 'big'))
+        return inet_ntop(AF_INET6, aaddr.to_bytes(16, 'big'))
+
+    def _parse_network(self, net):
+        """Parse an IP network (e.g. '192.0.2.0/24') into the int value of
+        its network address, its prefix length and its version.  The
+        host bits are cleared.
+        """
+        if ipaddress is None:
+            _import_parser()
+        try:
+            ip = ipaddress.ip_network(net, strict=False)
+        except (ValueError, ipaddress.AddressValueError,
+                ipaddress.NetmaskValueError):
+            raise AddressValueError
+        return (int(ip.network_address), ip.prefixlen, ip.version)
+
+    def anonymize(self, addr, fast=False, prefix_bits=None, host_bits='keep'):
+        """Anonymize an IP address represented as a text string.
+
+        Args:
+            addr: an IP address string.
+            fast: if True, parse and format the address with
+                  inet_pton()/inet_ntop() instead of the ipaddress
+                  module.  This is several times faster, and IPv6
+                  addresses are returned in the RFC 5952 compressed form
+                  (e.g. '2001:db8::1') instead of all the 8 fields.
+                  Scoped IPv6 addresses (e.g. 'fe80::1%eth0') are not
+                  accepted in this mode.
+            prefix_bits: anonymize only the first bits of the address,
+                  see anonymize_bin().  Either a number of bits, or a
+                  dict of the number per version (e.g. {4: 24, 6: 64}),
+                  where a missing version is fully anonymized.
+            host_bits: the remaining bits, see anonymize_bin().
+
+        Returns:
+            An anoymized IP address string.
+        """
+        if fast:
+            (value, version) = self._parse_fast(addr)
+            format_ = self._format_fast
+        else:
+            (value, version) = self._parse(addr)
+            format_ = self._format
+        if prefix_bits is None:
+            return format_(self.anonymize_bin(value, version), version)
+        if isinstance(prefix_bits, dict):
+            prefix_bits = prefix_bits.get(version)
+        return format_(self.anonymize_bin(value, version, prefix_bits,
+                                          host_bits), version)
+
+    def anonymize_many(self, addrs, fast=False):
+        """Anonymize IP addresses represented as text strings in a batch.
+
+        IPv4 and IPv6 addresses can be mixed.  See anonymize_bin_many()
+        for how the batch is processed.
+
+        Args:
+            addrs: an iterable of IP address strings.
+            fast: parse and format the addresses as anonymize() does
+                  with fast=True.
+
+        Returns:
+            A list of anonymized IP address strings in the input order.
+        """
+        return self._map_many(self.anonymize_bin_many, addrs, fast)
+
+    def _map_many(self, bin_many, addrs, fast):
+        """Parses the address strings, converts the values of each version
+        with bin_many(values, version), and formats them in the input
+        order.
+        """
+        if fast:
+            parse = self._parse_fast
+            format_ = self._format_fast
+        else:
+            parse = self._parse
+            format_ = self._format
+        parsed = [parse(addr) for addr in addrs]
+        result = [None] * len(parsed)
+        for version in (4, 6):
+            index = [i for (i, (_, v)) in enumerate(parsed) if v == version]
+            if not index:
+                continue
+            values = bin_many([parsed[i][0] for i in index], version)
+            for (i, aaddr) in zip(index, values):
+                result[i] = format_(aaddr, version)
+        return result
+
+    def anonymize_packed(self, addr):
+        """Anonymize an IP address in the network byte order.
+
+        Args:
+            addr: a bytes-like object of 4 (IPv4) or 16 (IPv6) bytes.
+
+        Returns:
+            The anonymized address as bytes of the same length.
+        """
+        if len(addr) == 4:
+            version = 4
+        elif len(addr) == 16:
+            version = 6
+        else:
+            raise AddressValueError
+        aaddr = self.anonymize_bin(int.from_bytes(addr, 'big'), version)
+        return aaddr.to_bytes(len(addr), 'big')
+
+    def anonymize_packed_buffer(self, buf, width, out=None, chunk_size=65536):
+        """Anonymize a buffer of IP addresses in the network byte order,
+        such as an address column of a packet capture.
+
+        The buffer is read through a memoryview without copying, and
+        anonymized by anonymize_bin_many() chunk by chunk.
+
+        Args:
+            buf: a bytes-like object holding the addresses back to back.
+            width: the size of an address, 4 (IPv4) or 16 (IPv6).
+            out: a writable bytes-like object of the same size as buf to
+                 write the result to.  It may be buf itself to anonymize
+                 in place.  None (default) allocates a new bytearray.
+            chunk_size: the number of addresses anonymized at once.
+
+        Returns:
+            out, or the new bytearray holding the anonymized addresses.
+        """
+        assert(width == 4 or width == 16)
+        version = 4 if width == 4 else 6
+        src = memoryview(buf).cast('B')
+        if len(src) % width != 0:
+            raise ValueError('the buffer size is not a multiple of %d' % width)
+        if out is None:
+            out = bytearray(len(src))
+        dst = memoryview(out).cast('B')
+        if len(dst) != len(src):
+            raise ValueError('the output buffer size differs from the input')
+        step = chunk_size * width
+        for offset in range(0, len(src), step):
+            end = min(offset + step, len(src))
+            if (self._core is not None and self._address_cache is None
+                    and (width == 4 or self._embedded_prefixes is None)):
+                dst[offset:end] = self._anonymize_buffer(src[offset:end], width)
+                continue
+            addrs = [int.from_bytes(src[i:i + width], 'big')
+                     for i in range(offset, end, width)]
+            dst[offset:end] = b''.join(
+                [aaddr.to_bytes(width, 'big')
+                 for aaddr in self.anonymize_bin_many(addrs, version)])
+        return out
+
+    def _anonymize_buffer(self, buf, width):
+        """Anonymize a buffer of packed addresses with the C accelerator.
+        """
+        return self._core.anonymize_buffer(buf, width)
+
+    def anonymize_bin(self, addr, version, prefix_bits=None, host_bits='keep'):
         """Anonymize an IP address represented as an integer value.
 
         Args:
             addr: an IP address value.
             version: the version of the address (either 4 or 6)
+            prefix_bits: if given, only the first prefix_bits bits are
+                  anonymized, with prefix_bits AES rounds instead of 32
+                  or 128.  They are the same as the first bits of the
+                  fully anonymized address.
+            host_bits: the bits after prefix_bits: 'keep' (default)
+                  leaves the original bits, and 'zero' clears them.
 
         Returns:
             An anoymized IP address value.
         """
         assert(version == 4 or version == 6)
+        if prefix_bits is not None:
+            return self._anonymize_prefix_bin(addr, version, prefix_bits,
+                                              host_bits)
+        if self._address_cache is not None:
+            aaddr = self._address_cache.get(version, addr)
+            if aaddr is None:
+                aaddr = self._anonymize_bin(addr, version)
+                self._address_cache.put(version, addr, aaddr)
+            return aaddr
+        return self._anonymize_bin(addr, version)
+
+    def _anonymize_prefix_bin(self, addr, version, prefix_bits, host_bits):
+        """Anonymize the first prefix_bits bits of an IP address value.
+        """
+        assert(host_bits in ('keep', 'zero'))
+        pos_max = 32 if version == 4 else 128
+        assert(0 <= prefix_bits <= pos_max)
+        # the functions of the class, not the wrappers of an instrumented
+        # instance, which count the address again
+        if prefix_bits == pos_max:
+            return type(self).anonymize_bin(self, addr, version)
+        aaddr = type(self).anonymize_network_bin(self, addr, prefix_bits,
+                                                 version)
+        if host_bits == 'keep':
+            aaddr |= addr & ((1 << (pos_max - prefix_bits)) - 1)
+        return aaddr
+
+    def _anonymize_bin(self, addr, version):
+        """Anonymize an IP address value bypassing the address cache.
+        """
+        if version == 6 and self._embedded_prefixes is not None:
+            embedded = self._embedded_range(addr)
+            if embedded is not None:
+                return self._anonymize_embedded_many([addr], [embedded])[0]
+        if self._core is not None:
+            width = 4 if version == 4 else 16
+            return int.from_bytes(
+                self._core.anonymize_buffer(addr.to_bytes(width, 'big'), width),
+                'big')
+        if version == 4:
+            return addr ^ self._flip_bits(addr << 96, 32)
+        return addr ^ self._flip_bits(addr, 128)
+
+    def _flip_bits(self, ext_addr, pos_max):
+        """Returns the flip bits of the first pos_max prefixes of the
+        extended address, using the prefix table and cache if any.
+        """
+        start = self._table_depth
+        if self._table is not None and start >= pos_max:
+            return self._table_lookup(ext_addr) >> (start - pos_max)
+        flip_bits = None
+        if self._cache is not None:
+            (start, flip_bits) = self._cache.lookup(ext_addr, start, pos_max)
+        if flip_bits is None:
+            flip_bits = 0
+            if self._table is not None:
+                flip_bits = self._table_lookup(ext_addr)
+        # all the remaining prefixes are encrypted by one AES call, and
+        # the flip bits are taken from every 16th byte of the result.
+        f = self._cipher.encrypt(self._padded_blocks(ext_addr, start, pos_max))
+        result = (flip_bits << (pos_max - start)) | int(f[::16].translate(_FLIP_DIGITS), 2)
+        if self._cache is not None:
+            self._cache.store(ext_addr, start, pos_max, result)
+        return result
+
+    def anonymize_array(self, addrs):
+        """Anonymize IPv4 addresses held in a NumPy array.
+
+        The padded prefixes of each bit position are built with
+        vectorized shifts and masks, deduplicated with numpy.unique(),
+        and encrypted by one AES call per bit position.  This requires
+        the optional numpy package.
+
+        Args:
+            addrs: a numpy.ndarray of IPv4 address values (uint32).
+
+        Returns:
+            A uint32 numpy.ndarray of the anonymized addresses, in the
+            same shape as addrs.
+        """
+        import numpy as np
+
+        addrs = np.asarray(addrs, dtype=np.uint32)
+        if self._core is not None:
+            f = self._core.anonymize_buffer(addrs.astype('>u4').tobytes(), 4)
+            return np.frombuffer(f, dtype='>u4').astype(np.uint32).reshape(addrs.shape)
+        flat = addrs.ravel()
+        flip_bits = np.zeros(flat.shape, dtype=np.uint32)
+        if flat.size == 0:
+            return flip_bits.reshape(addrs.shape)
+        # an IPv4 prefix only covers the top 32 bits of a padded block,
+        # the rest of the block always comes from the padding.
+        padding_hi = np.uint32(self._padding_int >> 96)
+        padding_lo = np.frombuffer(
+            (self._padding_int & self._masks[32]).to_bytes(12, 'big'),
+            dtype=np.uint8)
+        if self._table is not None:
+            depth = self._table_depth
+            table = np.frombuffer(self._table,
+                                  dtype='>u%d' % self._table_width,
+                                  offset=_TABLE_HEADER.size)
+            flip_bits |= (table[flat >> np.uint32(32 - depth)].astype(np.uint32)
+                          << np.uint32(32 - depth))
+        for pos in range(self._table_depth, 32):
+            mask = np.uint32(self._masks[pos] >> 96)
+            padded_hi = (flat & ~mask) | (padding_hi & mask)
+            (prefixes, inverse) = np.unique(padded_hi, return_inverse=True)
+            blocks = np.empty((len(prefixes), 16), dtype=np.uint8)
+            blocks[:, :4] = prefixes.astype('>u4').view(np.uint8).reshape(-1, 4)
+            blocks[:, 4:] = padding_lo
+            f = np.frombuffer(self._cipher.encrypt(blocks.tobytes()),
+                              dtype=np.uint8)[::16] >> 7
+            flip_bits |= f.astype(np.uint32)[inverse.ravel()] << np.uint32(31 - pos)
+        return (flat ^ flip_bits).reshape(addrs.shape)
+
+    def anonymize_bin_many(self, addrs, version):
+        """Anonymize IP addresses represented as integer values in a batch.
+
+        The padded prefixes of all the addresses are collected into one
+        buffer and encrypted by a single AES call.  This is much faster
+        than calling anonymize_bin() per address.  The buffer takes 16
+        bytes per prefix which is not cached, so very large inputs
+        should be given in chunks.
+
+        Args:
+            addrs: an iterable of IP address values.
+            version: the version of the addresses (either 4 or 6)
+
+        Returns:
+            A list of anonymized IP address values in the input order.
+        """
+        assert(version == 4 or version == 6)
+        address_cache = self._address_cache
+        if address_cache is None:
+            return self._anonymize_bin_many(addrs, version)
+        addrs = list(addrs)
+        result = [address_cache.get(version, addr) for addr in addrs]
+        # the addresses missing in the cache, each only once
+        missing = list(OrderedDict.fromkeys(
+            [addr for (addr, aaddr) in zip(addrs, result) if aaddr is None]))
+        if missing:
+            computed = dict(zip(missing,
+                                self._anonymize_bin_many(missing, version)))
+            for (addr, aaddr) in computed.items():
+                address_cache.put(version, addr, aaddr)
+            result = [computed[addr] if aaddr is None else aaddr
+                      for (addr, aaddr) in zip(addrs, result)]
+        return result
+
+    def _anonymize_bin_many(self, addrs, version):
+        """Anonymize IP address values in a batch bypassing the address
+        cache.
+        """
+        if version == 4 or self._embedded_prefixes is None:
+            return self._anonymize_plain_many(addrs, version)
+        return self._split_embedded(addrs, self._anonymize_plain_many,
+                                    self._anonymize_embedded_many)
+
+    def _anonymize_plain_many(self, addrs, version):
+        """Anonymize IP address values in a batch, all of them as plain
+        IPv4 or IPv6 addresses.
+        """
+        if self._core is not None:
+            width = 4 if version == 4 else 16
+            f = self._core.anonymize_buffer(
+                b''.join([addr.to_bytes(width, 'big') for addr in addrs]), width)
+            return [int.from_bytes(f[i:i + width], 'big')
+                    for i in range(0, len(f), width)]
         if version == 4:
             pos_max = 32
-            ext_addr = addr << 96
+            shift = 96
         else:
             pos_max = 128
-            ext_addr = addr
-
-        flip_array = []
-        for pos in range(pos_max):
-            prefix = ext_addr >> (128 - pos) << (128 - pos)
-            padded_addr = prefix | (self._padding_int & self._masks[pos])
-            if sys.version_info.major == 2:
-                # for Python2
-                f = self._cipher.encrypt(self._to_array(padded_addr, 16).tostring())
+            shift = 0
+
+        cache = self._cache
+        table_depth = self._table_depth
+        # (address, extended address, first position to encrypt, flip
+        # bits above that position) of each address
+        known = []
+        blocks = []
+        for addr in addrs:
+            ext_addr = addr << shift
+            start = table_depth
+            flip_bits = None
+            if cache is not None:
+                (start, flip_bits) = cache.lookup(ext_addr, start, pos_max)
+            if flip_bits is None:
+                flip_bits = 0
+                if self._table is not None:
+                    flip_bits = self._table_lookup(ext_addr)
+            known.append((addr, ext_addr, start, flip_bits))
+            blocks.append(self._padded_blocks(ext_addr, start, pos_max))
+
+        f = self._cipher.encrypt(b''.join(blocks))
+        result = []
+        offset = 0
+        for (addr, ext_addr, start, flip_bits) in known:
+            end = offset + (pos_max - start) * 16
+            flip_bits = ((flip_bits << (pos_max - start))
+                         | int(f[offset:end:16].translate(_FLIP_DIGITS), 2))
+            offset = end
+            if cache is not None:
+                cache.store(ext_addr, start, pos_max, flip_bits)
+            result.append(addr ^ flip_bits)
+        return result
+
+    def _embedded_range(self, addr):
+        """Returns the (network value, prefix length) of the embedded
+        IPv4 range of an IPv6 address value, or None.
+        """
+        for (net, prefixlen) in _EMBEDDED_IPV4:
+            if addr >> (128 - prefixlen) == net >> (128 - prefixlen):
+                return (net, prefixlen)
+        return None
+
+    def _embedded_network(self, net, prefixlen):
+        """Returns the anonymized network value of an embedded IPv4 range.
+        """
+        anet = self._embedded_prefixes.get(net)
+        if anet is None:
+            anet = net ^ (self._flip_bits(net, prefixlen) << (128 - prefixlen))
+            self._embedded_prefixes[net] = anet
+        return anet
+
+    def _split_embedded(self, addrs, plain_many, embedded_many):
+        """Converts the IPv6 address values of a batch with
+        embedded_many(values, ranges) if they embed an IPv4 address, and
+        with plain_many(values, 6) otherwise.
+        """
+        addrs = list(addrs)
+        ranges = [self._embedded_range(addr) for addr in addrs]
+        plain = [i for (i, embedded) in enumerate(ranges) if embedded is None]
+        if len(plain) == len(addrs):
+            return plain_many(addrs, 6)
+        result = list(addrs)
+        if plain:
+            for (i, aaddr) in zip(plain,
+                                  plain_many([addrs[i] for i in plain], 6)):
+                result[i] = aaddr
+        index = [i for (i, embedded) in enumerate(ranges) if embedded is not None]
+        for (i, aaddr) in zip(index, embedded_many([addrs[i] for i in index],
+                                                   [ranges[i] for i in index])):
+            result[i] = aaddr
+        return result
+
+    def _anonymize_embedded_many(self, addrs, ranges):
+        """Anonymize IPv6 address values embedding an IPv4 address, given
+        with their embedded IPv4 ranges.
+
+        The IPv4 addresses are anonymized in one batch, and the bits
+        after them (only for 6to4) get their usual flip bits, encrypted
+        by one AES call.
+        """
+        ipv4 = self._anonymize_plain_many(
+            [(addr >> (96 - prefixlen)) & 0xffffffff
+             for (addr, (_, prefixlen)) in zip(addrs, ranges)], 4)
+        # the prefixes after the IPv4 address
+        suffixes = [(addr, prefixlen + 32) for (addr, (_, prefixlen))
+                    in zip(addrs, ranges) if prefixlen < 96]
+        if suffixes:
+            f = self._cipher.encrypt(b''.join(
+                [self._padded_blocks(addr, pos, 128) for (addr, pos) in suffixes]))
+        result = []
+        offset = 0
+        for (addr, (net, prefixlen), aaddr) in zip(addrs, ranges, ipv4):
+            suffix_len = 96 - prefixlen
+            aaddr = self._embedded_network(net, prefixlen) | (aaddr << suffix_len)
+            if suffix_len:
+                end = offset + suffix_len * 16
+                flip_bits = int(f[offset:end:16].translate(_FLIP_DIGITS), 2)
+                offset = end
+                aaddr |= (addr ^ flip_bits) & ((1 << suffix_len) - 1)
+            result.append(aaddr)
+        return result
+
+    def _walk_embedded_range(self, addr, prefixlen, embedded):
+        """Generate the anonymized addresses of a network overlapping an
+        embedded IPv4 range, as anonymize_range_bin() does.
+        """
+        (net, length) = embedded
+        suffix_len = 96 - length
+        if prefixlen >= 96 and length == 96:
+            # the IPv4 network walked as such
+            anet = self._embedded_network(net, length)
+            for aaddr in self._walk_range(addr & 0xffffffff, prefixlen - 96, 32):
+                yield anet | aaddr
+        elif prefixlen >= 128 - suffix_len:
+            # the usual walk below the fixed IPv4 address
+            top = self._anonymize_embedded_many([addr], [embedded])[0]
+            top &= ~((1 << suffix_len) - 1)
+            mask = (1 << suffix_len) - 1
+            for aaddr in self._walk_range(addr, prefixlen, 128):
+                yield top | (aaddr & mask)
+        else:
+            step = 1 << _RANGE_CHUNK_BITS
+            end = addr + (1 << (128 - prefixlen))
+            for start in range(addr, end, step):
+                for aaddr in self._anonymize_bin_many(
+                        range(start, min(start + step, end)), 6):
+                    yield aaddr
+
+    def anonymize_network(self, net, fast=False):
+        """Anonymize an IP network represented as a text string.
+
+        Crypto-PAn maps a network of prefix length N to a network of the
+        same prefix length, so only the N flip bits of the network
+        prefix are computed.
+
+        Args:
+            net: an IP network string (e.g. '192.0.2.0/24').  The host
+                 bits, if any, are ignored.
+            fast: format the network address as anonymize() does with
+                  fast=True.
+
+        Returns:
+            The anonymized network string.
+        """
+        (value, prefixlen, version) = self._parse_network(net)
+        aaddr = self.anonymize_network_bin(value, prefixlen, version)
+        if fast:
+            return '%s/%d' % (self._format_fast(aaddr, version), prefixlen)
+        return '%s/%d' % (self._format(aaddr, version), prefixlen)
+
+    def anonymize_network_bin(self, addr, prefixlen, version):
+        """Anonymize an IP network represented as an integer value.
+
+        Args:
+            addr: the network address value.  The host bits are ignored.
+            prefixlen: the prefix length of the network.
+            version: the version of the address (either 4 or 6)
+
+        Returns:
+            The anonymized network address value (with the host bits
+            cleared).
+        """
+        assert(version == 4 or version == 6)
+        pos_max = 32 if version == 4 else 128
+        assert(0 <= prefixlen <= pos_max)
+        addr &= ~((1 << (pos_max - prefixlen)) - 1)
+        if prefixlen == 0:
+            return addr
+        if version == 6 and self._embedded_prefixes is not None:
+            embedded = self._embedded_range(addr)
+            if embedded is not None and prefixlen > embedded[1]:
+                aaddr = self._anonymize_embedded_many([addr], [embedded])[0]
+                return aaddr & ~((1 << (128 - prefixlen)) - 1)
+        flip_bits = self._flip_bits(addr << (128 - pos_max), prefixlen)
+        return addr ^ (flip_bits << (pos_max - prefixlen))
+
+    def anonymize_range(self, net, fast=False):
+        """Generate the anonymized addresses of every address of an IP
+        network, represented as text strings.
+
+        See anonymize_range_bin() for how the network is walked.
+
+        Args:
+            net: an IP network string (e.g. '192.0.2.0/24').  The host
+                 bits, if any, are ignored.
+            fast: format the addresses as anonymize() does with
+                  fast=True.
+
+        Returns:
+            A generator of the anonymized address strings, in the order
+            of the original addresses from the network address up.
+        """
+        (value, prefixlen, version) = self._parse_network(net)
+        format_ = self._format_fast if fast else self._format
+        for aaddr in self.anonymize_range_bin(value, prefixlen, version):
+            yield format_(aaddr, version)
+
+    def anonymize_range_bin(self, addr, prefixlen, version):
+        """Generate the anonymized addresses of every address of an IP
+        network, represented as integer values.
+
+        The prefix tree below the network is walked depth first, and
+        the flip bit of each internal node is computed only once
+        instead of once per address below it.  The subtrees of up to
+        2**_RANGE_CHUNK_BITS addresses at the bottom are processed level
+        by level with one AES call per level.
+
+        Args:
+            addr: the network address value.  The host bits are ignored.
+            prefixlen: the prefix length of the network.
+            version: the version of the address (either 4 or 6)
+
+        Returns:
+            A generator of the anonymized address values, in the order
+            of the original addresses from the network address up.
+        """
+        assert(version == 4 or version == 6)
+        pos_max = 32 if version == 4 else 128
+        assert(0 <= prefixlen <= pos_max)
+        addr &= ~((1 << (pos_max - prefixlen)) - 1)
+        if version == 6 and self._embedded_prefixes is not None:
+            for (net, length) in _EMBEDDED_IPV4:
+                common = min(prefixlen, length)
+                if addr >> (128 - common) == net >> (128 - common):
+                    return self._walk_embedded_range(addr, prefixlen,
+                                                     (net, length))
+        return self._walk_range(addr, prefixlen, pos_max)
+
+    def _walk_range(self, addr, prefixlen, pos_max):
+        """Generate the anonymized addresses of a network as
+        anonymize_range_bin() does, all of them as plain addresses.
+        """
+        paddings = self._paddings
+        # the depth at which the bottom subtrees start
+        bottom = max(prefixlen, pos_max - _RANGE_CHUNK_BITS)
+        prefix = addr >> (pos_max - prefixlen)
+        flip_bits = 0
+        if prefixlen > 0:
+            flip_bits = self._flip_bits(prefix << (128 - prefixlen), prefixlen)
+        # (prefix, its length, its flip bits) of the nodes to visit
+        stack = [(prefix, prefixlen, flip_bits)]
+        while stack:
+            (prefix, pos, flip_bits) = stack.pop()
+            if pos < bottom:
+                if self._table is not None and pos < self._table_depth:
+                    flip = (self._table_lookup(prefix << (128 - pos))
+                            >> (self._table_depth - pos - 1)) & 1
+                else:
+                    f = self._cipher.encrypt(
+                        ((prefix << (128 - pos)) | paddings[pos]).to_bytes(16, 'big'))
+                    flip = f[0] >> 7
+                flip_bits = (flip_bits << 1) | flip
+                stack.append(((prefix << 1) | 1, pos + 1, flip_bits))
+                stack.append((prefix << 1, pos + 1, flip_bits))
+                continue
+            # leaves[i] holds the flip bits below the bottom node of the
+            # i-th node of the current level
+            leaves = [0]
+            for level in range(pos, pos_max):
+                base = prefix << (level - pos)
+                f = self._cipher.encrypt(b''.join(
+                    [(((base | i) << (128 - level)) | paddings[level]).to_bytes(16, 'big')
+                     for i in range(len(leaves))]))
+                leaves = [(bits << 1) | (flip >> 7)
+                          for (bits, flip) in zip(leaves, f[::16])
+                          for _ in (0, 1)]
+            base = prefix << (pos_max - pos)
+            high = flip_bits << (pos_max - pos)
+            for (i, bits) in enumerate(leaves):
+                yield (base | i) ^ high ^ bits
+
+    def _table_inverse(self):
+        """Returns an array mapping the top bits of an anonymized address
+        to the flip bits of the prefix table, built at the first use.
+
+        It is built in one pass over the mapped table, vectorized with
+        numpy if it is installed, and takes as much memory as the table.
+        """
+        if self._table_inv is None:
+            width = self._table_width
+            typecode = _TABLE_TYPECODES[width]
+            try:
+                import numpy as np
+            except ImportError:
+                np = None
+            if np is not None:
+                entries = np.frombuffer(self._table, dtype='>u%d' % width,
+                                        offset=_TABLE_HEADER.size)
+                inverse = np.empty(len(entries), dtype='=u%d' % width)
+                inverse[np.arange(len(entries), dtype=inverse.dtype)
+                        ^ entries] = entries
+                self._table_inv = array(typecode, inverse.tobytes())
             else:
-                # for Python3 (and later?)
-                f = self._cipher.encrypt(self._to_array(padded_addr, 16).tobytes())
-            flip_array.append(bytearray(f)[0] >> 7)
-        result = reduce(lambda x, y: (x << 1) | y, flip_array)
+                entries = array(typecode, self._table[_TABLE_HEADER.size:])
+                if sys.byteorder == 'little':
+                    entries.byteswap()
+                inverse = array(typecode, bytes(len(entries) * width))
+                for (prefix, flip_bits) in enumerate(entries):
+                    inverse[prefix ^ flip_bits] = flip_bits
+                self._table_inv = inverse
+        return self._table_inv
+
+    def deanonymize(self, addr, fast=False):
+        """Restore the original IP address of an anonymized one, both
+        represented as text strings.
+
+        Args:
+            addr: an anonymized IP address string.
+            fast: parse and format the addresses as anonymize() does
+                  with fast=True.
+
+        Returns:
+            The original IP address string.
+        """
+        if fast:
+            (value, version) = self._parse_fast(addr)
+            return self._format_fast(self.deanonymize_bin(value, version),
+                                     version)
+        (value, version) = self._parse(addr)
+        return self._format(self.deanonymize_bin(value, version), version)
+
+    def deanonymize_many(self, addrs, fast=False):
+        """Restore the original IP addresses of anonymized ones, both
+        represented as text strings, in a batch.
+
+        Args:
+            addrs: an iterable of anonymized IP address strings.
+            fast: parse and format the addresses as anonymize() does
+                  with fast=True.
+
+        Returns:
+            A list of the original IP address strings in the input order.
+        """
+        return self._map_many(self.deanonymize_bin_many, addrs, fast)
+
+    def deanonymize_bin(self, addr, version):
+        """Restore the original IP address of an anonymized one, both
+        represented as integer values.
+
+        Args:
+            addr: an anonymized IP address value.
+            version: the version of the address (either 4 or 6)
+
+        Returns:
+            The original IP address value.
+        """
+        return self.deanonymize_bin_many([addr], version)[0]
+
+    def deanonymize_bin_many(self, addrs, version):
+        """Restore the original IP addresses of anonymized ones, both
+        represented as integer values, in a batch.
+
+        Each bit of an anonymized address is the original bit flipped by
+        a function of the original prefix above it, so the original is
+        restored from the top bit down.  The bits of all the addresses
+        at the same position are restored by one AES call, and the
+        prefix cache (or table) lets addresses skip the known prefixes.
+
+        Args:
+            addrs: an iterable of anonymized IP address values.
+            version: the version of the addresses (either 4 or 6)
+
+        Returns:
+            A list of the original IP address values in the input order.
+        """
+        assert(version == 4 or version == 6)
+        if version == 4 or self._embedded_prefixes is None:
+            return self._deanonymize_plain_many(addrs, version)
+        return self._split_deanonymized(addrs)
+
+    def _split_deanonymized(self, addrs):
+        """Restore the original IPv6 address values of anonymized ones,
+        some of which may be in the anonymized embedded IPv4 ranges.
+        """
+        anets = [(self._embedded_network(net, prefixlen), net, prefixlen)
+                 for (net, prefixlen) in _EMBEDDED_IPV4]
+        addrs = list(addrs)
+        ranges = []
+        for addr in addrs:
+            embedded = None
+            for (anet, net, prefixlen) in anets:
+                if addr >> (128 - prefixlen) == anet >> (128 - prefixlen):
+                    embedded = (net, prefixlen)
+                    break
+            ranges.append(embedded)
+        index = [i for (i, embedded) in enumerate(ranges) if embedded is not None]
+        plain = [i for (i, embedded) in enumerate(ranges) if embedded is None]
+        result = list(addrs)
+        if plain:
+            for (i, addr) in zip(plain, self._deanonymize_plain_many(
+                    [addrs[i] for i in plain], 6)):
+                result[i] = addr
+        if not index:
+            return result
+        ipv4 = self._deanonymize_plain_many(
+            [(addrs[i] >> (96 - ranges[i][1])) & 0xffffffff for i in index], 4)
+        # a 6to4 address is restored from its usual anonymized address,
+        # whose top 48 bits are computed from the restored ones
+        usual = []
+        for (i, addr) in zip(index, ipv4):
+            (net, prefixlen) = ranges[i]
+            suffix_len = 96 - prefixlen
+            result[i] = net | (addr << suffix_len)
+            if suffix_len:
+                top = result[i]
+                top ^= self._flip_bits(top, 128 - suffix_len) << suffix_len
+                usual.append((i, top | (addrs[i] & ((1 << suffix_len) - 1))))
+        if usual:
+            for ((i, _), addr) in zip(usual, self._deanonymize_plain_many(
+                    [aaddr for (_, aaddr) in usual], 6)):
+                result[i] = addr
+        return result
+
+    def _deanonymize_plain_many(self, addrs, version):
+        """Restore the original IP address values of anonymized ones, all
+        of them as plain IPv4 or IPv6 addresses.
+        """
+        if self._core is not None:
+            width = 4 if version == 4 else 16
+            f = self._core.deanonymize_buffer(
+                b''.join([addr.to_bytes(width, 'big') for addr in addrs]), width)
+            return [int.from_bytes(f[i:i + width], 'big')
+                    for i in range(0, len(f), width)]
+        if version == 4:
+            pos_max = 32
+            shift = 96
+        else:
+            pos_max = 128
+            shift = 0
+
+        cache = self._cache
+        paddings = self._paddings
+        # [address, extended address, first position to restore, flip
+        # bits above the position] of each address
+        states = []
+        for addr in addrs:
+            ext_addr = addr << shift
+            start = self._table_depth
+            flip_bits = None
+            if cache is not None:
+                (start, flip_bits) = cache.lookup(ext_addr, start, pos_max,
+                                                  reverse=True)
+            if flip_bits is None:
+                flip_bits = 0
+                if self._table is not None:
+                    flip_bits = self._table_inverse()[ext_addr >> (128 - start)]
+            states.append([addr, ext_addr, start, flip_bits])
+
+        for pos in range(min([state[2] for state in states] or [pos_max]),
+                         pos_max):
+            active = [state for state in states if state[2] <= pos]
+            # the original prefix is the anonymized one with its flip bits
+            f = self._cipher.encrypt(b''.join([
+                ((((ext_addr >> (128 - pos)) ^ flip_bits) << (128 - pos))
+                 | paddings[pos]).to_bytes(16, 'big')
+                for (_, ext_addr, _, flip_bits) in active]))
+            for (state, flip) in zip(active, f[::16]):
+                state[3] = (state[3] << 1) | (flip >> 7)
+
+        result = []
+        for (addr, ext_addr, start, flip_bits) in states:
+            if cache is not None:
+                cache.store(ext_addr, start, pos_max, flip_bits, reverse=True)
+            result.append(addr ^ flip_bits)
+        return result
+
+class _PrefixTree(object):
+    """A path-compressed binary (Patricia) tree of labeled prefixes of
+    one IP version, for the longest prefix match of address values.
+
+    Prefixes are added to a plain binary trie, which is compiled at
+    the first lookup into flat lists where the chains of unlabeled
+    nodes with one child are collapsed.  A lookup visits at most one
+    node per branching or labeled prefix above the address.
+    """
+    def __init__(self, bits):
+        self.bits = bits
+        # a trie node is [label, child 0, child 1]
+        self._root = [None, None, None]
+        self._prefixes = None
+
+    def add(self, value, prefixlen, label):
+        """Labels the prefix of prefixlen bits of the address value.
+        """
+        node = self._root
+        for pos in range(prefixlen):
+            bit = 1 + ((value >> (self.bits - pos - 1)) & 1)
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[0] = label
+        self._prefixes = None
+
+    def _compile(self):
+        self._prefixes = []
+        self._lengths = []
+        self._labels = []
+        self._children = ([], [])
+        self._emit(self._root, 0, 0)
+
+    def _emit(self, node, prefix, length):
+        """Appends the compiled node of the trie node, and its subtree.
+        Returns the index of the node.
+        """
+        while node[0] is None and (node[1] is None) != (node[2] is None):
+            bit = 0 if node[1] is not None else 1
+            node = node[1 + bit]
+            prefix = (prefix << 1) | bit
+            length += 1
+        index = len(self._prefixes)
+        self._prefixes.append(prefix)
+        self._lengths.append(length)
+        self._labels.append(node[0])
+        self._children[0].append(-1)
+        self._children[1].append(-1)
+        for bit in (0, 1):
+            if node[1 + bit] is not None:
+                self._children[bit][index] = self._emit(
+                    node[1 + bit], (prefix << 1) | bit, length + 1)
+        return index
+
+    def lookup(self, value):
+        """Returns the (label, network value, prefixlen) of the longest
+        labeled prefix of the address value, or None.
+        """
+        if self._prefixes is None:
+            self._compile()
+        bits = self.bits
+        prefixes = self._prefixes
+        lengths = self._lengths
+        (children0, children1) = self._children
+        best = -1
+        index = 0
+        while index >= 0:
+            length = lengths[index]
+            if value >> (bits - length) != prefixes[index]:
+                break
+            if self._labels[index] is not None:
+                best = index
+            if length == bits:
+                break
+            if (value >> (bits - length - 1)) & 1:
+                index = children1[index]
+            else:
+                index = children0[index]
+        if best < 0:
+            return None
+        length = lengths[best]
+        return (self._labels[best], prefixes[best] << (bits - length), length)
+
+class AddressPolicy(object):
+    """Anonymize IP addresses with a CryptoPAn instance, except for the
+    addresses in some ranges.
+
+    Each range has an action:
+
+      passthrough: the address is not anonymized (e.g. loopback).
+      preserve: the network prefix of the range is kept and only the
+          host part is anonymized (e.g. private or documentation
+          ranges).
+      special: the address is anonymized as usual.
+
+    The range of an address is its longest matching range.  An address
+    anonymized as usual must not fall into any of the ranges, as it
+    could not be told from a kept address; PolicyCollisionError is
+    raised then.  The ranges are compiled into a Patricia tree, so
+    thousands of ranges cost a few node visits per address.
+    """
+    def __init__(self, cp, passthrough=(), preserve=(), special=()):
+        """Initialize an AddressPolicy() instance.
+
+        Args:
+            cp: the CryptoPAn instance used for anonymization.
+            passthrough: networks (strings like '127.0.0.0/8' or
+                 ipaddress network objects) not to anonymize.
+            preserve: networks whose prefix is kept.
+            special: networks anonymized as usual, which the other
+                 addresses must not be anonymized into.
+        """
+        self._cp = cp
+        self._trees = {4: _PrefixTree(32), 6: _PrefixTree(128)}
+        for (action, nets) in (('special', special), ('preserve', preserve),
+                               ('passthrough', passthrough)):
+            for net in nets:
+                (value, prefixlen, version) = cp._parse_network(str(net))
+                self._trees[version].add(value, prefixlen, action)
+
+    def match_bin(self, addr, version):
+        """Finds the range of an address value.
+
+        Returns:
+            An (action, network value, prefixlen) tuple of the range, or
+            None if the address is in none of the ranges.
+        """
+        assert(version == 4 or version == 6)
+        return self._trees[version].lookup(addr)
+
+    def classify(self, addr):
+        """Returns the action for an address string ('passthrough',
+        'preserve' or 'special'), or None.
+        """
+        (value, version) = self._cp._parse(addr)
+        return self.classify_bin_many([value], version)[0]
+
+    def classify_bin_many(self, addrs, version):
+        """Returns the actions for address values, as classify() does.
+        """
+        assert(version == 4 or version == 6)
+        lookup = self._trees[version].lookup
+        return [match[0] if match is not None else None
+                for match in [lookup(addr) for addr in addrs]]
+
+    def anonymize(self, addr, fast=False):
+        """Anonymize an IP address string following the policy.
+
+        Args:
+            addr: an IP address string.
+            fast: parse and format the address as CryptoPAn.anonymize()
+                  does with fast=True.
+
+        Returns:
+            An IP address string.
+        """
+        return self.anonymize_many([addr], fast)[0]
+
+    def anonymize_many(self, addrs, fast=False):
+        """Anonymize IP address strings following the policy in a batch.
+
+        Returns:
+            A list of IP address strings in the input order.
+        """
+        return self._cp._map_many(self.anonymize_bin_many, addrs, fast)
+
+    def anonymize_bin(self, addr, version):
+        """Anonymize an IP address value following the policy.
+        """
+        return self.anonymize_bin_many([addr], version)[0]
+
+    def anonymize_bin_many(self, addrs, version):
+        """Anonymize IP address values following the policy in a batch.
+
+        The whole batch is classified first, and the addresses to
+        anonymize are given to CryptoPAn.anonymize_bin_many() at once.
+
+        Args:
+            addrs: an iterable of IP address values.
+            version: the version of the addresses (either 4 or 6)
+
+        Returns:
+            A list of IP address values in the input order.
+        """
+        assert(version == 4 or version == 6)
+        bits = 32 if version == 4 else 128
+        lookup = self._trees[version].lookup
+        result = list(addrs)
+        matches = [lookup(addr) for addr in result]
+        index = [i for (i, match) in enumerate(matches)
+                 if match is None or match[0] != 'passthrough']
+        anonymized = self._cp.anonymize_bin_many([result[i] for i in index],
+                                                 version)
+        for (i, aaddr) in zip(index, anonymized):
+            match = matches[i]
+            if match is not None and match[0] == 'preserve':
+                hostmask = (1 << (bits - match[2])) - 1
+                aaddr = match[1] | (aaddr & hostmask)
+            else:
+                collision = lookup(aaddr)
+                if collision is not None:
+                    (action, net, prefixlen) = collision
+                    raise PolicyCollisionError(
+                        '%s is anonymized into the %s range %s/%d'
+                        % (self._cp._format_fast(result[i], version), action,
+                           self._cp._format_fast(net, version), prefixlen))
+            result[i] = aaddr
+        return result
+
+class MultiCryptoPAn(object):
+    """Anonymize IP addresses under several keys at once.
+
+    Each address is parsed once, and the addresses of a batch are
+    anonymized with one anonymize_bin_many() call per key, so that an
+    input shared with several parties is read and parsed only once.
+    """
+    def __init__(self, keys, **options):
+        """Initialize a MultiCryptoPAn() instance.
+
+        Args:
+            keys: the 32 bytes keys, or CryptoPAn instances (e.g. each
+                  with the prefix table of its key).
+            options: other keyword arguments given to CryptoPAn() for
+                  each key, such as cache_size.
+        """
+        self.instances = [key if isinstance(key, CryptoPAn)
+                          else CryptoPAn(key, **options) for key in keys]
+        assert(self.instances)
+
+    def __len__(self):
+        return len(self.instances)
+
+    def anonymize(self, addr, fast=False):
+        """Anonymize an IP address string under every key.
+
+        Returns:
+            A list of the anonymized IP address strings, one per key.
+        """
+        return [result[0] for result in self.anonymize_many([addr], fast)]
+
+    def anonymize_many(self, addrs, fast=False):
+        """Anonymize IP address strings under every key in a batch.
+
+        Args:
+            addrs: an iterable of IP address strings.
+            fast: parse and format the addresses as
+                  CryptoPAn.anonymize() does with fast=True.
+
+        Returns:
+            A list of lists of anonymized IP address strings in the
+            input order, one list per key.
+        """
+        cp = self.instances[0]
+        if fast:
+            parse = cp._parse_fast
+            format_ = cp._format_fast
+        else:
+            parse = cp._parse
+            format_ = cp._format
+        parsed = [parse(addr) for addr in addrs]
+        results = [[None] * len(parsed) for _ in self.instances]
+        for version in (4, 6):
+            index = [i for (i, (_, v)) in enumerate(parsed) if v == version]
+            if not index:
+                continue
+            values = [parsed[i][0] for i in index]
+            for (result, anonymized) in zip(
+                    results, self.anonymize_bin_many(values, version)):
+                for (i, aaddr) in zip(index, anonymized):
+                    result[i] = format_(aaddr, version)
+        return results
+
+    def anonymize_bin(self, addr, version):
+        """Anonymize an IP address value under every key.
+
+        Returns:
+            A list of the anonymized IP address values, one per key.
+        """
+        return [cp.anonymize_bin(addr, version) for cp in self.instances]
+
+    def anonymize_bin_many(self, addrs, version):
+        """Anonymize IP address values under every key in a batch.
+
+        Args:
+            addrs: an iterable of IP address values.
+            version: the version of the addresses (either 4 or 6)
+
+        Returns:
+            A list of lists of anonymized IP address values in the input
+            order, one list per key.
+        """
+        assert(version == 4 or version == 6)
+        addrs = list(addrs)
+        return [cp.anonymize_bin_many(addrs, version) for cp in self.instances]
+
+# The CryptoPAn instance of a parallel_anonymize() worker process.
+_worker_cp = None
+
+def _parallel_init(key, options):
+    global _worker_cp
+    _worker_cp = CryptoPAn(key, **options)
+
+def _parallel_anonymize_chunk(addrs):
+    return _worker_cp.anonymize_many(addrs)
+
+def parallel_anonymize(addrs, key, workers=None, chunk_size=10000,
+                       **options):
+    """Anonymize IP address strings using a pool of worker processes.
+
+    Only the key is sent to the workers, each of which creates its own
+    CryptoPAn instance.  The input is read and sent in chunks, keeping
+    at most two chunks per worker in flight, so the memory use does not
+    depend on the input size.
+
+    Args:
+        addrs: an iterable of IP address strings.
+        key: the 32 bytes key given to CryptoPAn().
+        workers: the number of worker processes.  None (default) uses
+                 the number of CPUs.
+        chunk_size: the number of addresses sent to a worker at once.
+        options: other keyword arguments given to CryptoPAn() in the
+                 workers, such as cache_size or table.
+
+    Returns:
+        A generator of the anonymized IP address strings in the input
+        order.
+    """
+    import multiprocessing
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    addrs = iter(addrs)
+    with multiprocessing.Pool(workers, _parallel_init,
+                              (key, options)) as pool:
+        pending = deque()
+        while True:
+            chunk = list(itertools.islice(addrs, chunk_size))
+            if chunk:
+                pending.append(pool.apply_async(_parallel_anonymize_chunk,
+                                                (chunk,)))
+            if not pending:
+                break
+            if not chunk or len(pending) >= 2 * workers:
+                for aaddr in pending.popleft().get():
+                    yield aaddr
+
+# IPv4, IPv6 and MAC addresses in text, matched in a single pass.  The
+# IPv6 part only matches candidates, which are validated by the parser.
+# A candidate ends with a group of hex digits, an IPv4 address or '::',
+# so that a colon or a full stop after it (e.g. 'from 2001:db8::1:
+# refused') is left out, as is a port after an embedded IPv4 address
+# ('::ffff:10.0.0.1:80').
+_IPV4_TEXT = br'(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+_TEXT_PATTERN = (
+    br'(?P<mac>(?<![\w:-])[0-9A-Fa-f]{2}(?P<sep>[:-])'
+    br'(?:[0-9A-Fa-f]{2}(?P=sep)){4}[0-9A-Fa-f]{2}(?![\w:-]))'
+    br'|(?P<ipv6>(?<![\w:.])(?:[0-9A-Fa-f]{0,4}:){2,8}'
+    br'(?:' + _IPV4_TEXT + br'(?!\.?\w)(?!:[A-Za-z_:.])'
+    br'|(?:[0-9A-Fa-f]{1,4}|(?<=::))(?!\.?\w)(?!:[\w:.])))'
+    br'|(?P<ipv4>(?<![\w.])' + _IPV4_TEXT + br'(?!\.?\w))')
+# _TEXT_PATTERN compiled by the first TextAnonymizer
+_text_regex = None
+_CENSORED_MAC = b'XX:XX:XX:XX:XX:XX'
+# the memo value of a text which is not in the memo (None is the value of
+# a text left unchanged)
+_NOT_MEMOIZED = object()
+
+class TextAnonymizer(object):
+    """Anonymize the IP addresses found in text, such as log files.
+    """
+    def __init__(self, cp, mac='censor', memo_size=1000000):
+        """Initialize a TextAnonymizer() instance.
+
+        Args:
+            cp: the CryptoPAn instance used for anonymization.
+            mac: 'censor' to replace MAC addresses with
+                 XX:XX:XX:XX:XX:XX, or 'keep' to leave them.
+            memo_size: the maximum number of distinct addresses whose
+                 results are remembered.  The memo is cleared when full.
+        """
+        global _text_regex
+        assert(mac in ('censor', 'keep'))
+        if _text_regex is None:
+            import re
+            _text_regex = re.compile(_TEXT_PATTERN)
+        self._regex = _text_regex
+        self._cp = cp
+        self._mac = mac
+        self._memo_size = memo_size
+        self._memo = {}
+        # the statistics reported by the --stats option
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.addresses = 0
+
+    def _replace(self, m):
+        text = m.group(0)
+        result = self._memo.get(text, _NOT_MEMOIZED)
+        if result is _NOT_MEMOIZED:
+            if m.group('mac') is not None:
+                result = _CENSORED_MAC if self._mac == 'censor' else None
+            else:
+                try:
+                    result = self._cp.anonymize(text.decode('ascii'),
+                                                fast=True).encode('ascii')
+                except AddressValueError:
+                    # an IPv6 lookalike, such as a time of day
+                    result = None
+            if len(self._memo) >= self._memo_size:
+                self._memo.clear()
+            self._memo[text] = result
+        if result is None:
+            return text
+        self.addresses += 1
+        return result
+
+    def sub(self, data):
+        """Anonymize all the addresses in a bytes object.
+
+        Args:
+            data: bytes containing ASCII compatible text.
+
+        Returns:
+            The bytes with the addresses replaced.
+        """
+        result = self._regex.sub(self._replace, data)
+        self.bytes_in += len(data)
+        self.bytes_out += len(result)
+        return result
+
+    def anonymize_stream(self, infile, outfile, block_size=1 << 20):
+        """Anonymize a binary stream, reading it in blocks of lines.
+
+        Args:
+            infile: a binary file object to read.
+            outfile: a binary file object to write.
+            block_size: the number of bytes read at once.
+        """
+        rest = b''
+        while True:
+            block = infile.read(block_size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            if end:
+                outfile.write(self.sub(block[:end]))
+        if rest:
+            outfile.write(self.sub(rest))
+
+class MultiTextAnonymizer(TextAnonymizer):
+    """Anonymize the IP addresses found in text under several keys,
+    writing one output per key from a single read of the input.
+
+    The addresses of a block which are not in the memo are anonymized
+    together with MultiCryptoPAn.anonymize_bin_many().
+    """
+    def __init__(self, mcp, mac='censor', memo_size=1000000):
+        """Initialize a MultiTextAnonymizer() instance.
+
+        Args:
+            mcp: the MultiCryptoPAn instance used for anonymization.
+            mac: see TextAnonymizer().
+            memo_size: see TextAnonymizer().
+        """
+        TextAnonymizer.__init__(self, mcp, mac, memo_size)
+
+    def _resolve(self, texts):
+        """Anonymizes the address texts under every key into the memo.
+        """
+        cp = self._cp.instances[0]
+        parsed = {4: [], 6: []}
+        for text in texts:
+            try:
+                (value, version) = cp._parse_fast(text.decode('ascii'))
+            except AddressValueError:
+                # an IPv6 lookalike, such as a time of day
+                self._memo[text] = None
+                continue
+            parsed[version].append((text, value))
+        for (version, items) in parsed.items():
+            if not items:
+                continue
+            anonymized = self._cp.anonymize_bin_many(
+                [value for (_, value) in items], version)
+            for (j, (text, _)) in enumerate(items):
+                self._memo[text] = tuple(
+                    cp._format_fast(values[j], version).encode('ascii')
+                    for values in anonymized)
+
+    def sub(self, data):
+        """Anonymize all the addresses in a bytes object under every key.
+
+        Args:
+            data: bytes containing ASCII compatible text.
+
+        Returns:
+            A list of the bytes with the addresses replaced, one per key.
+        """
+        matches = list(self._regex.finditer(data))
+        memo = self._memo
+        if len(memo) + len(matches) > self._memo_size:
+            memo.clear()
+        missing = OrderedDict()
+        for m in matches:
+            text = m.group(0)
+            if text in memo or text in missing:
+                continue
+            if m.group('mac') is not None:
+                memo[text] = (_CENSORED_MAC if self._mac == 'censor' else None)
+            else:
+                missing[text] = None
+        if missing:
+            self._resolve(missing)
+        # the text between the addresses, and the replacement of each
+        # address per key
+        pieces = []
+        replaced = []
+        last = 0
+        for m in matches:
+            text = m.group(0)
+            result = memo[text]
+            if result is None:
+                continue
+            pieces.append(data[last:m.start()])
+            replaced.append(result)
+            last = m.end()
+        tail = data[last:]
+        self.addresses += len(replaced)
+        self.bytes_in += len(data)
+        results = []
+        for k in range(len(self._cp)):
+            parts = []
+            for (piece, result) in zip(pieces, replaced):
+                parts.append(piece)
+                parts.append(result if result is _CENSORED_MAC else result[k])
+            parts.append(tail)
+            result = b''.join(parts)
+            self.bytes_out += len(result)
+            results.append(result)
+        return results
+
+    def anonymize_stream(self, infile, outfiles, block_size=1 << 20):
+        """Anonymize a binary stream under every key, reading it in blocks
+        of lines.
+
+        Args:
+            infile: a binary file object to read.
+            outfiles: binary file objects to write, one per key.
+            block_size: the number of bytes read at once.
+        """
+        assert(len(outfiles) == len(self._cp))
+        rest = b''
+        while True:
+            block = infile.read(block_size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            if end:
+                for (outfile, result) in zip(outfiles, self.sub(block[:end])):
+                    outfile.write(result)
+        if rest:
+            for (outfile, result) in zip(outfiles, self.sub(rest)):
+                outfile.write(result)
+
+def main(argv=None):
+    """The yacryptopan command, which anonymizes the IP addresses in
+    text files or the standard input.
+    """
+    import argparse
+    import binascii
+
+    def int_at_least(minimum):
+        def convert(text):
+            try:
+                value = int(text)
+            except ValueError:
+                raise argparse.ArgumentTypeError('invalid int value: %r' % text)
+            if value < minimum:
+                raise argparse.ArgumentTypeError('%d is less than %d'
+                                                 % (value, minimum))
+            return value
+        return convert
+
+    parser = argparse.ArgumentParser(
+        prog='yacryptopan',
+        description='Anonymize the IP addresses in text files keeping '
+                    'their prefix consistency.')
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='input files (default: the standard input)')
+    key_group = parser.add_mutually_exclusive_group(required=True)
+    key_group.add_argument('-k', '--key', action='append',
+                           help='the 32 bytes key as 64 hex digits; '
+                                'repeat it with -o to write one output '
+                                'per key from a single read')
+    key_group.add_argument('--key-file', action='append',
+                           help='a file containing the 32 bytes key '
+                                '(repeatable as -k)')
+    parser.add_argument('-o', '--output', action='append',
+                        help='output file (default: the standard output), '
+                             'one per key')
+    parser.add_argument('--mac', choices=('censor', 'keep'), default='censor',
+                        help='what to do with MAC addresses '
+                             '(default: censor)')
+    # an instance with a prefix cache does not use the C accelerator,
+    # which is faster than the cache
+    default_cache_size = 0 if _yacryptopan is not None else 100000
+    parser.add_argument('--cache-size', type=int_at_least(0),
+                        default=default_cache_size,
+                        help='the size of the prefix cache, 0 for none; it '
+                             'disables the C accelerator (default: %d)'
+                             % default_cache_size)
+    parser.add_argument('--table', action='append',
+                        help='a prefix table file made with the same key, '
+                             'one per key')
+    parser.add_argument('--embedded-ipv4', action='store_true',
+                        help='anonymize IPv4-mapped, NAT64 and 6to4 '
+                             'addresses consistently with their IPv4 '
+                             'address')
+    parser.add_argument('--block-size', type=int_at_least(1), default=1 << 20,
+                        help='the number of bytes read at once')
+    parser.add_argument('--stats', action='store_true',
+                        help='report the throughput to the standard error')
+    args = parser.parse_args(argv)
+
+    keys = []
+    if args.key is not None:
+        for hexkey in args.key:
+            try:
+                keys.append(binascii.unhexlify(hexkey))
+            except (TypeError, ValueError):
+                parser.error('the key must be given as hex digits')
+    else:
+        for path in args.key_file:
+            with open(path, 'rb') as f:
+                keys.append(f.read())
+    if any(len(key) != 32 for key in keys):
+        parser.error('the key must be 32 bytes long')
+    outputs = args.output or [None]
+    if len(outputs) != len(keys):
+        parser.error('give one output file per key')
+    tables = args.table or [None] * len(keys)
+    if len(tables) != len(keys):
+        parser.error('give one prefix table per key')
 
-        return addr ^ result
+    cps = [CryptoPAn(key, cache_size=args.cache_size or None, table=table,
+                     embedded_ipv4=args.embedded_ipv4)
+           for (key, table) in zip(keys, tables)]
+    outfiles = [sys.stdout.buffer if path is None else open(path, 'wb')
+                for path in outputs]
+    if len(cps) == 1:
+        text = TextAnonymizer(cps[0], mac=args.mac)
+        out = outfiles[0]
+    else:
+        text = MultiTextAnonymizer(MultiCryptoPAn(cps), mac=args.mac)
+        out = outfiles
+    stime = time.time()
+    try:
+        if not args.files:
+            text.anonymize_stream(sys.stdin.buffer, out, args.block_size)
+        for path in args.files:
+            with open(path, 'rb') as infile:
+                text.anonymize_stream(infile, out, args.block_size)
+    finally:
+        for outfile in outfiles:
+            outfile.flush()
+            if outfile is not sys.stdout.buffer:
+                outfile.close()
+    dtime = time.time() - stime
+    if args.stats:
+        print('%d bytes in, %d bytes out, %d addresses in %.3f s, %.2f MB/s'
+              % (text.bytes_in, text.bytes_out, text.addresses, dtime,
+                 text.bytes_out / dtime / 1e6 if dtime else 0.0),
+              file=sys.stderr)
+    return 0
 
 if __name__ == '__main__':
     # do the same test as the pycryptopan does.